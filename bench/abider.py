@@ -0,0 +1,46 @@
+"""Attribute write throughput of tracked objects, with and without
+a rulebook watching the written attribute."""
+from benchlib import *
+from rulebook import loader
+from rulebook.abider import RuleAbider, SlottedAbider
+
+WRITES = 10000
+
+class Plain(object):
+    pass
+
+class Abider(RuleAbider):
+    pass
+
+class Slotted(SlottedAbider):
+    FIELDS = ['watched', 'unwatched', 'out']
+
+def make(cls):
+    obj = cls()
+    obj.watched = obj.unwatched = obj.out = 0
+    return obj
+
+def writes(obj, attr):
+    def bench():
+        for i in range(WRITES):
+            setattr(obj, attr, i)
+    return bench
+
+def main():
+    rows = []
+    for cls in [Plain, Abider, Slotted]:
+        obj = make(cls)
+        rows.append((cls.__name__, 'no rulebook',
+                     '%.3f' % (measure(writes(obj, 'unwatched')) / WRITES * 1e6)))
+        if cls is Plain: continue
+        root, ctx = loader.load_string('obj.out = obj.watched + 1\n')
+        ctx.ns.obj = obj
+        root.set_active(True)
+        rows.append((cls.__name__, 'unwatched attr',
+                     '%.3f' % (measure(writes(obj, 'unwatched')) / WRITES * 1e6)))
+        rows.append((cls.__name__, 'watched attr',
+                     '%.3f' % (measure(writes(obj, 'watched'), repeat=3) / WRITES * 1e6)))
+    report(('class', 'write', 'time [us]'), rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Aggregating assignments (``+=``, ``max=``) over the items of a large
+``for`` loop: the time to activate the loop and to process a change of
+a single item, with the incremental aggregates and with plain folding.
+
+Then the same for an aggregate expression (``sum(... for c in conns)``),
+compared to the equivalent list comprehension, which is evaluated in full."""
+from benchlib import *
+import logging
+from unittest import mock
+from rulebook import loader, aggregate
+from rulebook.abider import RuleAbider
+from rulebook.tracked import TrackedList
+
+RULEBOOK = '''
+total = 0 prio -1
+biggest = 0 prio -1
+for itm in items:
+    total += itm.size
+    biggest max= itm.size
+'''
+
+class Item(RuleAbider):
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+def bench(n):
+    root, ctx = loader.load_string(RULEBOOK)
+    items = ctx.ns.items = [ Item(i) for i in range(n) ]
+    t_build = measure(lambda: root.set_active(True), repeat=1)
+    item = items[n // 2]
+    def change():
+        item.size += 1
+    t_change = measure(change, repeat=3, number=10) / 10
+    assert ctx.ns.total == sum( item.size for item in items )
+    return t_build, t_change
+
+EXPR = 'stats.up = sum(%s1 for c in conns if c.up%s)\n'
+
+def bench_expr(n, brackets):
+    root, ctx = loader.load_string(EXPR % brackets)
+    conns = ctx.ns.conns = TrackedList( Item(i) for i in range(n) )
+    for conn in conns:
+        conn.up = True
+    ctx.ns.stats = stats = Item(0)
+    t_build = measure(lambda: root.set_active(True), repeat=1)
+    conn = conns[n // 2]
+    def change():
+        conn.up = not conn.up
+    t_change = measure(change, repeat=3, number=10) / 10
+    assert stats.up == sum( conn.up for conn in conns )
+    return t_build, t_change
+
+def main():
+    # Plain lists cannot be tracked, do not warn about them
+    logging.disable(logging.WARNING)
+    rows = []
+    for n in [1000, 10000]:
+        t_build, t_change = bench(n)
+        with mock.patch.dict(aggregate.KINDS, clear=True):
+            t_build_folded, t_change_folded = bench(n)
+        rows.append((n, '%.1f' % (t_build * 1e3), '%.1f' % (t_build_folded * 1e3),
+                     '%.3f' % (t_change * 1e3), '%.3f' % (t_change_folded * 1e3)))
+    report(('items', 'build [ms]', 'folded', 'change [ms]', 'folded'), rows)
+    print()
+    rows = []
+    for n in [1000, 10000]:
+        t_build, t_change = bench_expr(n, ('', ''))
+        t_build_full, t_change_full = bench_expr(n, ('[', ']'))
+        rows.append((n, '%.1f' % (t_build * 1e3), '%.1f' % (t_build_full * 1e3),
+                     '%.3f' % (t_change * 1e3), '%.3f' % (t_change_full * 1e3)))
+    report(('conns', 'build [ms]', 'full', 'change [ms]', 'full'), rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Shared helpers for the microbenchmarks in this directory.
+
+Run the benchmarks directly, e.g. ``python bench/valueset.py``."""
+import sys, os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def measure(func, repeat=5, number=1):
+    """Return the best time (in seconds) of ``repeat`` runs of ``number`` calls of ``func``."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(header, rows):
+    """Print a simple aligned table."""
+    widths = [ max(len(str(x)) for x in col) for col in zip(header, *rows) ]
+    for row in [header] + rows:
+        print('  '.join(str(x).rjust(w) for x, w in zip(row, widths)))
+
+def sample_rulebook(n):
+    """Return the source of a synthetic rulebook with ``n`` rule groups."""
+    parts = []
+    for i in range(n):
+        parts.append(
+            'if obj.a%d > 0:\n'
+            '    obj.b%d = obj.a%d.real + 1\n'
+            '    obj.c%d = [ x * 2 for x in range(obj.a%d) ]\n'
+            'else:\n'
+            '    obj.b%d = 0 prio 2\n'
+            'for x in obj.items%d:\n'
+            '    x.parent = obj\n' % ((i,) * 7))
+    return ''.join(parts)
@@ -0,0 +1,34 @@
+"""Compile throughput (Rulebook AST to code object) of rulebooks dominated
+by ``for`` loops and imports, which are compiled using AST templates."""
+import builtins
+import ast as pyast
+from benchlib import *
+from rulebook import parser, compiler
+
+REPEAT = 3
+
+def for_rulebook(n):
+    return ''.join('for x in obj.items%d:\n    x.parent%d = obj\n' % (i, i) for i in range(n))
+
+def import_rulebook(n):
+    return ''.join('import mod%d\nfrom pkg%d import name as alias%d\n' % (i, i, i) for i in range(n))
+
+def compile_bench(src):
+    # Compiling may modify the AST, use a fresh one for every run.
+    trees = [ parser.parse(src) for _ in range(REPEAT) ]
+    def bench():
+        node = compiler.Compiler().transform_node(trees.pop())
+        node = pyast.fix_missing_locations(node)
+        builtins.compile(node, '<bench>', 'exec')
+    return bench
+
+def main():
+    rows = []
+    for kind, gen in [('for', for_rulebook), ('import', import_rulebook)]:
+        for n in [100, 1000]:
+            t = measure(compile_bench(gen(n)), repeat=REPEAT)
+            rows.append((kind, n, '%.1f' % (t * 1e3), '%.0f' % (n / t)))
+    report(('kind', 'count', 'time [ms]', 'per second'), rows)
+
+if __name__ == '__main__':
+    main()
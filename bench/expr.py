@@ -0,0 +1,39 @@
+"""Tracked evaluation of deep attribute chains (``N.o.next.next...``):
+the generic ``ObjectWrapper`` path versus ``Context.read_path``."""
+from benchlib import *
+from rulebook.runtime import Context
+from rulebook.abider import RuleAbider
+
+EVALS = 2000
+
+class Node(RuleAbider):
+    pass
+
+def main():
+    ctx = Context()
+    obj = ctx.ns.o = Node()
+    for i in range(16):
+        obj.value = i
+        obj.next = Node()
+        obj = obj.next
+    N = ctx.nswrap
+    rows = []
+    for depth in [1, 2, 4, 8, 16]:
+        src = 'N.o' + '.next' * (depth - 1) + '.value'
+        generic = eval('lambda: ' + src, {'N': N})
+        path = (('attr', 'o'),) + (('attr', 'next'),) * (depth - 1) + (('attr', 'value'),)
+        specialized = lambda: ctx.read_path(N, path)
+        assert ctx.tracked_eval(generic) == ctx.tracked_eval(specialized)
+        def run(expr):
+            def bench():
+                for _ in range(EVALS):
+                    ctx.tracked_eval(expr)
+            return bench
+        t_generic = measure(run(generic)) / EVALS
+        t_special = measure(run(specialized)) / EVALS
+        rows.append((depth + 1, '%.2f' % (t_generic * 1e6), '%.2f' % (t_special * 1e6),
+                     '%.1fx' % (t_generic / t_special)))
+    report(('hops', 'generic [us]', 'read_path [us]', 'speedup'), rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Replacing the list iterated by a ``for`` loop with fresh but logically
+identical objects (as a polling data layer does), with and without a key."""
+from benchlib import *
+import logging
+from rulebook import loader
+from rulebook.abider import RuleAbider
+
+ITEMS = 200
+
+class Device(RuleAbider):
+    def __init__(self, name, rate):
+        super().__init__()
+        self.name, self.rate = name, rate
+
+class Config(RuleAbider):
+    enabled = True
+    verbose = False
+
+def poll():
+    return [ Device('dev%d' % i, i) for i in range(ITEMS) ]
+
+def bench(header):
+    root, ctx = loader.load_string(header + ':\n'
+                                   '    dev.limit = dev.rate * 2\n'
+                                   '    if cfg.enabled:\n'
+                                   '        dev.load = dev.rate + 1 prio 5\n'
+                                   '        if cfg.verbose:\n'
+                                   '            dev.log = True\n')
+    ctx.ns.cfg = Config()
+    ctx.ns.devs = poll()
+    root.set_active(True)
+    def replace():
+        ctx.ns.devs = poll()
+    return measure(replace, repeat=3)
+
+def main():
+    # Plain lists cannot be tracked, do not warn about them
+    logging.disable(logging.WARNING)
+    rows = []
+    for header in ['for dev in devs', 'for dev in devs key dev.name']:
+        rows.append((header, '%.2f' % (bench(header) * 1e3)))
+    report(('loop', 'replace %d items [ms]' % ITEMS), rows)
+
+if __name__ == '__main__':
+    main()
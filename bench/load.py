@@ -0,0 +1,29 @@
+"""Startup cost of ``loader.load`` for a large rulebook, with a cold
+(missing) and a warm (up-to-date) bytecode cache."""
+import os, sys, tempfile
+from benchlib import *
+from rulebook import loader
+
+def main():
+    sys.dont_write_bytecode = False
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in [10, 100, 500]:
+            fn = os.path.join(tmp, 'rules%d.rbk' % n)
+            with open(fn, 'w') as file:
+                file.write(sample_rulebook(n))
+            cache_fn = loader.cache_from_source(fn)
+            def cold():
+                if os.path.exists(cache_fn):
+                    os.unlink(cache_fn)
+                loader.load(fn)
+            def warm():
+                loader.load(fn)
+            lines = sample_rulebook(n).count('\n')
+            t_cold, t_warm = measure(cold, repeat=3), measure(warm, repeat=3)
+            rows.append((lines, '%.1f' % (t_cold * 1e3), '%.1f' % (t_warm * 1e3),
+                         '%.1fx' % (t_cold / t_warm)))
+    report(('lines', 'cold [ms]', 'warm [ms]', 'speedup'), rows)
+
+if __name__ == '__main__':
+    main()
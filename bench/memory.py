@@ -0,0 +1,41 @@
+"""Memory used by an active ``Assign`` (including its value set and
+watchsets) in the body of a large ``for`` loop, measured with tracemalloc."""
+from benchlib import *
+import gc, logging, tracemalloc
+from rulebook import loader
+from rulebook.abider import RuleAbider
+
+SIZES = [1000, 10000]
+RULEBOOK = '''
+for itm in items:
+    itm.y = itm.x + 1
+    itm.z = 0 prio -1
+    if itm.x > 0:
+        itm.w = itm.y * 2
+'''
+ASSIGNS = 3 # Per item
+
+class Item(RuleAbider):
+    def __init__(self, x):
+        super().__init__()
+        self.x = x
+
+def bench(size):
+    root, ctx = loader.load_string(RULEBOOK)
+    ctx.ns.items = [ Item(i) for i in range(size) ]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    root.set_active(True)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / (size * ASSIGNS)
+
+def main():
+    # Plain lists cannot be tracked, do not warn about them
+    logging.disable(logging.WARNING)
+    report(('items', 'bytes per Assign'), [ (size, '%.0f' % bench(size)) for size in SIZES ])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+"""Parse throughput of large generated rulebooks: the single-pass
+translation versus the legacy per-expression parser."""
+from benchlib import *
+from rulebook import parser
+
+def main():
+    rows = []
+    for n in [100, 500, 2000]:
+        src = sample_rulebook(n)
+        lines = src.count('\n')
+        tokens = parser.tokenize(src, ensure_newline=True)
+        t_legacy = measure(lambda: parser.parse(tokens, single_pass=False), repeat=3)
+        t_single = measure(lambda: parser.parse(tokens), repeat=3)
+        rows.append((lines, '%.0f' % (lines / t_legacy), '%.0f' % (lines / t_single),
+                     '%.1fx' % (t_legacy / t_single)))
+    report(('lines', 'legacy [lines/s]', 'single-pass [lines/s]', 'speedup'), rows)
+
+if __name__ == '__main__':
+    main()
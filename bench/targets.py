@@ -0,0 +1,56 @@
+"""Cost of the table lookups done for every read and notification:
+``ObjectKeyDict`` with ``(obj, subtype, subname)`` tuple keys versus
+plain dicts keyed by interned ``Target``s."""
+from benchlib import *
+from rulebook.util import ObjectKeyDict, Target
+from rulebook.runtime import Context
+from rulebook.abider import RuleAbider
+
+N = 1000
+
+class Obj(RuleAbider):
+    pass
+
+def main():
+    objs = [ Obj() for _ in range(N) ]
+    okd = ObjectKeyDict()
+    plain = {}
+    for obj in objs:
+        okd[(obj, 'attr', 'x')] = 1
+        plain[Target.get(obj, 'attr', 'x')] = 1
+    targets = list(plain)
+
+    def okd_lookup():
+        for obj in objs:
+            (obj, 'attr', 'x') in okd
+            okd.get((obj, 'attr', 'y'), None)
+    def target_lookup():
+        for obj in objs:
+            Target.get(obj, 'attr', 'x') in plain
+            plain.get(Target.get(obj, 'attr', 'y'), None)
+    def interned_lookup():
+        for target in targets:
+            target in plain
+            plain.get(target, None)
+
+    ctx = Context()
+    for obj in objs:
+        obj.x = 1
+    def read_value():
+        with ctx.track_reads():
+            for obj in objs:
+                ctx.read_value(Target.get(obj, 'attr', 'x'))
+
+    rows = []
+    base = None
+    for name, func in [('ObjectKeyDict, tuple keys (2 lookups)', okd_lookup),
+                       ('dict, Target.get() keys (2 lookups)', target_lookup),
+                       ('dict, pre-interned Targets (2 lookups)', interned_lookup),
+                       ('Context.read_value (tracked)', read_value)]:
+        t = measure(func, number=20) / (20 * N)
+        if base is None: base = t
+        rows.append((name, '%.3f' % (t * 1e6), '%.1fx' % (base / t)))
+    report(('operation (per object)', 'time [us]', 'speedup'), rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Appending and removing one item of a large collection iterated by
+a ``for`` loop: a plain list has to be replaced (and the whole loop
+re-evaluated), a ``TrackedList`` reports the change incrementally."""
+from benchlib import *
+import logging
+from rulebook import loader
+from rulebook.abider import RuleAbider
+from rulebook.tracked import TrackedList
+
+SIZES = [1000, 10000, 50000]
+CHANGES = 10
+
+class Item(RuleAbider):
+    def __init__(self, x):
+        super().__init__()
+        self.x = x
+
+def bench(size, tracked):
+    root, ctx = loader.load_string('for itm in lst:\n'
+                                   '    itm.y = itm.x + 1\n')
+    items = [ Item(i) for i in range(size) ]
+    ctx.ns.lst = TrackedList(items) if tracked else items
+    root.set_active(True)
+    extra = Item(-1)
+    def change():
+        for _ in range(CHANGES):
+            if tracked:
+                ctx.ns.lst.append(extra)
+                ctx.ns.lst.pop()
+            else:
+                ctx.ns.lst = items + [extra]
+                ctx.ns.lst = items
+    return measure(change, repeat=3) / CHANGES / 2
+
+def main():
+    # Plain lists cannot be tracked, do not warn about them
+    logging.disable(logging.WARNING)
+    rows = []
+    for size in SIZES:
+        rows.append((size, '%.3f' % (bench(size, False) * 1e3), '%.3f' % (bench(size, True) * 1e3)))
+    report(('items', 'list [ms/change]', 'TrackedList [ms/change]'), rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Cost of changing one contributor of a value set and reading the winner,
+as a function of the value set size. Compares the incrementally maintained
+``ValueSet`` with sorting a plain ``{ident: (val, prio, comb)}`` dict."""
+import random
+from benchlib import *
+from rulebook.runtime import ValueSet, get_effective_value
+
+UPDATES = 2000
+
+def run_dict(n, updates):
+    vals = { i: (i, i, None) for i in range(n) }
+    def bench():
+        for ident, val, prio in updates:
+            vals[ident] = (val, prio, None)
+            get_effective_value(vals)
+    return bench
+
+def run_valueset(n, updates):
+    vals = ValueSet()
+    for i in range(n):
+        vals.set(i, i, i)
+    def bench():
+        for ident, val, prio in updates:
+            vals.set(ident, val, prio)
+            vals.get_effective_value()
+    return bench
+
+def main():
+    rnd = random.Random(0)
+    rows = []
+    for n in [10, 100, 1000, 10000]:
+        updates = [ (rnd.randrange(n), rnd.random(), rnd.randrange(n)) for _ in range(UPDATES) ]
+        t_dict = measure(run_dict(n, updates), repeat=3) / UPDATES
+        t_vs = measure(run_valueset(n, updates), repeat=3) / UPDATES
+        rows.append((n, '%.2f' % (t_dict * 1e6), '%.2f' % (t_vs * 1e6), '%.1fx' % (t_dict / t_vs)))
+    report(('size', 'sorted dict [us]', 'ValueSet [us]', 'speedup'), rows)
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,75 @@ from functools import wraps
 from itertools import chain
 from .util import *
 
-class RuleAbider(object):
+class AbiderBase(object):
+    """The common base of objects whose changes can be tracked by a rulebook.
+
+    Trackers (usually ``Context.notify_change``) subscribe to individual
+    targets of the object, identified by ``(subtype, subname)``, e.g.
+    ``('attr', 'x')``. When the object changes, it calls ``_changed``
+    with the changed sub-target, which calls the trackers subscribed
+    to it (and nothing else, so changes nobody watches are cheap).
+
+    Trackers in ``_rbk_trackers`` are called for all changes.
+
+    A sub-target is almost always watched by a single tracker, which is then
+    stored in ``_rbk_subs`` directly. Only additional trackers make it a set.
+
+    Membership tests (``key in obj``) are watched as ``('contains', key)``.
+    Objects that only report ``('item', key)`` changes still wake them up,
+    as a change of ``('item', key)`` is also reported as one of
+    ``('contains', key)``, unless ``_ITEMS_IMPLY_CONTAINS`` is false (for
+    objects reporting membership changes themselves, like ``TrackedCollection``).
+    """
+    __slots__ = ()
+    _ITEMS_IMPLY_CONTAINS = True
+
+    def _rbk_subscribe(self, sub, tracker):
+        subs = self._rbk_subs
+        if subs is None:
+            subs = self._rbk_subs = {}
+        cur = subs.get(sub)
+        if cur is None:
+            subs[sub] = tracker
+        elif type(cur) is set:
+            cur.add(tracker)
+        elif cur != tracker:
+            subs[sub] = {cur, tracker}
+
+    def _rbk_unsubscribe(self, sub, tracker):
+        subs = self._rbk_subs
+        cur = subs.get(sub) if subs else None
+        if cur is None: return
+        if type(cur) is set:
+            cur.discard(tracker)
+            if len(cur) == 1:
+                subs[sub], = cur
+        elif cur == tracker:
+            del subs[sub]
+
+    def _changed(self, sub):
+        if isinstance(sub, str): sub = ('attr', sub)
+        elif sub[0] == 'item' and self._ITEMS_IMPLY_CONTAINS:
+            self._changed(('contains', sub[1]))
+        subs = self._rbk_subs
+        trackers = subs.get(sub) if subs else None
+        if not (trackers or self._rbk_trackers): return
+        target = Target.get(self, *sub)
+        for tracker in self._rbk_trackers:
+            tracker(target)
+        if type(trackers) is set:
+            # The set may change when a tracker processes the change.
+            for tracker in list(trackers):
+                tracker(target)
+        elif trackers is not None:
+            trackers(target)
+
+class RuleAbider(AbiderBase):
+    # Class-level defaults, so that changes made before ``__init__``
+    # is called do not fail.
+    _rbk_subs = None
+    _rbk_trackers = frozenset()
+
     def __init__(self):
         self._rbk_trackers = set()
     def __setattr__(self, name, val):
@@ -12,15 +80,58 @@ class RuleAbider(object):
         super().__setattr__(name, val)
         if not name.startswith('_'):
             self._changed(name)
-    def _changed(self, sub):
-        if isinstance(sub, str): sub = ('attr', sub)
-        for tracker in self._rbk_trackers:
-            tracker((self,) + sub)
+
+class _SlottedAbiderMeta(type):
+    def __new__(mcls, name, bases, ns):
+        fields = ns.get('FIELDS', [])
+        ns['__slots__'] = tuple(ns.get('__slots__', ())) + tuple( '_rbk_f_' + f for f in fields )
+        # Class-level values of fields are their defaults. They must be
+        # removed from the namespace, they would conflict with the properties.
+        defaults = { f: ns.pop(f) for f in fields if f in ns }
+        cls = super().__new__(mcls, name, bases, ns)
+        for f in fields:
+            setattr(cls, f, _make_field(f, getattr(cls, '_rbk_f_' + f), defaults.get(f, NOTHING)))
+        return cls
+
+def _make_field(name, member, default):
+    sub = ('attr', name)
+    get_slot, set_slot = member.__get__, member.__set__
+    def getter(self):
+        try:
+            return get_slot(self)
+        except AttributeError:
+            if default is NOTHING:
+                raise AttributeError(name) from None
+            return default
+    def setter(self, val):
+        set_slot(self, val)
+        subs = self._rbk_subs
+        if subs and sub in subs or self._rbk_trackers:
+            self._changed(sub)
+    getter.__name__ = setter.__name__ = name
+    return property(getter, setter)
+
+class SlottedAbider(AbiderBase, metaclass=_SlottedAbiderMeta):
+    """A compact and faster variant of ``RuleAbider`` with a fixed set of fields::
+
+        class Device(SlottedAbider):
+            FIELDS = ['name', 'rate', 'enabled']
+            enabled = False # Default value
+
+    The fields are stored in ``__slots__`` and accessed through generated
+    properties, whose setters skip the change notification altogether
+    when the field is not watched by any rulebook. Only the fields listed
+    in ``FIELDS`` are tracked. Subclasses may list additional ``FIELDS``.
+    """
+    __slots__ = ('_rbk_subs', '_rbk_trackers', '__weakref__')
+
+    def __new__(cls, *a, **kw):
+        self = super().__new__(cls)
+        self._rbk_subs = None
+        self._rbk_trackers = ()
+        return self
 
 class AbideWrapper(RuleAbider):
     def __init__(self, obj):
         self.obj = obj
         raise NotImplementedError
-
-
-
@@ -0,0 +1,408 @@
+"""Incrementally maintained aggregates of relative values.
+
+A rule like ``total += item.size`` inside a ``for`` over many items adds one
+relative value per item to the value set of `total`. Folding all of them on
+every change would cost O(n) per change (and O(n^2) to build the loop), so
+``ValueSet`` groups the relative values with the same combining function and
+priority into an ``Aggregate``, which keeps their fold up to date on every
+change:
+
+  * ``+=`` (``Sum``) -- O(1) per change for numbers,
+  * ``count=`` (``Count``) -- the number of true values, O(1),
+  * ``|=`` and ``&=`` of booleans (``Any``, ``All``) -- O(1),
+  * ``max=`` and ``min=`` (``Max``, ``Min``) -- O(log n), using a heap.
+
+Values an aggregate cannot maintain incrementally (e.g. ``+=`` of lists,
+which does not commute, or ``|=`` of sets) are folded one by one, just like
+individual relative values. So are groups sharing their priority with other
+relative values, where the order of the combining functions matters.
+
+The same aggregates keep the aggregate expressions of rulebooks, like
+``sum(1 for c in conns if c.up)``, up to date element by element (see
+``CollectionAggregate``).
+"""
+import collections
+import heapq
+import operator
+from functools import partial, reduce
+from .abider import AbiderBase
+from .tracked import TrackedCollection
+from .util import NOTHING, Target
+
+def count(acc, val):
+    """The combining function of ``count=``: add one for a true value."""
+    return acc + bool(val)
+
+class Aggregate:
+    """The fold of a group of relative values with the same combining function.
+
+    Subclasses maintain the fold incrementally in ``_add`` and ``_remove``.
+    When they return False, the value is not supported and the aggregate
+    falls back to folding all of its values on every change."""
+    __slots__ = ('comb', 'seq', 'values', '_fallback')
+
+    def __init__(self, comb, seq):
+        self.comb = comb
+        # The position of the group among the relative values (see ``ValueSet``)
+        self.seq = seq
+        self.values = {} # ident -> val, in the order of addition
+        self._fallback = 0 # The number of unsupported values
+
+    def set(self, ident, val):
+        old = self.values.get(ident, NOTHING)
+        if old is not NOTHING:
+            self._discard(old)
+        self.values[ident] = val
+        if not self._add(val):
+            self._fallback += 1
+
+    def remove(self, ident):
+        self._discard(self.values.pop(ident))
+
+    def _discard(self, val):
+        if not self._remove(val):
+            self._fallback -= 1
+
+    def apply(self, base):
+        """Return `base` combined with all the values."""
+        if self._fallback:
+            return reduce(self.comb, self.values.values(), base)
+        return self._apply(base)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.values)
+
+_NUMBERS = (int, float, bool)
+
+class Sum(Aggregate):
+    __slots__ = ('total', '_removed')
+
+    def __init__(self, comb, seq):
+        super().__init__(comb, seq)
+        self.total = 0
+        self._removed = 0
+
+    def _add(self, val):
+        if type(val) not in _NUMBERS: return False
+        self.total += val
+        return True
+
+    def _remove(self, val):
+        if type(val) not in _NUMBERS: return False
+        self.total -= val
+        self._removed += 1
+        if type(val) is float and self._removed > len(self.values):
+            # Do not let rounding errors of floats accumulate
+            self._removed = 0
+            self.total = sum( val for val in self.values.values() if type(val) in _NUMBERS )
+        return True
+
+    def _apply(self, base):
+        return base + self.total
+
+class Count(Aggregate):
+    __slots__ = ('true',)
+
+    def __init__(self, comb, seq):
+        super().__init__(comb, seq)
+        self.true = 0
+
+    def _add(self, val):
+        if val: self.true += 1
+        return True
+
+    def _remove(self, val):
+        if val: self.true -= 1
+        return True
+
+    def _apply(self, base):
+        return base + self.true
+
+class Any(Count):
+    """``|=`` of booleans."""
+    __slots__ = ()
+
+    def _add(self, val):
+        return type(val) is bool and super()._add(val)
+
+    def _remove(self, val):
+        return type(val) is bool and super()._remove(val)
+
+    def _apply(self, base):
+        return base | (self.true > 0)
+
+class All(Any):
+    """``&=`` of booleans."""
+    __slots__ = ()
+
+    def _apply(self, base):
+        return base & (self.true == len(self.values))
+
+class _Reversed:
+    __slots__ = ('val',)
+    def __init__(self, val):
+        self.val = val
+    def __lt__(self, other):
+        return other.val < self.val
+
+class Min(Aggregate):
+    """Keeps the values in a binary heap with lazy deletion (see ``ValueSet``)."""
+    __slots__ = ('_heap', '_seqs', '_seq')
+    _key = staticmethod(lambda val: val)
+
+    def __init__(self, comb, seq):
+        super().__init__(comb, seq)
+        self._heap = [] # (key, seq, ident)
+        self._seqs = {} # ident -> seq of its heap entry
+        self._seq = 0
+
+    def set(self, ident, val):
+        super().set(ident, val)
+        self._seq += 1
+        self._seqs[ident] = self._seq
+        heapq.heappush(self._heap, (self._key(val), self._seq, ident))
+        if len(self._heap) > 2 * len(self.values) + 16:
+            self._heap = [ entry for entry in self._heap if self._is_live(entry) ]
+            heapq.heapify(self._heap)
+
+    def remove(self, ident):
+        super().remove(ident)
+        del self._seqs[ident]
+
+    def _is_live(self, entry):
+        return self._seqs.get(entry[2]) == entry[1]
+
+    def _add(self, val):
+        return True
+
+    def _remove(self, val):
+        return True
+
+    def top(self):
+        """Return the smallest (for ``Max`` the largest) value, NOTHING if empty."""
+        heap = self._heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+        return self.values[heap[0][2]] if heap else NOTHING
+
+    def _apply(self, base):
+        top = self.top()
+        return base if top is NOTHING else self.comb(base, top)
+
+class Max(Min):
+    __slots__ = ()
+    _key = _Reversed
+
+# Combining function -> the aggregate maintaining its fold
+KINDS = {
+    operator.add: Sum,
+    count: Count,
+    operator.or_: Any,
+    operator.and_: All,
+    min: Min,
+    max: Max,
+}
+
+def groupcount(iterable):
+    """Count the occurences of each value, e.g. ``groupcount(c.kind for c in conns)``."""
+    return collections.Counter(iterable)
+
+class GroupCount(Aggregate):
+    __slots__ = ('counts',)
+
+    def __init__(self, comb, seq):
+        super().__init__(comb, seq)
+        self.counts = {}
+
+    def _add(self, val):
+        self.counts[val] = self.counts.get(val, 0) + 1
+        return True
+
+    def _remove(self, val):
+        self.counts[val] -= 1
+        if not self.counts[val]:
+            del self.counts[val]
+        return True
+
+    def _apply(self, base):
+        return collections.Counter(self.counts)
+
+# The aggregate expressions compiled into ``Context.aggregate`` calls:
+# name -> (the builtin, the aggregate maintaining it, its combining function)
+EXPRESSIONS = {
+    'sum': (sum, Sum, operator.add),
+    'min': (min, Min, min),
+    'max': (max, Max, max),
+    'any': (any, Count, count),
+    'all': (all, Count, count),
+    'groupcount': (groupcount, GroupCount, None),
+}
+
+def evaluate(kind, coll, project, cond=None):
+    """Evaluate an aggregate expression directly, like the original code."""
+    return EXPRESSIONS[kind][0]( project(x) for x in coll if cond is None or cond(x) )
+
+# Collections whose elements ``CollectionAggregate`` can diff cheaply
+COLLECTIONS = (TrackedCollection, list, tuple, set, frozenset, dict)
+
+VALUE = ('attr', 'value')
+
+class CollectionAggregate(AbiderBase):
+    """An aggregate expression over a collection (``sum(c.n for c in conns)``),
+    kept up to date element by element (see ``Context.aggregate``).
+
+    The contribution of every element (``project(elem)`` if ``cond(elem)``)
+    is evaluated and watched separately, so a change of one element only
+    re-evaluates that element and updates the result in O(1) (O(log n) for
+    `min` and `max`). The expression containing the aggregate only watches
+    its result (``('attr', 'value')``), not every element.
+
+    Changes of a ``TrackedCollection`` are applied as deltas. Other
+    collections are compared with the previous contents whenever the
+    expression is evaluated."""
+    __slots__ = ('ctx', 'kind', 'key', 'ns', 'project', 'cond', 'coll', 'elems', 'agg',
+                 'result', 'pending', 'target', '_rbk_subs', '_rbk_trackers', '__weakref__')
+
+    def __init__(self, ctx, kind, key, ns):
+        self._rbk_subs = None
+        self._rbk_trackers = ()
+        self.ctx = ctx
+        self.kind = kind
+        self.key = key
+        self.ns = ns # Keeps the id in `key` valid
+        self.project = self.cond = None
+        self.coll = None
+        self.elems = {} # id(elem) -> [elem, number of occurences, contribution or NOTHING]
+        _, cls, comb = EXPRESSIONS[kind]
+        self.agg = cls(comb, 0)
+        self.result = NOTHING
+        self.pending = []
+        self.target = Target.get(self, *VALUE)
+
+    def update(self, coll):
+        """Make the aggregate reflect the current contents of `coll`."""
+        if coll is self.coll and isinstance(coll, TrackedCollection):
+            self._apply_deltas()
+            return
+        self._listen(coll)
+        occurences = collections.Counter(map(id, coll))
+        elems = dict(zip(map(id, coll), coll))
+        for key in [ key for key in self.elems if key not in occurences ]:
+            self._set_count(key, None, 0)
+        for key, n in occurences.items():
+            self._set_count(key, elems[key], n)
+        self._update_result()
+
+    def value(self):
+        if self.result is NOTHING:
+            # Only `min` and `max` have no value for an empty collection
+            raise ValueError('%s() arg is an empty sequence' % self.kind)
+        return self.result
+
+    def _listen(self, coll):
+        old, self.coll = self.coll, coll
+        if isinstance(old, TrackedCollection):
+            old._rbk_unlisten(self._on_delta)
+            self.ctx.remove_watchset((id(self), 'items'))
+        self.pending = []
+        if isinstance(coll, TrackedCollection):
+            coll._rbk_listen(self._on_delta)
+            self._watch((id(self), 'items'), [Target.get(coll, 'iter', None)], self._apply_deltas)
+
+    def _on_delta(self, added, removed):
+        # Applied when the change of ``('iter', None)`` is processed (see ``runtime.For``)
+        self.pending.append((added, removed))
+
+    def _apply_deltas(self, *a):
+        pending, self.pending = self.pending, []
+        for added, removed in pending:
+            for elem in added:
+                cur = self.elems.get(id(elem))
+                self._set_count(id(elem), elem, cur[1] + 1 if cur else 1)
+            for elem in removed:
+                self._set_count(id(elem), elem, self.elems[id(elem)][1] - 1)
+        if pending:
+            self._update_result()
+
+    def _set_count(self, key, elem, n):
+        cur = self.elems.get(key)
+        if cur is None:
+            if not n: return
+            cur = self.elems[key] = [elem, 0, NOTHING]
+            self._eval_elem(key)
+        old = cur[1]
+        if old == n: return
+        cur[1] = n
+        if cur[2] is not NOTHING:
+            for idx in range(n, old):
+                self.agg.remove((key, idx))
+            for idx in range(old, n):
+                self.agg.set((key, idx), cur[2])
+        if not n:
+            del self.elems[key]
+            self.ctx.remove_watchset((id(self), key))
+
+    def _eval_elem(self, key):
+        """(Re-)evaluate the contribution of an element, return True if it changed."""
+        ctx = self.ctx
+        cur = self.elems[key]
+        elem = ctx._wrap(cur[0])
+        with ctx.track_reads() as reads:
+            if self.cond is None or self.cond(elem):
+                val = ctx._unwrap(self.project(elem))
+            else:
+                val = NOTHING
+        self._watch((id(self), key), reads, partial(self._elem_changed, key))
+        old, cur[2] = cur[2], val
+        if old is val: return False
+        for idx in range(cur[1]):
+            if val is NOTHING:
+                self.agg.remove((key, idx))
+            else:
+                self.agg.set((key, idx), val)
+        return True
+
+    def _elem_changed(self, key, *a):
+        if key not in self.elems: return
+        self.ctx.stats['aggregate_updates'] += 1
+        if self._eval_elem(key):
+            self._update_result()
+
+    def _watch(self, ident, targets, func):
+        ctx = self.ctx
+        ctx.add_watchset(targets, func, ident)
+        # The expression reading the result should run after the watchers
+        # of the elements (see ``Context._schedule``).
+        height = ctx._heights[ident]
+        if height > ctx._target_heights.get(self.target, 0):
+            ctx._target_heights[self.target] = height
+
+    def _update_result(self):
+        agg = self.agg
+        if self.kind in ('min', 'max'):
+            new = agg.top()
+        elif self.kind == 'any':
+            new = agg.true > 0
+        elif self.kind == 'all':
+            new = agg.true == len(agg)
+        else:
+            new = agg.apply(0)
+        if self.ctx._same_value(self.result, new): return
+        self.result = new
+        self._changed(VALUE)
+
+    def _rbk_unsubscribe(self, sub, tracker):
+        super()._rbk_unsubscribe(sub, tracker)
+        if not self._rbk_subs:
+            self.ctx._idle_aggregates[self] = True
+
+    def dispose(self):
+        """Stop updating the aggregate (when nobody uses it any more)."""
+        self._listen(None)
+        for key in self.elems:
+            self.ctx.remove_watchset((id(self), key))
+        self.elems = {}
+        self.ctx._target_heights.pop(self.target, None)
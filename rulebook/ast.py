@@ -90,6 +90,7 @@ class If(Node):
 
 class For(Node):
     FIELDS_REQ = ['target', 'iter', 'body']
+    FIELDS_OPT = ['item_key']
 
 class Assign(Node):
     FIELDS_REQ = ['lhs', 'rhs']
@@ -4,30 +4,260 @@ from .util import *
 import ast as pyast
 import builtins
 import copy
-
-def _nsify(node, base='N', isdict=False):
-    if isinstance(base, str): base = pyast_tools.dotted(base)
-    class _NsifyTransformer(pyast.NodeTransformer):
-        def generic_visit(self, node):
-            if node is None: return
-            if isinstance(node, (list, tuple)):
-                return type(node)(self.visit(i) for i in node)
+import hashlib
+import collections
+
+class _NsifyTransformer(pyast.NodeTransformer):
+    def __init__(self, base, isdict, static):
+        super().__init__()
+        self.base = base
+        self.isdict = isdict
+        self.static = static
+    def generic_visit(self, node):
+        if node is None: return
+        if isinstance(node, (list, tuple)):
+            return type(node)(self.visit(i) for i in node)
+        else:
+            return super().generic_visit(node)
+    def visit(self, node):
+        if isinstance(node, (pyast.ListComp, pyast.SetComp, pyast.GeneratorExp, pyast.DictComp)):
+            return self._visit_comprehension(node)
+        elif isinstance(node, pyast.Lambda):
+            node.args = self.visit(node.args)
+            args = node.args
+            names = [ arg.arg for arg in args.args + args.kwonlyargs + [args.vararg, args.kwarg]
+                      if arg is not None ]
+            node.body = self._local(names).visit(node.body)
+            return node
+        if (isinstance(node, pyast.Name) and not (node.id.startswith('_') and not node.id.startswith('__'))
+                and node.id not in self.static):
+            if isinstance(self.base, str):
+                newbase = pyast_tools.dotted(self.base)
             else:
-                return super().generic_visit(node)
-        def visit(self, node):
-            if isinstance(node, pyast.Name) and not (node.id.startswith('_') and not node.id.startswith('__')):
-                newbase = copy.deepcopy(base)
-                pyast.copy_location(newbase, node)
-                if isdict:
-                    newnode = pyast.Subscript(newbase, pyast.Index(pyast.Str(node.id)), node.ctx)
+                newbase = copy.deepcopy(self.base)
+            pyast.copy_location(newbase, node)
+            if self.isdict:
+                newnode = pyast.Subscript(newbase, pyast.Index(pyast.Str(node.id)), node.ctx)
+            else:
+                newnode = pyast.Attribute(newbase, node.id, node.ctx)
+            pyast.copy_location(newnode, node)
+            return newnode
+        else:
+            return self.generic_visit(node)
+
+    def _local(self, names):
+        """Return a transformer for a scope in which `names` are local variables."""
+        return type(self)(self.base, self.isdict, self.static | frozenset(names))
+
+    def _visit_comprehension(self, node):
+        # The variables of a comprehension are local to it. Only the iterable
+        # of the first ``for`` is evaluated in the enclosing scope.
+        visitor = self
+        for idx, comp in enumerate(node.generators):
+            comp.iter = visitor.visit(comp.iter) if idx else self.visit(comp.iter)
+            visitor = visitor._local(_bound_names(comp.target))
+            comp.ifs = visitor.visit(comp.ifs)
+        for field in ('elt', 'key', 'value'):
+            if hasattr(node, field):
+                setattr(node, field, visitor.visit(getattr(node, field)))
+        return node
+
+def _bound_names(target):
+    """Return the names bound by an assignment target."""
+    if isinstance(target, pyast.Name):
+        return [target.id]
+    elif isinstance(target, (pyast.Tuple, pyast.List)):
+        return [ name for elt in target.elts for name in _bound_names(elt) ]
+    elif isinstance(target, pyast.Starred):
+        return _bound_names(target.value)
+    return []
+
+def _nsify(node, base='N', isdict=False, static=frozenset()):
+    """Make names in `node` refer to the namespace `base` (``x`` -> ``N.x``).
+    Names in `static` are left alone (see ``_StaticNamesCollector``)."""
+    return _NsifyTransformer(base, isdict, static).visit(node)
+
+class _StaticNamesCollector(object):
+    """Find the names that can be bound statically in a rulebook.
+
+    Bare names in rulebook expressions normally become tracked namespace reads
+    (``len`` -> ``N.len``). That is pointless for builtins and imported modules,
+    which do not change, so they are compiled as plain Python names instead,
+    resolved through the module globals (where rulebook imports store the
+    imported names, see ``_IMPORT``) and builtins.
+
+    The rule: a name is static if it is a builtin or imported by the rulebook
+    and the rulebook never assigns it (as the target of an assignment directive
+    or a ``for`` loop, or as ``N.name`` in an ``enter``/``leave`` body).
+    Assigning such a name from the outside (e.g. ``ctx.ns.len = ...``) does
+    *not* shadow it for an already compiled rulebook, so the namespace warns
+    about it (see ``runtime.Context.declare_static``).
+
+    ``bindings`` describes what each static name is bound to (e.g.
+    ``'from m import f'``). It is a part of the keys of the directives using
+    the name, so that reloading a rulebook whose imports changed does not keep
+    directives evaluating the old imported objects.
+    """
+    BUILTINS = frozenset( name for name in dir(builtins) if not name.startswith('_') )
+    # Functions provided to rulebooks in addition to the Python builtins
+    RBK_BUILTINS = frozenset(['groupcount'])
+
+    def __init__(self):
+        self.imported = {} # name -> the import statements binding it
+        self.assigned = set()
+        self.used = set() # Names read by rulebook expressions
+
+    def collect(self, node):
+        if isinstance(node, (rbkast.Rulebook, rbkast.Block)):
+            for sub in (node.body if isinstance(node.body, list) else [node.body]):
+                self.collect(sub)
+        elif isinstance(node, rbkast.If):
+            self._add_used(node.cond)
+            self.collect(node.body)
+            if node.orelse is not None: self.collect(node.orelse)
+        elif isinstance(node, rbkast.For):
+            self._add_targets(node.target)
+            self._add_used(node.iter, node.item_key)
+            self.collect(node.body)
+        elif isinstance(node, rbkast.Assign):
+            self._add_targets(node.lhs)
+            self._add_used(node.lhs, node.rhs, node.prio)
+        elif isinstance(node, rbkast.EnterLeave):
+            # Imperative code is not nsified, it assigns the namespace as ``N.name``
+            for stmt in node.body:
+                for sub in pyast.walk(stmt):
+                    if (isinstance(sub, pyast.Attribute) and isinstance(sub.ctx, pyast.Store)
+                            and isinstance(sub.value, pyast.Name) and sub.value.id == 'N'):
+                        self.assigned.add(sub.attr)
+        elif isinstance(node, rbkast.Import):
+            pynode = node.pynode
+            for alias in pynode.names:
+                if isinstance(pynode, pyast.ImportFrom):
+                    how = 'from %s%s import %s' % ('.' * pynode.level, pynode.module or '', alias.name)
                 else:
-                    newnode = pyast.Attribute(newbase, node.id, node.ctx)
-                pyast.copy_location(newnode, node)
-                return newnode
+                    how = 'import %s' % alias.name
+                self.imported.setdefault(alias.asname or alias.name.split('.')[0], set()).add(how)
+        return self
+
+    def _add_targets(self, target):
+        self.assigned.update(_bound_names(target))
+
+    def _add_used(self, *nodes):
+        for node in nodes:
+            if node is not None:
+                self.used.update( sub.id for sub in pyast.walk(node) if isinstance(sub, pyast.Name) )
+
+    @property
+    def static(self):
+        return frozenset((self.BUILTINS | self.RBK_BUILTINS | set(self.imported)) - self.assigned)
+
+    @property
+    def shadowable(self):
+        """Return the static names used by the rulebook that the namespace could shadow
+        if they were not static, i.e. the used builtins (imported names are bound
+        in the namespace by the rulebook itself)."""
+        return frozenset( name for name in self.static & self.used if name not in self.imported )
+
+    @property
+    def bindings(self):
+        """Return a dict mapping every static name to a string describing its binding."""
+        return { name: ('; '.join(sorted(self.imported[name])) if name in self.imported
+                        else 'builtin')
+                 for name in self.static }
+
+class _ReadPathTransformer(pyast.NodeTransformer):
+    """Replace static chains of attribute and item reads starting at the namespace,
+    e.g. ``N.a.b[0]``, with a single ``C.read_path`` call (see ``runtime.Context.read_path``)."""
+
+    CONSTANT_KEYS = (pyast.Num, pyast.Str, pyast.NameConstant)
+    MIN_LENGTH = 2 # Single reads are not worth it.
+
+    def _path(self, node):
+        """Return the root and the ``((subtype, subname), ...)`` path of
+        a static chain, or None if `node` is not one."""
+        path = []
+        while True:
+            if isinstance(node, pyast.Attribute) and isinstance(node.ctx, pyast.Load):
+                path.append(('attr', node.attr))
+            elif (isinstance(node, pyast.Subscript) and isinstance(node.ctx, pyast.Load)
+                    and isinstance(node.slice, pyast.Index)
+                    and isinstance(node.slice.value, self.CONSTANT_KEYS)):
+                path.append(('item', pyast.literal_eval(node.slice.value)))
+            elif isinstance(node, pyast.Name) and node.id == 'N' and path:
+                path.reverse()
+                return node, tuple(path)
             else:
-                return self.generic_visit(node)
-    return _NsifyTransformer().visit(node)
+                return None
+            node = node.value
+
+    def _visit_chain(self, node):
+        found = self._path(node)
+        if found is None or len(found[1]) < self.MIN_LENGTH:
+            return self.generic_visit(node)
+        root, path = found
+        return pyast.copy_location(pyast_tools.build_call('C.read_path', root, path), node)
+
+    visit_Attribute = visit_Subscript = _visit_chain
+
+
+class _AggregateTransformer(pyast.NodeTransformer):
+    """Replace aggregates of generators, e.g. ``sum(N.x.n for x in N.xs if x.up)``,
+    with ``C.aggregate`` calls maintaining them incrementally (see
+    ``runtime.Context.aggregate``). Only generators with a single ``for``
+    binding a plain name, which are not nested in another comprehension
+    or lambda (whose variables they could use), are replaced."""
+
+    FUNCTIONS = frozenset(['sum', 'min', 'max', 'any', 'all', 'groupcount'])
+
+    def __init__(self, static, gen_name):
+        super().__init__()
+        self.static = static
+        # Generates the unique name of each call site, which identifies the aggregate
+        self.gen_name = gen_name
+        self.count = 0
+
+    def _visit_scope(self, node):
+        # Leave the nested scopes alone
+        return node
 
+    visit_Lambda = visit_GeneratorExp = visit_ListComp = visit_SetComp = visit_DictComp = _visit_scope
+
+    def visit_Call(self, node):
+        func, args = node.func, node.args
+        if not (isinstance(func, pyast.Name) and func.id in self.FUNCTIONS
+                and func.id in self.static and len(args) == 1 and not node.keywords
+                and isinstance(args[0], pyast.GeneratorExp)
+                and len(args[0].generators) == 1
+                and isinstance(args[0].generators[0].target, pyast.Name)):
+            return self.generic_visit(node)
+        gen = args[0]
+        comp = gen.generators[0]
+        sig = pyast.arguments([pyast.arg(comp.target.id, None)], None, [], [], None, [])
+        project = pyast.Lambda(sig, gen.elt)
+        if not comp.ifs:
+            cond = pyast.NameConstant(None)
+        elif len(comp.ifs) == 1:
+            cond = pyast.Lambda(sig, comp.ifs[0])
+        else:
+            cond = pyast.Lambda(sig, pyast.BoolOp(pyast.And(), comp.ifs))
+        self.count += 1
+        call = pyast_tools.build_call('C.aggregate', func.id, pyast.Name('N', pyast.Load()),
+                                      self.visit(comp.iter), project, cond, self.gen_name('agg'))
+        return pyast.copy_location(call, node)
+
+_IMPORT_AS = pyast_tools.Template('''
+    import importlib
+    N.ASNAME = globals()['ASNAME'] = importlib.import_module('NAME')
+''', 'ASNAME NAME')
+
+_IMPORT = pyast_tools.Template('''
+    N.TOP = globals()['TOP'] = __import__('NAME')
+''', 'TOP NAME')
+
+_IMPORT_FROM = pyast_tools.Template('''
+    import importlib
+    N.ASNAME = globals()['ASNAME'] = __import__('MOD', None, None, ('NAME',)).NAME
+''', 'MOD ASNAME NAME')
 
 class _ImportTransformer(pyast_tools.EnhancedTransformer):
     def visit(self, node):
@@ -36,27 +266,14 @@ class _ImportTransformer(pyast_tools.EnhancedTransformer):
             if isinstance(node, pyast.Import):
                 for alias in node.names:
                     if alias.asname:
-                        @pyast_tools.interpolate(ASNAME=alias.asname, NAME=alias.name, N_ASNAME=pyast.Name(alias.asname, pyast.Store()))
-                        @pyast_tools.get_ast
-                        def pycode():
-                            import importlib
-                            N.ASNAME = globals()['ASNAME'] = importlib.import_module('NAME')
+                        r += _IMPORT_AS(ASNAME=alias.asname, NAME=alias.name)
                     else:
                         top = alias.name.split('.')[0]
-                        @pyast_tools.interpolate(NAME=alias.name, TOP=top, N_TOP=pyast.Name(top, pyast.Store()))
-                        @pyast_tools.get_ast
-                        def pycode():
-                            N.TOP = globals()['TOP'] = __import__('NAME')
-                    r += pycode
+                        r += _IMPORT(TOP=top, NAME=alias.name)
             elif isinstance(node, pyast.ImportFrom):
                 for alias in node.names:
                     asname = alias.asname or alias.name
-                    @pyast_tools.interpolate(MOD=node.module, ASNAME=asname, NAME=alias.name, N_ASNAME=pyast.Name(asname, pyast.Store()))
-                    @pyast_tools.get_ast
-                    def pycode():
-                        import importlib
-                        N.ASNAME = globals()['ASNAME'] = __import__('MOD', None, None, ('NAME',)).NAME
-                    r += pycode
+                    r += _IMPORT_FROM(MOD=node.module, ASNAME=asname, NAME=alias.name)
             return r
             #if len(r) == 1:
             #    return r[0]
@@ -66,26 +283,128 @@ class _ImportTransformer(pyast_tools.EnhancedTransformer):
         else:
             return self.generic_visit(node)
 
+# Rulebook ``import`` directives are hoisted: the import itself runs once when
+# the compiled rulebook is loaded, the directive only binds the imported name
+# in the namespace. Imports in the branches of an ``if`` are not hoisted, so
+# that an import in a branch never taken cannot fail.
+_HOISTED_IMPORT_AS = pyast_tools.Template('''
+    import importlib
+    ASNAME = importlib.import_module('NAME')
+''', 'ASNAME NAME')
+
+_HOISTED_IMPORT = pyast_tools.Template('''
+    TOP = __import__('NAME')
+''', 'TOP NAME')
+
+_HOISTED_IMPORT_FROM = pyast_tools.Template('''
+    ASNAME = __import__('MOD', None, None, ('NAME',)).NAME
+''', 'MOD ASNAME NAME')
+
+_BIND_IMPORTED = pyast_tools.Template('''
+    N.ASNAME = globals()['ASNAME']
+''', 'ASNAME')
+
+def _hoist_import(node):
+    """Return the module-level code performing the import `node` and
+    the code binding the imported names in the namespace."""
+    hoisted, bind = [], []
+    for alias in node.names:
+        if isinstance(node, pyast.ImportFrom):
+            asname = alias.asname or alias.name
+            hoisted += _HOISTED_IMPORT_FROM(MOD=node.module, ASNAME=asname, NAME=alias.name)
+        elif alias.asname:
+            asname = alias.asname
+            hoisted += _HOISTED_IMPORT_AS(ASNAME=asname, NAME=alias.name)
+        else:
+            asname = alias.name.split('.')[0]
+            hoisted += _HOISTED_IMPORT(TOP=asname, NAME=alias.name)
+        bind += _BIND_IMPORTED(ASNAME=asname)
+    return hoisted, bind
+
+def _is_constant(node):
+    """Is `node` a literal of an immutable type (e.g. ``42``, ``-1``, ``'x'``,
+    ``(1, None)``), which can be evaluated once, without tracking?"""
+    for sub in pyast.walk(node):
+        if not isinstance(sub, (pyast.Num, pyast.Str, pyast.Bytes, pyast.NameConstant, pyast.Tuple,
+                                pyast.UnaryOp, pyast.unaryop, pyast.expr_context)):
+            return False
+    try:
+        pyast.literal_eval(node)
+    except ValueError:
+        return False
+    return True
+
+_FUNCTION_WRAPPER = pyast_tools.Template('''
+    def _inner(N):
+        NODE
+    N.ORIGNAME = TMPNAME
+''', 'NODE ORIGNAME TMPNAME')
+
 class _FunctionTransformer(object):
     def visit(self, node):
         if isinstance(node, pyast.FunctionDef):
             tmpname = self.gen_name('pyfunc')
             origname = node.name
             node.name = tmpname
-            @pyast_tools.interpolate(MOD=node.module, ASNAME=alias.asname or alias.name, NAME=alias.name)
-            @pyast_tools.single
-            @pyast_tools.get_ast
-            def pycode():
-                def _inner(N):
-                    NODE
-                N.ORIGNAME = TMPNAME
+            pycode = _FUNCTION_WRAPPER(NODE=node, ORIGNAME=origname, TMPNAME=tmpname)
         else:
             return self.generic_visit(node)
 
+# The bind function and the body factory of a ``for`` loop (see ``runtime.For``).
+# The body factory takes the overlay namespace as `N`, because in Python you
+# cannot both load the value of a variable from an outer scope and assign
+# to it in the inner one. The binding of a variable (local or outer) stays
+# fixed for the whole duration of a function.
+_FOR_HELPER = pyast_tools.Template('''
+    def NAME(iterval):
+        _overlay = {}
+        TARGET = iterval # Saves target variable(s) into _overlay
+        return R.NamespaceOverlay(C, N, _overlay)
+    def BODY_NAME(N):
+        DEFS
+        return BODY
+''', 'NAME BODY_NAME TARGET DEFS BODY')
+
+_FOR_KEY = pyast_tools.Template('''
+    def NAME(N):
+        return KEY
+''', 'NAME KEY')
+
+_MODULE_BODY = pyast_tools.Template('''
+    from rulebook import runtime as R
+    from rulebook.aggregate import groupcount
+    import operator
+    HOISTED
+    def init(ctx):
+        C = ctx
+        N = ctx.nswrap
+        C.declare_static(STATIC)
+        DEFS
+        return ROOT
+''', 'HOISTED STATIC DEFS ROOT')
+
 class Compiler:
     CTX = pyast_tools.dotted('C')
     NS_SIG = pyast.arguments([pyast.arg('N', None)],None,[],[],None, [])
     last_id = 0
+    # Names compiled as plain Python names and their bindings, see ``_StaticNamesCollector``
+    static_names = frozenset()
+    static_bindings = {}
+
+    def __init__(self):
+        # The number of specializations done, by kind:
+        #   constant_obj, constant_rhs, constant_prio -- parts of assignments
+        #       evaluated without read tracking (``R.Constant``)
+        #   hoisted_imports -- imports moved to the module level (except for
+        #       those in the branches of an ``if``, which run on activation)
+        #   lazy -- subtrees built on their first activation (``R.Lazy``)
+        #   aggregates -- aggregate expressions maintained incrementally
+        #       (``Context.aggregate``)
+        self.stats = collections.Counter()
+        self.hoisted = []
+        # The nesting depth of ``if`` branches being compiled
+        self.conditional = 0
+
     def gen_name(self, prefix='x'):
         self.last_id += 1
         return prefix + str(self.last_id)
@@ -98,12 +417,44 @@ class Compiler:
                 return getattr(self, meth)(node)
         raise TypeError("Don't know how to compile %r of type %r" % (node, type(node)))
 
+    def _key(self, *parts):
+        """Return a fingerprint of the source of a directive, used to match directives
+        between the old and new version of a rulebook when reloading (see
+        ``runtime.Directive.reconcile``). Only the directive's own parts
+        should be passed, not nested directives, which are matched separately.
+
+        The bindings of the static names used by the parts are included, as the
+        compiled code depends on them."""
+        h = hashlib.sha1()
+        names = set()
+        for part in parts:
+            if isinstance(part, list):
+                names.update( sub.id for node in part for sub in pyast.walk(node)
+                              if isinstance(sub, pyast.Name) )
+                part = '[%s]' % ', '.join(map(pyast.dump, part))
+            elif isinstance(part, pyast.AST):
+                names.update( sub.id for sub in pyast.walk(part) if isinstance(sub, pyast.Name) )
+                part = pyast.dump(part)
+            else:
+                part = repr(part)
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        for name in sorted(names):
+            if name in self.static_bindings:
+                h.update(('%s=%s' % (name, self.static_bindings[name])).encode('utf-8'))
+                h.update(b'\0')
+        return h.hexdigest()[:16]
+
     def _wrap_lambda(self, expr):
         """Wrap the expression in a Lambda so that it is not evaluated
         immediately but at the appropriate time (e.g. what a directive
         is activated."""
 
-        r = pyast.Lambda(pyast_tools.EMPTY_SIG, expr)
+        aggregates = _AggregateTransformer(self.static_names, self.gen_name)
+        expr = aggregates.visit(expr)
+        if aggregates.count:
+            self.stats['aggregates'] += aggregates.count
+        r = pyast.Lambda(pyast_tools.EMPTY_SIG, _ReadPathTransformer().visit(expr))
         if debug_enabled:
             try:
                 import astunparse
@@ -114,14 +465,24 @@ class Compiler:
                 r = pyast_tools.build_call('R._LambdaWithSource', r, src)
         return r
 
+    def _wrap_expr(self, expr, kind=None):
+        """Wrap an (nsified) expression to be evaluated by a directive: in
+        an ``R.Constant`` if it is constant, otherwise using ``_wrap_lambda``.
+        Constants are counted in ``stats`` under `kind`."""
+        if kind is not None and (_is_constant(expr) or
+                                 isinstance(expr, pyast.Name) and expr.id == 'N'):
+            self.stats[kind] += 1
+            return pyast_tools.build_call('R.Constant', expr)
+        return self._wrap_lambda(expr)
+
     def _transform_pycode(self, node):
-        node = _nsify(node)
+        node = _nsify(node, static=self.static_names)
         node = _ImportTransformer().visit(node)
         return node
 
     def _xform_assign(self, node):
-        lhs = _nsify(node.lhs)
-        rhs = _nsify(node.rhs)
+        lhs = _nsify(node.lhs, static=self.static_names)
+        rhs = _nsify(node.rhs, static=self.static_names)
         if isinstance(lhs, pyast.Attribute):
             obj = lhs.value
             subtype = 'attr'
@@ -146,10 +507,12 @@ class Compiler:
 
         kw = {}
         if node.comb: kw['comb'] = node.comb
+        kw['key'] = self._key(node.lhs, node.rhs, node.prio, node.comb)
 
-        pynode = self._build_directive('Assign', self._wrap_lambda(obj),
-                                        subtype, subval, self._wrap_lambda(rhs),
-                                        prio=self._wrap_lambda(_nsify(node.prio)),
+        prio = _nsify(node.prio, static=self.static_names)
+        pynode = self._build_directive('Assign', self._wrap_expr(obj, 'constant_obj'),
+                                        subtype, subval, self._wrap_expr(rhs, 'constant_rhs'),
+                                        prio=self._wrap_expr(prio, 'constant_prio'),
                                         **kw)
         return pynode
 
@@ -158,13 +521,24 @@ class Compiler:
 
     def _xform_block(self, node):
         pynodes = [ self.transform_node(directive) for directive in node.body ]
-        return self._build_directive('Block', pyast.List(pynodes, pyast.Load()))
+        return self._build_directive('Block', pyast.List(pynodes, pyast.Load()), key=self._key())
 
     def _xform_if(self, node):
-        return self._build_directive('If', self._wrap_lambda(_nsify(node.cond)),
-                                        self.transform_node(node.body),
-                                        self.transform_node(node.orelse) if node.orelse is not None
-                                        else None)
+        self.conditional += 1
+        try:
+            body = self._lazy(node.body)
+            orelse = self._lazy(node.orelse) if node.orelse is not None else None
+        finally:
+            self.conditional -= 1
+        return self._build_directive('If', self._wrap_lambda(_nsify(node.cond, static=self.static_names)),
+                                        body, orelse, key=self._key(node.cond))
+
+    def _lazy(self, node):
+        """Compile `node` into an ``R.Lazy`` directive building it on its first
+        activation (the branches of an ``if`` are often never taken)."""
+        self.stats['lazy'] += 1
+        factory = pyast.Lambda(pyast_tools.EMPTY_SIG, self.transform_node(node))
+        return self._build_directive('Lazy', factory, key=self._key())
 
     def _xform_for(self, node):
         olddefs = self.defs
@@ -176,26 +550,17 @@ class Compiler:
             self.defs = olddefs
         target = _nsify(node.target, '_overlay', True)
         helper_name = self.gen_name('for')
-        @pyast_tools.interpolate(NAME=helper_name, TARGET=target, BODY=py_body, DEFS=localdefs)
-        @pyast_tools.single
-        @pyast_tools.get_ast
-        def localns_helper():
-            def NAME(iterval):
-                _overlay = {}
-                TARGET = iterval # Saves target variable(s) into _overlay
-                # The trick with _inner is there because in Python you cannot
-                # both load the value of a variable from an outer scope and
-                # assign to it in the inner one. The binding of a variable
-                # (local or outer) stays fixed for the whole duration of
-                # a function.
-                newns = R.NamespaceOverlay(C, N, _overlay)
-                def _inner(N):
-                    DEFS
-                    return BODY
-                return _inner(newns)
-        self.defs.append(localns_helper)
-        return self._build_directive('For', self._wrap_lambda(_nsify(node.iter)),
-                                        pyast.Name(helper_name, pyast.Load()))
+        self.defs += _FOR_HELPER(NAME=helper_name, BODY_NAME=helper_name + '_body', TARGET=target,
+                                 BODY=py_body, DEFS=localdefs)
+        kw = {}
+        if node.item_key is not None:
+            item_key = _ReadPathTransformer().visit(_nsify(node.item_key, static=self.static_names))
+            self.defs += _FOR_KEY(NAME=helper_name + '_key', KEY=item_key)
+            kw['item_key'] = pyast.Name(helper_name + '_key', pyast.Load())
+        return self._build_directive('For', self._wrap_lambda(_nsify(node.iter, static=self.static_names)),
+                                        pyast.Name(helper_name, pyast.Load()),
+                                        pyast.Name(helper_name + '_body', pyast.Load()),
+                                        key=self._key(node.target, node.iter, node.item_key), **kw)
 
     def _wrap_imperative(self, body, nprefix='x'):
         """Wrap a block of imperative Python code, return an AST node representing
@@ -214,29 +579,35 @@ class Compiler:
         #       methods, e.g. ``add_value``.
         #body = self._transform_pycode(node.body)
         #body = _ImportTransformer().visit(node.body)
-        return self._build_directive('EnterLeave', node.event, self._wrap_imperative(node.body))
+        return self._build_directive('EnterLeave', node.event, self._wrap_imperative(node.body),
+                                     key=self._key(node.event, node.body))
 
     def _xform_onchange(self, node):
         return self._build_directive('OnChange', self._wrap_lambda(node.expr),
-                                     self._wrap_imperative(node.body))
+                                     self._wrap_imperative(node.body),
+                                     key=self._key(node.expr, node.body))
 
     def _xform_import(self, node):
-        pycode = _ImportTransformer().visit(node.pynode)
-        return self.transform_node(rbkast.EnterLeave('enter', pycode))
+        if self.conditional:
+            # The branch may never be taken (e.g. an optional dependency), import
+            # on activation. Later activations find the module in ``sys.modules``.
+            bind = _ImportTransformer().visit(node.pynode)
+        else:
+            hoisted, bind = _hoist_import(node.pynode)
+            self.hoisted += hoisted
+            self.stats['hoisted_imports'] += 1
+        # The binding code is the same for all imports of a name, key by the import
+        return self._build_directive('EnterLeave', 'enter', self._wrap_imperative(bind),
+                                     key=self._key(node.pynode))
 
     def _xform_rulebook(self, node):
         self.defs = []
+        collector = _StaticNamesCollector().collect(node)
+        self.static_names = collector.static
+        self.static_bindings = collector.bindings
         body_pynode = self.transform_node(node.body)
-        @pyast_tools.interpolate(ROOT=body_pynode, DEFS=self.defs)
-        @pyast_tools.get_ast
-        def module_body():
-            from rulebook import runtime as R
-            import operator
-            def init(ctx):
-                C = ctx
-                N = ctx.nswrap
-                DEFS
-                return ROOT
+        static = pyast_tools.literal_to_ast(tuple(sorted(collector.shadowable)))
+        module_body = _MODULE_BODY(HOISTED=self.hoisted, STATIC=static, ROOT=body_pynode, DEFS=self.defs)
 
         #return pyast.Module([pyast.Assign([pyast.Name('root', pyast.Store())], body_pynode)])
         return pyast.Module(module_body)
@@ -250,6 +621,7 @@ def compile(source_or_ast, filename=None):
         source_or_ast = parser.parse(source_or_ast, filename)
     compiler = Compiler()
     node = compiler.transform_node(source_or_ast)
+    debug('compile: specializations', dict(compiler.stats))
     node = pyast.fix_missing_locations(node)
     code = builtins.compile(node, filename, 'exec')
     return code
@@ -264,6 +636,8 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--tree', help='Print AST tree instad of Python source'
                                              ' (-tt for non-pretty-printed `ast.dump` for the brave)',
                         action='count')
+    parser.add_argument('-s', '--stats', help='Print the number of specializations done to stderr',
+                        action='store_true')
     parser.add_argument('filename', default=None)
 
     args = parser.parse_args()
@@ -279,6 +653,9 @@ if __name__ == '__main__':
 
     comp = Compiler()
     pynode = comp.transform_node(node)
+    if args.stats:
+        for kind, count in sorted(comp.stats.items()):
+            print('%s: %d' % (kind, count), file=sys.stderr)
 
     try:
         import astunparse
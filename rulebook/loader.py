@@ -1,10 +1,13 @@
-import sys, os
+import sys, os, marshal, struct, tempfile, logging
 import importlib.util, importlib.machinery
 from pathlib import Path
 
 from . import compiler, runtime
 
-RBK_TAG = 'rbk0'
+log = logging.getLogger(__name__)
+
+# Bump whenever the generated code changes, so that stale caches are ignored.
+RBK_TAG = 'rbk13'
 
 def cache_from_source(path, debug_override=None):
     """Given the path to a .rbk file, return the path to its .pyc/.pyo file.
@@ -31,15 +34,78 @@ def cache_from_source(path, debug_override=None):
     filename = ''.join([base_filename, sep, tag, suffixes[0]])
     return os.path.join(head, '__pycache__', filename)
 
-def load(filename, ctx=None):
-    filename = str(filename)
-    cache_fn = cache_from_source(filename)
-    # TODO load compiled
+def _cache_header(st):
+    """Return the header identifying a cache file valid for source with stat `st`.
+
+    Like a ``.pyc`` header, it contains the Python magic number and the source
+    mtime and size, with the Rulebook tag added so that caches written by
+    a different Rulebook version are never used even under the same name.
+    """
+    return (importlib.util.MAGIC_NUMBER + RBK_TAG.encode('ascii') + b'\0'
+            + struct.pack('<II', int(st.st_mtime) & 0xFFFFFFFF, st.st_size & 0xFFFFFFFF))
 
+def _read_cache(cache_fn, header):
+    """Return the code object cached in `cache_fn`, or None if it is missing or stale."""
+    try:
+        with open(cache_fn, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (EOFError, ValueError, TypeError):
+        log.warning('Ignoring corrupted rulebook cache %s', cache_fn)
+        return None
+
+def _write_cache(cache_fn, header, code, mode=0o666):
+    """Atomically write `code` to `cache_fn`, with the permissions given by
+    `mode` (the source mode, like ``py_compile``). Failures are logged and ignored."""
+    tmp_fn = None
+    try:
+        dirname = os.path.dirname(cache_fn)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(dir=dirname, prefix='.rbk-', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(header)
+            marshal.dump(code, file)
+        # mkstemp creates the file readable by the owner only
+        os.chmod(tmp_fn, mode & 0o666)
+        os.replace(tmp_fn, cache_fn)
+    except OSError as exc:
+        log.debug('Cannot write rulebook cache %s: %s', cache_fn, exc)
+        if tmp_fn is not None:
+            try: os.unlink(tmp_fn)
+            except OSError: pass
+
+def load_code(filename, use_cache=True):
+    """Return the code object for the rulebook in `filename`.
+
+    The code is loaded from the ``__pycache__`` directory next to the file
+    when it is up to date, otherwise the rulebook is compiled and the cache
+    (re)written.
+    """
+    filename = str(filename)
+    with open(filename, 'rb') as file:
+        st = os.fstat(file.fileno())
+        source = file.read()
+    if use_cache:
+        cache_fn = cache_from_source(filename)
+        header = _cache_header(st)
+        code = _read_cache(cache_fn, header)
+        if code is not None:
+            return code
+    code = compiler.compile(source, filename)
+    if use_cache and not sys.dont_write_bytecode:
+        _write_cache(cache_fn, header, code, st.st_mode)
+    return code
+
+def load(filename, ctx=None, use_cache=True):
     if ctx is None:
         ctx = runtime.Context()
 
-    code = compiler.compile(None, filename)
+    code = load_code(filename, use_cache)
 
     vars = {}
     exec(code, vars, vars)
@@ -59,6 +125,30 @@ def load_string(s, filename='<string>', ctx=None):
 
     return root, ctx
 
+def _reconcile(root, new_root):
+    ctx = root.ctx
+    in_trans = ctx.in_transaction
+    if not in_trans: ctx.begin()
+    root.reconcile(new_root)
+    if not ctx._processing: ctx.process_events()
+    if not in_trans: ctx.commit()
+    return root
+
+def reload(root, filename, use_cache=True):
+    """Reload a rulebook loaded with ``load`` into the same context, e.g. after
+    it was edited. Return the new root (currently always `root` itself).
+
+    Directives whose source did not change stay active as they are, keeping
+    their values and watchsets. Only changed directives are deactivated and
+    replaced with the new versions, all within a single transaction."""
+    code = load_code(filename, use_cache)
+    vars = {}
+    exec(code, vars, vars)
+    return _reconcile(root, vars['init'](root.ctx))
 
-
-
+def reload_string(root, s, filename='<string>'):
+    """Like ``reload``, with the new rulebook source given as a string."""
+    code = compiler.compile(s, filename)
+    vars = {}
+    exec(code, vars, vars)
+    return _reconcile(root, vars['init'](root.ctx))
@@ -1,6 +1,6 @@
 """Parser module"""
 
-import sys, os, io
+import sys, os, io, keyword
 from functools import partial
 
 from tokenize import tokenize,untokenize,TokenInfo
@@ -43,16 +43,60 @@ class Parser:
     # in ``parse_pycode`` for details.
     IGNORE = [t.ENCODING, t.NL, t.COMMENT]
     PY_BALANCE = {'(': ')', '[': ']', '{': '}', t.INDENT: t.DEDENT}
-    ASSIGN_OPS = ['=', '+=', '-=', '*=', '/=', '//=', '%=', '|=', '&=', '^=', '**=', '<<=', '>>=']
+    # Aggregating assignments spelled as a name followed by '=' (``x max= y``)
+    NAMED_ASSIGN_OPS = ['max=', 'min=', 'count=']
+    ASSIGN_OPS = ['=', '+=', '-=', '*=', '/=', '//=', '%=', '|=', '&=', '^=', '**=', '<<=', '>>='
+                  ] + NAMED_ASSIGN_OPS
 
     KW_PRIO = (t.NAME, 'prio')
     KW_IF = (t.NAME, 'if')
     KW_ELSE = (t.NAME, 'else')
     KW_FOR = (t.NAME, 'for')
+    KW_IN = (t.NAME, 'in')
+    KW_KEY = (t.NAME, 'key')
     ONCHANGE_KEYWORDS = [(t.NAME, 'onchange'), (t.NAME, 'c_onchange')]
     ENTERLEAVE_KEYWORDS = [ (t.NAME, kw) for kw in ('enter', 'leave', 'c_enter', 'c_leave') ]
     IMPORT_KEYWORDS = [ (t.NAME, 'import'), (t.NAME, 'from') ]
     KW_SET = (t.NAME, 'set')
+    KW_ELIF = (t.NAME, 'elif')
+    AUG_COMB = {
+                '+=': 'operator.add',
+                '-=': 'operator.sub',
+                '*=': 'operator.mul',
+                '/=': 'operator.truediv',
+                '//=': 'operator.floordiv',
+                '%=': 'operator.mod',
+                '&=': 'operator.and_',
+                '|=': 'operator.or_',
+                '^=': 'operator.xor',
+                '**=': 'operator.pow',
+                '<<=': 'operator.lshift',
+                '>>=': 'operator.rshift',
+                'max=': 'max',
+                'min=': 'min',
+                'count=': 'R.aggregate.count',
+                '=': None
+            }
+    # The same for the ``op`` of a ``pyast.AugAssign``
+    AUG_OP_COMB = {
+                pyast.Add: 'operator.add',
+                pyast.Sub: 'operator.sub',
+                pyast.Mult: 'operator.mul',
+                pyast.Div: 'operator.truediv',
+                pyast.FloorDiv: 'operator.floordiv',
+                pyast.Mod: 'operator.mod',
+                pyast.BitAnd: 'operator.and_',
+                pyast.BitOr: 'operator.or_',
+                pyast.BitXor: 'operator.xor',
+                pyast.Pow: 'operator.pow',
+                pyast.LShift: 'operator.lshift',
+                pyast.RShift: 'operator.rshift',
+            }
+    # Keywords starting compound statements, which cannot form a simple body
+    # in the single-pass translation (``if x: for y in z: ...`` is not Python).
+    PY_COMPOUND_KEYWORDS = [ (t.NAME, kw) for kw in ('if', 'for', 'while', 'with', 'try',
+                                                     'def', 'class', 'async') ] + [(t.OP, '@')]
+    RBK_COMPOUND_KEYWORDS = [KW_IF, KW_FOR, KW_SET] + ENTERLEAVE_KEYWORDS + ONCHANGE_KEYWORDS
 
     in_simple_body = False
 
@@ -64,17 +108,24 @@ class Parser:
         self.filename = filename
         self.pos = 0
         self.defaults = { 'prio': pyast.Num(0) }
+        self._out = None # The output of the single-pass translation, if running
 
     ### HELPER FUNCTIONS TO EASE TOKEN HANDLING ###
 
     def skip_ignored(self):
         while self.tokens[self.pos].type in self.IGNORE:
+            if self._out is not None:
+                self._emit(self.tokens[self.pos])
             self.pos += 1
         if self.tokens[self.pos].type == t.ERRORTOKEN:
             self.syntax_error("Invalid token: " + str(self.tokens[self.pos]))
     def match(self, spec):
         self.skip_ignored()
         if isinstance(spec, str):
+            if spec in self.NAMED_ASSIGN_OPS:
+                return (self.match((t.NAME, spec[:-1]))
+                        and self.tokens[self.pos + 1].string == '='
+                        and self._after_operand())
             return self.match((t.OP, spec))
         elif isinstance(spec, int):
             return self.match((spec, None))
@@ -86,6 +137,19 @@ class Parser:
             return False
         else:
             raise TypeError
+    def _after_operand(self):
+        """Return True if the token before the current one ends an operand,
+        e.g. the lvalue in ``a.x max= 1``. Named assignment operators are only
+        recognized there, so that ``count = 1`` or ``a.max = 1`` are plain
+        assignments to a name or attribute called `count` or `max`."""
+        pos = self.pos - 1
+        while pos >= 0 and self.tokens[pos].type in (t.NL, t.COMMENT):
+            pos -= 1
+        if pos < 0: return False
+        prev = self.tokens[pos]
+        if prev.type == t.NAME:
+            return not keyword.iskeyword(prev.string)
+        return prev.type == t.OP and prev.string in (')', ']')
     def syntax_error(self, msg):
         """Raise a SyntaxError at the current position in the source.
         The main purpose of this function is to fill in the correct line number and other info."""
@@ -115,8 +179,9 @@ class Parser:
 
     ### INDIVIDUAL RECURSIVE DESCENT PARSING FUNCTIONS ###
 
-    def eat_pycode(self, endtoks):
-        """Eat a Python expression, statement or block (depending on `endtoks`)"""
+    def eat_pycode(self, endtoks, stop=None):
+        """Eat a Python expression, statement or block (depending on `endtoks`).
+        If `stop` is given, also stop at the token with that index."""
         orig_ignore = self.IGNORE
         self.IGNORE = []
         try:
@@ -152,7 +217,7 @@ class Parser:
                 #     3,0-3,0:            ENDMARKER      ''
                 # Therefore it's safe to say that an expression never contains the
                 # aforementioned tokens.
-                if self.match(endtoks) and not parens:
+                if self.pos == stop or self.match(endtoks) and not parens:
                     # The end token (e.g. a ':') is not a part of the expr, don't eat it)
                     break
                 for opening, closing in self.PY_BALANCE.items():
@@ -167,14 +232,27 @@ class Parser:
             self.IGNORE = orig_ignore
         return ret
 
-    def parse_pycode(self, endtoks, mode, *, prepend='', append=''):
+    def parse_pycode(self, endtoks, mode, *, prepend='', append='', stop=None):
         """Parse a Python expression starting at the current position in the token stream.
-        The expression ends with the first occurence of any token from ``endtoks``, which
-        does not become a part of the expression and is not eaten.
+        The expression ends with the first occurence of any token from ``endtoks`` (or
+        at the token with index `stop`), which does not become a part of the expression
+        and is not eaten.
 
         Return the AST of the expression."""
 
-        tokens = self.eat_pycode(endtoks)
+        tokens = self.eat_pycode(endtoks, stop)
+        if not tokens: self.syntax_error("Empty expression")
+        src = self._pycode_source(tokens, prepend, append)
+        node = pyast.parse(src, self.filename, mode).body
+
+        # TODO: Line number are wrong in `src`. Therefore we must:
+        #   * fix them up in the AST
+        #   * tranform them in SyntaxErrors that might be raised by `pyast.parse`
+
+        return node
+
+    def _pycode_source(self, tokens, prepend='', append=''):
+        """Convert a list of tokens back to source code (modifies the list)."""
         # Unfortunately, token streams cannot be parsed into ASTs from Python.
         # We must convert the tokens back to source code first.
         # See ``docs/desing/parser.md`` for more info.
@@ -201,8 +279,6 @@ class Parser:
         # which is clearly not a valid piece of Python code.
         # This can be resolved most easily by moving the very first token to column 0.
 
-        if not tokens: self.syntax_error("Empty expression")
-
         #debug('parse_pycode BEFORE: tokens =', tokens)
         #src = prepend + untokenize(tokens) + append
         #debug('parse_pycode BEFORE: untokenized to\n    |' + src.replace('\n', '\n    |'))
@@ -227,14 +303,46 @@ class Parser:
         debug('parse_pycode: tokens =', tokens)
         src = prepend + untokenize(tokens) + append
         debug('parse_pycode: untokenized to\n    |' + src.replace('\n', '\n    |'))
+        return src
 
-        node = pyast.parse(src, self.filename, mode).body
-
-        # TODO: Line number are wrong in `src`. Therefore we must:
-        #   * fix them up in the AST
-        #   * tranform them in SyntaxErrors that might be raised by `pyast.parse`
+    def _find_for_key(self):
+        """Return the index of the ``key`` keyword in the rest of a ``for`` header
+        (after ``in``), None if there is none.
 
-        return node
+        ``key`` is a keyword only if it splits the header into a valid iterable
+        and a valid key expression, so e.g. ``for x in a if key else b:``
+        iterates over ``a if key else b``. If the header is not a valid iterable
+        but cannot be split either, ``key`` cannot be used as a name there."""
+        self.skip_ignored()
+        start = pos = self.pos
+        depth = 0
+        candidates = []
+        while True:
+            tok = self.tokens[pos]
+            if tok.type in (t.NEWLINE, t.ENDMARKER) and not depth: break
+            if tok.type == t.OP:
+                if tok.string == ':' and not depth: break
+                if tok.string in '([{': depth += 1
+                elif tok.string in ')]}': depth -= 1
+            elif tok.type == t.NAME and tok.string == 'key' and not depth:
+                candidates.append(pos)
+            pos += 1
+        if not candidates or self._parses(start, pos):
+            return None
+        for key_pos in candidates:
+            if self._parses(start, key_pos) and self._parses(key_pos + 1, pos):
+                return key_pos
+        self.syntax_error("Invalid `for` iterable or key (`key` cannot be used as a name there)")
+
+    def _parses(self, start, end):
+        """Do the tokens between the indices `start` and `end` form a valid expression?"""
+        tokens = [ tok for tok in self.tokens[start:end] if tok.type not in (t.NL, t.COMMENT) ]
+        if not tokens: return False
+        try:
+            pyast.parse(self._pycode_source(tokens), self.filename, 'eval')
+        except SyntaxError:
+            return False
+        return True
 
     def parse_directive(self):
         debug('parse_directive', self.peek())
@@ -251,13 +359,23 @@ class Parser:
                 orelse = None
             return rbkast.If(expr, body, orelse)
         elif self.match(self.KW_FOR):
-            # (Ab)uses Python to parse the whole `for` header so that we don't
-            # have to bother with correctly splitting the individual parts,
-            # parsing the target expression in pyast.Store context, etc.
-            pynode = self.parse_pycode([':', t.NEWLINE, t.DEDENT, t.INDENT], 'exec', append=': pass')[0]
+            self.eat()
+            # (Ab)uses Python to parse the target so that we don't have to bother
+            # with parsing the target expression in pyast.Store context.
+            target = self.parse_pycode([self.KW_IN, ':', t.NEWLINE], 'exec',
+                                       prepend='for ', append=' in (): pass')[0].target
+            self.eat(self.KW_IN)
+            # ``key`` is only a keyword after the iterable (``for key in keys:`` is valid)
+            key_pos = self._find_for_key()
+            iter = self.parse_pycode([':', t.NEWLINE], 'eval', stop=key_pos)
+            if key_pos is not None:
+                self.eat(self.KW_KEY)
+                item_key = self.parse_pycode([':', t.NEWLINE], 'eval')
+            else:
+                item_key = None
             self.eat(':')
             body = self.parse_body()
-            return rbkast.For(pynode.target, pynode.iter, body)
+            return rbkast.For(target, iter, body, item_key)
         elif self.match(self.ENTERLEAVE_KEYWORDS):
             event = self.eat().string
             self.eat(':')
@@ -285,27 +403,18 @@ class Parser:
             if self.match(self.ASSIGN_OPS):
                 # TODO multi-target assignments (x = y = 42)
                 op = self.eat().string
-                COMB = {
-                            '+=': 'operator.add',
-                            '-=': 'operator.sub',
-                            '*=': 'operator.mul',
-                            '/=': 'operator.truediv',
-                            '//=': 'operator.floordiv',
-                            '%=': 'operator.mod',
-                            '&=': 'operator.and_',
-                            '|=': 'operator.or_',
-                            '^=': 'operator.xor',
-                            '**=': 'operator.pow',
-                            '<<=': 'operator.lshift',
-                            '>>=': 'operator.rshift',
-                            '=': None
-                        }
+                if op + '=' in self.NAMED_ASSIGN_OPS:
+                    op += self.eat('=').string
                 lhs = expr
                 if not hasattr(lhs, 'ctx'):
                     self.syntax_error("Invalid lvalue")
                 lhs.ctx = pyast.Store()
+                # Assignment operators are only valid after the lvalue, the RHS may
+                # contain e.g. ``x = lambda count=1: count``. (Chained assignments
+                # like ``x = y = 1`` are then rejected by the Python parser.)
+                stoppers = [t.NEWLINE, t.DEDENT, self.KW_PRIO]
                 rhs = self.parse_pycode(stoppers, 'eval')
-                comb = COMB[op]
+                comb = self.AUG_COMB[op]
                 if comb: comb = pyast_tools.dotted(comb)
                 node = rbkast.Assign(lhs, rhs, prio = self.defaults['prio'], comb=comb)
                 while not self.match([t.NEWLINE, t.DEDENT]):
@@ -362,8 +471,323 @@ class Parser:
         body = self.parse_block()
         return rbkast.Rulebook(body)
 
-def parse(*a):
-    return Parser(*a).parse_rulebook()
+    ### SINGLE-PASS TRANSLATION ###
+
+    # Instead of parsing every expression separately, ``translate_rulebook`` rewrites
+    # the whole token stream into Python source code, in which Rulebook constructs
+    # are replaced with marker constructs (names starting with ``__rbk_``):
+    #
+    #     a.x = 1 prio 2          ->  a.x = 1 ; __rbk_prio__ = 2
+    #     set prio 5              ->  __rbk_set__. prio = 5
+    #     enter: ...              ->  with __rbk_enter__: ...
+    #     onchange a.x: ...       ->  with __rbk_onchange__( a.x): ...
+    #     if a: b.x = 1           ->  if a: __rbk_simple__; b.x = 1
+    #     for a in b key a.k:     ->  for a in b , __rbk_key__, a.k:
+    #     a.x max= 1              ->  a.x @= __rbk_max__, 1
+    #
+    # The result is parsed with a single ``ast.parse`` call and the Rulebook AST
+    # is recovered from the Python one. All tokens keep their line numbers
+    # (only columns shift), so the Python AST nodes have correct locations.
+    # See ``doc/design/parser.md``.
+
+    SIMPLE_MARKER = '__rbk_simple__'
+    PRIO_MARKER = '__rbk_prio__'
+    SET_MARKER = '__rbk_set__'
+    ONCHANGE_MARKER = '__rbk_onchange__'
+    KEY_MARKER = '__rbk_key__'
+    # The markers of named assignment operators (``max=`` -> ``__rbk_max__``)
+    NAMED_OP_MARKERS = { '__rbk_%s__' % op[:-1]: op for op in NAMED_ASSIGN_OPS }
+
+    def _emit(self, tok, string=None):
+        """Append `tok` to the translated source, preserving its line and the
+        whitespace before it. `string` replaces the text of the token."""
+        if tok.type in (t.ENCODING, t.ENDMARKER): return
+        row, col = tok.start
+        if row != self._row or self._col is None:
+            # Line continuations do not produce any tokens, recreate them.
+            self._out.append('\\\n' * (row - self._row))
+            # Copy the original indentation, which may contain tabs
+            self._out.append(tok.line[:col])
+        else:
+            self._out.append(' ' * (col - self._col))
+        self._out.append(tok.string if string is None else string)
+        if tok.type in (t.NEWLINE, t.NL):
+            self._row, self._col = row + 1, None
+        else:
+            self._row, self._col = tok.end
+
+    def _copy(self, string=None, expected=None):
+        """Eat a token and emit it to the translated source."""
+        tok = self.eat(expected)
+        self._emit(tok, string)
+        return tok
+
+    def _copy_raw(self, stop):
+        """Copy all tokens, including the ignored ones, up to and including the token
+        of type `stop` that is not nested in a INDENT/DEDENT pair."""
+        depth = 0
+        while True:
+            tok = self.tokens[self.pos]
+            if tok.type == t.ENDMARKER:
+                self.syntax_error("Unexpected end of file")
+            self._emit(tok)
+            self.pos += 1
+            if tok.type == stop and not depth: break
+            elif tok.type == t.INDENT: depth += 1
+            elif tok.type == t.DEDENT: depth -= 1
+
+    def _copy_pycode(self, endtoks, prio=False):
+        """Copy a Python expression up to the first token from `endtoks` (token types,
+        operators or ``(t.NAME, keyword)`` specs) at the top nesting level. If `prio`
+        is true, rewrite `prio` clauses.
+
+        This is the innermost loop of the translation, hence the direct token
+        checks instead of ``match``."""
+        end_types = [ x for x in endtoks if isinstance(x, int) ]
+        end_ops = [ x for x in endtoks if isinstance(x, str) ]
+        end_names = [ x[1] for x in endtoks if isinstance(x, tuple) ]
+        prio_marker = '; %s =' % self.PRIO_MARKER
+        depth = 0
+        assigned = False # Whether we are past the assignment operator
+        while True:
+            self.skip_ignored()
+            tok = self.tokens[self.pos]
+            toktype = tok.type
+            string = None
+            if toktype == t.OP:
+                if not depth and tok.string in end_ops: break
+                if tok.string in '([{': depth += 1
+                elif tok.string in ')]}': depth -= 1
+                elif tok.string == ';' and not depth:
+                    self.syntax_error("Unexpected token")
+                elif not depth and tok.string in self.ASSIGN_OPS:
+                    assigned = True
+            elif not depth and toktype in end_types:
+                break
+            elif toktype == t.NAME:
+                if not depth and tok.string in end_names: break
+                if prio and not depth and tok.string == 'prio':
+                    string = prio_marker
+                elif prio and not depth and not assigned and self.match(tok.string + '='):
+                    # A named assignment operator
+                    self._emit(tok, '@= __rbk_%s__,' % tok.string)
+                    self.pos += 2
+                    assigned = True
+                    continue
+            elif toktype in (t.INDENT, t.DEDENT, t.ENDMARKER):
+                self.syntax_error("Unexpected token")
+            self._emit(tok, string)
+            self.pos += 1
+
+    def _translate_directive(self):
+        if self.match(self.KW_IF):
+            self._copy()
+            self._copy_pycode([':', t.NEWLINE])
+            self._copy(expected=':')
+            self._translate_body()
+            if self.match(self.KW_ELSE):
+                self._copy()
+                self._copy(expected=':')
+                self._translate_body()
+        elif self.match(self.KW_FOR):
+            self._copy()
+            self._copy_pycode([self.KW_IN, ':', t.NEWLINE])
+            self._copy(expected=self.KW_IN)
+            key_pos = self._find_for_key()
+            self._copy_pycode([':', t.NEWLINE, self.KW_KEY])
+            while self.match(self.KW_KEY) and self.pos != key_pos:
+                # ``key`` used as a name in the iterable
+                self._copy()
+                self._copy_pycode([':', t.NEWLINE, self.KW_KEY])
+            if key_pos is not None:
+                self._copy(', %s,' % self.KEY_MARKER, expected=self.KW_KEY)
+                self._copy_pycode([':', t.NEWLINE])
+            self._copy(expected=':')
+            self._translate_body()
+        elif self.match(self.ENTERLEAVE_KEYWORDS):
+            self._copy('with __rbk_%s__' % self.peek().string)
+            self._copy(expected=':')
+            self._translate_pybody()
+        elif self.match(self.ONCHANGE_KEYWORDS):
+            self._copy('with %s(' % self.ONCHANGE_MARKER)
+            self._copy_pycode([':', t.NEWLINE])
+            self._copy('):', expected=':')
+            self._translate_pybody()
+        elif self.match(self.KW_SET):
+            self._copy(self.SET_MARKER + '.')
+            self._copy(self.peek().string + ' =', expected=t.NAME)
+            self._copy_pycode([t.NEWLINE, t.DEDENT])
+            self._copy(expected=t.NEWLINE)
+        elif self.match(self.KW_ELIF):
+            self.syntax_error("Unexpected token")
+        elif self.match(t.INDENT):
+            self.syntax_error("Unexpected indent")
+        else:
+            # Assignments, custom directives and imports
+            self._copy_pycode([t.NEWLINE, t.DEDENT], prio=True)
+            self._copy(expected=t.NEWLINE)
+
+    def _translate_block(self):
+        while self.peek().type not in [t.DEDENT, t.ENDMARKER]:
+            self._translate_directive()
+
+    def _translate_body(self):
+        if self.match(t.NEWLINE):
+            self._copy()
+            self._copy(expected=t.INDENT)
+            self._translate_block()
+            self._copy(expected=t.DEDENT)
+        elif self.match(self.RBK_COMPOUND_KEYWORDS):
+            raise _Untranslatable
+        else:
+            self._out.append(' %s;' % self.SIMPLE_MARKER)
+            self._translate_directive()
+
+    def _translate_pybody(self):
+        if self.match(t.NEWLINE):
+            self._copy()
+            self._copy(expected=t.INDENT)
+            self._copy_raw(t.DEDENT)
+        elif self.match(self.PY_COMPOUND_KEYWORDS):
+            raise _Untranslatable
+        else:
+            self._copy_raw(t.NEWLINE)
+
+    def translate(self):
+        """Translate the Rulebook source into Python source code with markers."""
+        self._out = []
+        self._row, self._col = 1, None
+        try:
+            self._translate_block()
+            return ''.join(self._out)
+        finally:
+            self._out = None
+
+    def _source_line(self, lineno):
+        for tok in self.tokens:
+            if tok.start[0] == lineno:
+                return tok.line
+
+    def _node_error(self, node, msg):
+        raise SyntaxError(msg, (self.filename, node.lineno, node.col_offset,
+                                self._source_line(node.lineno)))
+
+    @staticmethod
+    def _is_name(node, name):
+        return isinstance(node, pyast.Name) and node.id == name
+
+    def _recover_block(self, stmts):
+        """Convert a list of (translated) Python statements to Rulebook directives."""
+        r = []
+        for stmt in stmts:
+            if isinstance(stmt, pyast.Assign) and self._is_name(stmt.targets[0], self.PRIO_MARKER):
+                if not r or not isinstance(r[-1], rbkast.Assign):
+                    self._node_error(stmt, "Unexpected token")
+                r[-1].prio = stmt.value
+                continue
+            dir = self._recover_directive(stmt)
+            if dir is not None:
+                r.append(dir)
+        return r
+
+    def _recover_body(self, stmts):
+        if stmts and isinstance(stmts[0], pyast.Expr) and self._is_name(stmts[0].value, self.SIMPLE_MARKER):
+            dirs = self._recover_block(stmts[1:])
+            if len(dirs) != 1:
+                self._node_error(stmts[0], "Invalid simple body")
+            return dirs[0]
+        return rbkast.Block(self._recover_block(stmts))
+
+    def _split_key(self, iter):
+        """Split the translated iterable of a keyed `for` (``b , __rbk_key__, a.k``)
+        into the iterable and the key expression."""
+        if not isinstance(iter, pyast.Tuple):
+            return iter, None
+        for idx, elt in enumerate(iter.elts):
+            if self._is_name(elt, self.KEY_MARKER): break
+        else:
+            return iter, None
+        return self._join_elts(iter, iter.elts[:idx]), self._join_elts(iter, iter.elts[idx+1:])
+
+    def _join_elts(self, node, elts):
+        """Join the elements split off a translated tuple `node` back into an expression."""
+        if not elts: self._node_error(node, "Empty expression")
+        if len(elts) == 1: return elts[0]
+        return pyast.copy_location(pyast.Tuple(elts, pyast.Load()), elts[0])
+
+    def _recover_directive(self, node):
+        if isinstance(node, pyast.If):
+            return rbkast.If(node.test, self._recover_body(node.body),
+                             self._recover_body(node.orelse) if node.orelse else None)
+        elif isinstance(node, pyast.For) and not node.orelse:
+            iter, item_key = self._split_key(node.iter)
+            return rbkast.For(node.target, iter, self._recover_body(node.body), item_key)
+        elif isinstance(node, pyast.With) and len(node.items) == 1:
+            marker = node.items[0].context_expr
+            if isinstance(marker, pyast.Call) and self._is_name(marker.func, self.ONCHANGE_MARKER):
+                return rbkast.OnChange(marker.args[0], node.body)
+            elif isinstance(marker, pyast.Name) and marker.id.startswith('__rbk_'):
+                return rbkast.EnterLeave(marker.id[len('__rbk_'):-2], node.body)
+        elif isinstance(node, (pyast.Import, pyast.ImportFrom)):
+            return rbkast.Import(node)
+        elif isinstance(node, pyast.Assign):
+            if len(node.targets) != 1:
+                self._node_error(node, "Multi-target assignments are not supported")
+            lhs = node.targets[0]
+            if isinstance(lhs, pyast.Attribute) and self._is_name(lhs.value, self.SET_MARKER):
+                if lhs.attr != 'prio':
+                    self._node_error(node, "Unknown `set` directive: '%s'" % lhs.attr)
+                self.defaults['prio'] = node.value
+                return None
+            return rbkast.Assign(lhs, node.value, prio=self.defaults['prio'], comb=None)
+        elif isinstance(node, pyast.AugAssign) and isinstance(node.op, pyast.MatMult):
+            value = node.value
+            marker = value.elts[0] if isinstance(value, pyast.Tuple) and value.elts else None
+            if marker is None or not isinstance(marker, pyast.Name) \
+                    or marker.id not in self.NAMED_OP_MARKERS:
+                self._node_error(node, "Unexpected statement")
+            value = self._join_elts(node, value.elts[1:])
+            comb = pyast_tools.dotted(self.AUG_COMB[self.NAMED_OP_MARKERS[marker.id]])
+            return rbkast.Assign(node.target, value, prio=self.defaults['prio'], comb=comb)
+        elif isinstance(node, pyast.AugAssign) and type(node.op) in self.AUG_OP_COMB:
+            comb = pyast_tools.dotted(self.AUG_OP_COMB[type(node.op)])
+            return rbkast.Assign(node.target, node.value, prio=self.defaults['prio'], comb=comb)
+        elif isinstance(node, pyast.Expr) and isinstance(node.value, pyast.Call):
+            return rbkast.CustomDirective(node.value)
+        self._node_error(node, "Unexpected statement")
+
+    def translate_rulebook(self):
+        """Parse the rulebook in a single pass (see above)."""
+        src = self.translate()
+        debug('translate_rulebook: translated to\n    |' + src.replace('\n', '\n    |'))
+        try:
+            module = pyast.parse(src, self.filename)
+        except SyntaxError as exc:
+            # Show the original line rather than the translated one
+            exc.text = self._source_line(exc.lineno) or exc.text
+            raise
+        return rbkast.Rulebook(rbkast.Block(self._recover_block(module.body)))
+
+class _Untranslatable(Exception):
+    """Raised when a rulebook uses a construct that cannot be expressed in the
+    single-pass translation, e.g. a compound statement as a simple body."""
+
+def parse(inp, filename='<str>', *, single_pass=True):
+    """Parse a Rulebook source (see ``tokenize`` for accepted inputs) into its AST.
+
+    By default, the whole rulebook is translated to Python and parsed at once
+    (see ``Parser.translate_rulebook``). Rulebooks using constructs that the
+    translation cannot express are parsed with the original, expression-by-expression
+    parser, which can also be requested explicitly with ``single_pass=False``.
+    """
+    parser = Parser(inp, filename)
+    if single_pass:
+        try:
+            return parser.translate_rulebook()
+        except _Untranslatable:
+            debug('parse: falling back to the legacy parser')
+            parser = Parser(parser.tokens, filename)
+    return parser.parse_rulebook()
 
 __all__ = ['Parser', 'parse', 'tokenize']
 
@@ -1,6 +1,6 @@
 
 import sys
-import copy, functools
+import copy, functools, textwrap
 import ast as pyast
 
 class _Found(Exception):
@@ -150,6 +150,75 @@ def interpolate(node=None, **kw):
     return _InterpolateTransformer(kw).visit(node)
 
 
+def _template_name(value, ctx):
+    if isinstance(value, str):
+        return pyast.Name(value, ctx)
+    return value
+
+def _template_stmts(value):
+    if isinstance(value, (list, tuple)):
+        return value
+    elif isinstance(value, pyast.stmt):
+        return [value]
+    else:
+        return [pyast.Expr(value)]
+
+class Template(object):
+    """A piece of Python code with placeholders, from which ASTs can be built.
+
+    Unlike ``get_ast`` and ``interpolate``, the template source is parsed only
+    once, when the template is created (usually at import time), and turned
+    into a factory function that constructs fresh nodes directly::
+
+        HELPER = Template('''
+            def NAME(x):
+                DEFS
+                return BODY
+        ''', 'NAME DEFS BODY')
+        nodes = HELPER(NAME='helper', DEFS=[...], BODY=pyast.Num(42))
+
+    Placeholders are substituted the same way as with ``interpolate``. A name
+    is replaced with the given node (or a ``Name`` if a string is given),
+    a placeholder statement with the given list of statements, and strings
+    equal to a placeholder (e.g. in ``def NAME`` or ``'NAME'``) with the
+    given string. The nodes of the result have no locations.
+    """
+
+    def __init__(self, source, params):
+        if isinstance(params, str): params = params.split()
+        self.params = list(params)
+        self.body = pyast.parse(textwrap.dedent(source)).body
+        code = 'def factory(%s):\n    return %s\n' % (
+                    ', '.join(['*'] + self.params) if self.params else '', self._gen(self.body))
+        ns = { '_ast': pyast, '_name': _template_name, '_stmts': _template_stmts }
+        exec(compile(code, '<template>', 'exec'), ns)
+        self._factory = ns['factory']
+
+    def _gen(self, node):
+        """Generate a Python expression that builds a copy of `node`."""
+        if isinstance(node, list):
+            items = []
+            for item in node:
+                if (isinstance(item, pyast.Expr) and isinstance(item.value, pyast.Name)
+                        and item.value.id in self.params):
+                    items.append('*_stmts(%s)' % item.value.id)
+                else:
+                    items.append(self._gen(item))
+            return '[%s]' % ', '.join(items)
+        elif isinstance(node, pyast.Name) and node.id in self.params:
+            return '_name(%s, %s)' % (node.id, self._gen(node.ctx))
+        elif isinstance(node, pyast.AST):
+            return '_ast.%s(%s)' % (type(node).__name__,
+                                    ', '.join( self._gen(getattr(node, fld, None)) for fld in node._fields ))
+        elif isinstance(node, str) and node in self.params:
+            return node
+        else:
+            return repr(node)
+
+    def __call__(self, **kw):
+        """Build the AST (a list of statements) with placeholders substituted by `kw`."""
+        return self._factory(**kw)
+
 def single(nodes):
     if not isinstance(nodes, (list, tuple)) or len(nodes)!=1:
         raise ValueError("INTERNAL ERROR: Expected a single AST node")
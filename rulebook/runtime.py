@@ -1,8 +1,13 @@
 import builtins
 from .abider import  *
+from .tracked import TrackedCollection
+from . import aggregate
 from .util import *
 import weakref
 import collections
+import heapq
+import operator
+import time
 from contextlib import contextmanager
 from functools import partial
 
@@ -18,20 +23,62 @@ class ObjectWrapper:
         self.__dict__['_rbk_obj'] = obj
         if self._rbk_obj is None: raise RuntimeError('Object no longer exists')
 
+    # Reads are recorded as one of these kinds of dependencies (the `subtype`
+    # of the ``Target``), which tracked objects report separately (see
+    # ``rulebook.tracked``):
+    #
+    #   attr      ``w.name``
+    #   item      ``w[key]``, ``w.get(key)``
+    #   len       ``len(w)``, ``bool(w)`` (for containers)
+    #   contains  ``key in w``
+    #   keys      ``w.keys()``
+    #   iter      anything else that iterates the object (``for``, ``w.values()``,
+    #             ``w + [1]``...)
+
     def __getattr__(self, name):
-        return self._rbk_ctx.read_value((self._rbk_obj, 'attr', name))
+        obj = self._rbk_obj
+        if isinstance(obj, TrackedCollection) and name in obj.READ_METHODS:
+            return partial(self._rbk_ctx._read_method, obj, name, obj.READ_METHODS[name])
+        return self._rbk_ctx.read_value(Target.get(obj, 'attr', name))
 
     def __getitem__(self, key):
-        return self._rbk_ctx.read_value((self._rbk_obj, 'item', key))
+        return self._rbk_ctx.read_value(Target.get(self._rbk_obj, 'item', key))
 
     def __iter__(self):
-        self._rbk_ctx._report_read((self._rbk_obj, 'iter', None))
-        return map(partial(ObjectWrapper, self._rbk_ctx), iter(self._rbk_obj))
+        ctx = self._rbk_ctx
+        ctx._report_read(Target.get(self._rbk_obj, 'iter', None))
+        if ctx._readtrack_stack:
+            return map(ctx._wrap, self._rbk_obj)
+        return iter(self._rbk_obj)
+
+    def __reversed__(self):
+        ctx = self._rbk_ctx
+        ctx._report_read(Target.get(self._rbk_obj, 'iter', None))
+        if ctx._readtrack_stack:
+            return map(ctx._wrap, reversed(self._rbk_obj))
+        return reversed(self._rbk_obj)
+
+    def __len__(self):
+        return self._rbk_ctx.read_value(Target.get(self._rbk_obj, 'len', None))
+
+    def __bool__(self):
+        cls = type(self._rbk_obj)
+        if hasattr(cls, '__len__') and not hasattr(cls, '__bool__'):
+            return len(self) > 0
+        return bool(self._rbk_obj)
 
     def __contains__(self, key):
-        self._rbk_ctx._report_read((self._rbk_obj, 'item', key))
+        if isinstance(key, ObjectWrapper): key = key._rbk_obj
+        try:
+            target = Target.get(self._rbk_obj, 'contains', key)
+        except TypeError: # Unhashable
+            target = Target.get(self._rbk_obj, 'iter', None)
+        self._rbk_ctx._report_read(target)
         return key in self._rbk_obj
 
+    def __hash__(self):
+        return hash(self._rbk_obj)
+
     def __setattr__(self, name, val):
         setattr(self._rbk_obj, name, val)
 
@@ -57,15 +104,36 @@ class ObjectWrapper:
         locals()[_tmp_meth] = _tmp_mkfunc()
     del _tmp_meth, _tmp_mkfunc
 
+    # Operators of containers (``lst + [1]``, ``s | {1}``...) depend on the whole contents
+    for _tmp_meth in ['__add__', '__radd__', '__mul__', '__rmul__', '__sub__', '__rsub__',
+                      '__or__', '__ror__', '__and__', '__rand__', '__xor__', '__rxor__']:
+        def _tmp_mkfunc(meth=_tmp_meth):
+            def _tmp_func(self, other):
+                a = self._rbk_obj
+                if isinstance(other, ObjectWrapper): b = other._rbk_obj
+                else: b = other
+                self._rbk_ctx._report_read(Target.get(a, 'iter', None))
+                return getattr(a, meth)(b)
+            _tmp_func.__name__ = meth
+            return _tmp_func
+        locals()[_tmp_meth] = _tmp_mkfunc()
+    del _tmp_meth, _tmp_mkfunc
+
 def get_effective_value(vals):
     """Given a value set, computes the effective value, i.e. the one
     with highest priority. If more values have the same priority, the
-    result is undefined."""
+    result is undefined.
+
+    Accepts either a ``ValueSet`` (or ``SingleValueSet``) or a plain
+    ``{ident: (val, prio, comb)}`` dict. The latter is sorted on every
+    call, the former maintains its priority order incrementally."""
+    if isinstance(vals, (ValueSet, SingleValueSet)):
+        return vals.get_effective_value()
     lst = sorted(vals.values(), key=lambda x: -x[1])
     anchor = 0 # The highest priority non-relative value (with comb=None)
     while anchor < len(lst) and lst[anchor][2]:
         anchor += 1
-    if lst[anchor][2]:
+    if anchor >= len(lst):
         ## TODO we should say which one :-D
         raise RuntimeError("Value set contains only relative values")
     val = lst[anchor][0]
@@ -73,35 +141,306 @@ def get_effective_value(vals):
         val = comb(val, relval)
     return val
 
+class ValueSet:
+    """All the values assigned to a single target, indexed by priority.
+
+    Absolute values (those with ``comb=None``) are kept in a binary heap
+    ordered by priority, so that adding, removing or re-prioritizing
+    a value costs O(log n) and the winner can be found in O(1).
+    Heap entries are never removed in place; instead, entries whose
+    ident has since been removed or re-prioritized are skipped (and
+    popped) when they reach the top of the heap (lazy deletion).
+
+    Relative values (``+=`` and friends) are folded into the winning value
+    in the order of their priority. Those with a combining function known
+    to ``aggregate.KINDS`` are grouped by the function and priority into an
+    ``aggregate.Aggregate``, which maintains their fold incrementally. A group
+    is only applied as a whole if it is the only relative value at its
+    priority (so that the order within the priority does not matter) and
+    can maintain its values (e.g. not for ``+=`` of lists). Otherwise, and at
+    the priority of the winning value, its values are folded one by one.
+    The other relative values are rare, so they are simply sorted when the
+    effective value is computed.
+
+    Values with equal priority are ordered by the time their ident
+    was first added, just like in the dict-based value sets this
+    replaces.
+
+    Besides the values, the set remembers the effective value last seen
+    by the Context (``last_value``) and the one last written to the
+    target (``committed_value``), so that unchanged values can be
+    skipped (see ``Context.EQ_CUTOFF``)."""
+    __slots__ = ('last_value', 'committed_value', '_entries', '_heap', '_relative', '_groups',
+                 '_seq', '_cache_valid', '_cache')
+
+    def __init__(self):
+        self.last_value = self.committed_value = NOTHING
+        self._entries = {} # ident -> (val, prio, comb, seq)
+        self._heap = []    # (-prio, seq, ident) for absolute values
+        self._relative = {} # ident -> (-prio, seq) for relative values
+        self._groups = {}   # (comb, prio) -> Aggregate for aggregated relative values
+        self._seq = 0
+        self._cache_valid = False
+        self._cache = None
+
+    def set(self, ident, val, prio, comb=None):
+        """Add a value to the set, replacing any previous value with the same ident.
+        Returns the value set (see ``SingleValueSet.set``)."""
+        old = self._entries.get(ident)
+        if old is None:
+            self._seq += 1
+            seq = self._seq
+        else:
+            seq = old[3]
+        self._entries[ident] = (val, prio, comb, seq)
+        if old is not None and old[2] is not None and (old[2] is not comb or old[1] != prio):
+            self._remove_relative(ident, old)
+        if comb is None:
+            # If only the value changed, the heap entry is still valid.
+            if old is None or old[2] is not None or old[1] != prio:
+                heapq.heappush(self._heap, (-prio, seq, ident))
+                self._maybe_compact()
+        elif comb in aggregate.KINDS:
+            group = self._groups.get((comb, prio))
+            if group is None:
+                group = self._groups[comb, prio] = aggregate.KINDS[comb](comb, seq)
+            group.set(ident, val)
+        else:
+            self._relative[ident] = (-prio, seq)
+        self._cache_valid = False
+        return self
+
+    def remove(self, ident):
+        """Remove the value with the given ident. Raises KeyError if there is no such value."""
+        old = self._entries.pop(ident)
+        if old[2] is not None:
+            self._remove_relative(ident, old)
+        self._cache_valid = False
+
+    def _remove_relative(self, ident, entry):
+        val, prio, comb, seq = entry
+        group = self._groups.get((comb, prio))
+        if group is None:
+            del self._relative[ident]
+        else:
+            group.remove(ident)
+            if not group:
+                del self._groups[comb, prio]
+
+    def _is_live(self, heap_entry):
+        negprio, seq, ident = heap_entry
+        entry = self._entries.get(ident)
+        return (entry is not None and entry[2] is None
+                and entry[3] == seq and -entry[1] == negprio)
+
+    def _maybe_compact(self):
+        # Do not let stale entries pile up when priorities change often.
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = [ (-prio, seq, ident) for ident, (val, prio, comb, seq)
+                                in self._entries.items() if comb is None ]
+            heapq.heapify(self._heap)
+
+    def _top(self):
+        heap = self._heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def get_effective_value(self):
+        """Return the value with the highest priority, combined with all
+        relative values of an even higher priority."""
+        if self._cache_valid:
+            return self._cache
+        top = self._top()
+        if top is None:
+            raise RuntimeError("Value set contains only relative values")
+        val = self._entries[top[2]][0]
+        if self._relative or self._groups:
+            anchor = top[:2]
+            keys = [ (key, ident) for ident, key in self._relative.items() if key < anchor ]
+            # Priorities with more than one combining function, where the order matters
+            mixed = { -key[0] for key, ident in keys }
+            if len(self._groups) > 1:
+                mixed.update( prio for prio, count in
+                              collections.Counter( prio for comb, prio in self._groups ).items()
+                              if count > 1 )
+            for (comb, prio), group in self._groups.items():
+                if -prio < anchor[0] and prio not in mixed and not group._fallback:
+                    keys.append(((-prio, group.seq), group))
+                elif -prio <= anchor[0]:
+                    # Fold the values one by one, in the same order as the other relative
+                    # values (at the anchor's priority, only those added before it apply)
+                    keys += [ (key, ident) for key, ident in
+                              (((-prio, self._entries[ident][3]), ident) for ident in group.values)
+                              if key < anchor ]
+            # Fold from the lowest to the highest priority.
+            for key, what in sorted(keys, key=operator.itemgetter(0), reverse=True):
+                if isinstance(what, aggregate.Aggregate):
+                    val = what.apply(val)
+                else:
+                    relval, _, comb, _ = self._entries[what]
+                    val = comb(val, relval)
+        self._cache = val
+        self._cache_valid = True
+        return val
+
+    def items(self):
+        return ( (ident, entry[:3]) for ident, entry in self._entries.items() )
+
+    def __contains__(self, ident):
+        return ident in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return 'ValueSet(%r)' % dict(self.items())
+
+class SingleValueSet(object):
+    """A value set holding at most one value, stored directly in its slots.
+
+    Most targets are assigned by a single rule, which makes their value sets
+    far more numerous than all the other runtime objects. ``Context`` starts
+    every value set as a ``SingleValueSet``, whose ``set`` returns a full
+    ``ValueSet`` replacing it when a value with another ident is added."""
+    __slots__ = ('last_value', 'committed_value', 'ident', 'val', 'prio', 'comb')
+
+    def __init__(self):
+        self.last_value = self.committed_value = NOTHING
+        self.ident = NOTHING
+        self.val = self.prio = self.comb = None
+
+    def set(self, ident, val, prio, comb=None):
+        if self.ident is NOTHING or self.ident == ident:
+            self.ident, self.val, self.prio, self.comb = ident, val, prio, comb
+            return self
+        full = ValueSet()
+        full.last_value, full.committed_value = self.last_value, self.committed_value
+        full.set(self.ident, self.val, self.prio, self.comb)
+        return full.set(ident, val, prio, comb)
+
+    def remove(self, ident):
+        if ident not in self: raise KeyError(ident)
+        self.ident = NOTHING
+        self.val = self.prio = self.comb = None
+
+    def get_effective_value(self):
+        if self.ident is NOTHING or self.comb is not None:
+            raise RuntimeError("Value set contains only relative values")
+        return self.val
+
+    def items(self):
+        if self.ident is NOTHING: return iter(())
+        return iter([(self.ident, (self.val, self.prio, self.comb))])
+
+    def __contains__(self, ident):
+        return self.ident is not NOTHING and self.ident == ident
+
+    def __len__(self):
+        return 0 if self.ident is NOTHING else 1
+
+    def __repr__(self):
+        return 'ValueSet(%r)' % dict(self.items())
+
 class Context:
-    # The maximum length of an event chain before the rulebook is considered oscillating
-    # and an exception is raised.
+    # The maximum number of times a single watcher may run while processing one wave
+    # of events, before the rulebook is considered oscillating and an exception is raised.
+    # (Watchers normally run once per wave, however many of them there are.)
     MAX_CHAIN = 1000
     # Types that don't need change tracking -- simple immutable builtin types
     UNTRACKED = (str, bool, int, tuple, frozenset, float, complex, type(None))
+    # When a value set changes but its effective value stays equal (``==``)
+    # to the previous one, do not notify the watchers of the target and
+    # do not write the value again. Set to False to always propagate.
+    #
+    # NB: the cutoff compares against the last value *assigned by the
+    # rulebook*, changes made to the target behind its back are not seen.
+    EQ_CUTOFF = True
+    # Types whose ``__eq__`` is expensive or does not return a plain bool
+    # (e.g. numpy arrays); values of these types are compared by identity only.
+    EQ_CUTOFF_EXEMPT = ()
+    # The number of seconds a deactivated ``Lazy`` subtree is kept before
+    # it is evicted (rebuilt on its next activation). None keeps subtrees
+    # forever, 0 evicts them as soon as they are deactivated.
+    LAZY_IDLE_TIMEOUT = None
     def __init__(self):
         self._last_id = 0
         self._readtrack_stack = []
 
-        self._valuesets = ObjectKeyDict()
+        # All the tables below are indexed by (interned) ``Target``s,
+        # see ``_target``. When the object of a target dies, its entries
+        # are removed from the tables by ``_reap``.
+        self._valuesets = {}
         # Every time the value set is changed during a transaction, the effective
         # value is stored here. This has two purposes:
         # (1) Cache the effective value so that we don't have to traverse the whole
         #     value set for every in-transaction read.
         # (2) Keep a list of targets changed during the transaction which can be
         #     used to commit the changes.
-        self._uncommitted = ObjectKeyDict()
-        self._uncommitted_directives = ObjectKeyDict() # Used as a set, the values are ignored
+        self._uncommitted = {}
+        self._uncommitted_directives = {} # Used as a set, the values are ignored
 
+        # ident -> the targets it watches (a dict used as an ordered set)
         self._watchsets = {}
-        self._watchers = ObjectKeyDict()
-        self._queue = collections.deque()
-        self._inhibit_cnt = ObjectKeyDict()
+        self._watch_funcs = {}
+        # target -> idents of the watchsets containing it (a dict used as an ordered set)
+        self._watchers = {}
+        # Watchers waiting to be run, see ``_schedule``. The queue is a heap
+        # of ``(height, seq, ident)`` entries, ``_queued`` maps the ident
+        # to the target the watcher will be called with.
+        self._queue = []
+        self._queued = {}
+        self._queue_seq = 0
+        # The dependency height of each watchset (ident -> int) and of each
+        # target (the maximum height of the watchsets assigning to it, -1 if
+        # nobody assigns to it), see ``_raise_height``.
+        self._heights = {}
+        self._target_heights = {}
+        # ident -> the target its value is assigned to (see ``add_value``)
+        self._value_targets = {}
+        # Watchsets registered with an ``owner`` (see ``add_watchset``):
+        # ident -> owner, owner -> {ident: True} and owner -> height
+        self._watch_owners = {}
+        self._owned_watchsets = {}
+        self._owner_heights = {}
+        self._inhibit_cnt = {}
+        # External notifications postponed by ``batch``, used as an ordered set
+        self._batched = {}
+        self._batch_depth = 0
+        # Targets whose value sets were changed inside ``bulk`` (an ordered set)
+        self._bulk = {}
+        self._bulk_depth = 0
+        # Aggregate expressions (see ``aggregate``): key -> CollectionAggregate,
+        # and those nobody may watch any more (used as an ordered set)
+        self._aggregates = {}
+        self._idle_aggregates = {}
+        # Deactivated ``Lazy`` directives -> when they were deactivated. Weak,
+        # so that the subtrees of discarded directives do not stay alive.
+        self._idle_lazy = weakref.WeakKeyDictionary()
 
         self.in_transaction = False
         self._processing = False
 
         self.commit_hooks = []
+        # Various event counters, useful for profiling rulebooks:
+        #   echo_suppressed -- change notifications caused by our own writes
+        #                      (see ``_do_set``) that were ignored
+        #   batch_coalesced -- duplicate notifications dropped inside ``batch``
+        #   events_queued, events_coalesced, watcher_runs -- see ``trans_stats``
+        self.stats = collections.Counter()
+        # Counters for the current transaction (moved to ``last_trans_stats``
+        # and added to ``stats`` on commit):
+        #   events_queued -- change notifications processed
+        #   events_coalesced -- watchers not queued because they already were
+        #   watcher_runs -- watcher functions called
+        self.trans_stats = collections.Counter()
+        self.last_trans_stats = collections.Counter()
+
+        # Targets whose objects died and that wait for ``_reap``
+        self._dead_targets = []
+        # Table name -> number of entries removed by ``_reap``
+        self._gc_stats = collections.Counter()
+        Target.add_death_listener(self)
 
         self.ns = Namespace()
         self.nswrap = ObjectWrapper(self, self.ns)
@@ -110,82 +449,221 @@ class Context:
         self._last_id += 1
         return self._last_id
 
+    def declare_static(self, names):
+        """Record the builtin names a loaded rulebook uses without looking them up
+        in the namespace (see ``doc/design/names.md``). Setting them in the
+        namespace from the outside logs a warning, and so do those that are
+        already set when the rulebook is loaded."""
+        if names:
+            for name in sorted(set(names) & set(vars(self.ns))):
+                logger.warning("The namespace value of %r does not affect the loaded rulebook,"
+                               " which uses the builtin of the same name (see doc/design/names.md)",
+                               name)
+            self.ns._rbk_static = self.ns._rbk_static | frozenset(names)
+
     def _unwrap(self, obj):
         if isinstance(obj, ObjectWrapper):
             return obj._rbk_obj
         else:
             return obj
 
+    def _target(self, target):
+        """Convert an ``(obj, subtype, subname)`` tuple to an interned ``Target``."""
+        if type(target) is Target:
+            return target
+        obj, subtype, subname = target
+        if isinstance(obj, ObjectWrapper):
+            obj = obj._rbk_obj
+        # Names other than the loop variables are assigned in the namespace
+        # the overlay of a ``for`` body reads them from (and writes them to).
+        while type(obj) is NamespaceOverlay and subtype == 'attr' and subname not in obj._overlay:
+            obj = obj._base
+            if isinstance(obj, ObjectWrapper):
+                obj = obj._rbk_obj
+        return Target.get(obj, subtype, subname)
+
     def _wrap(self, obj):
         if isinstance(obj, ObjectWrapper):
             return obj
-        elif isinstance(obj, RuleAbider):
+        elif isinstance(obj, AbiderBase):
             return ObjectWrapper(self, obj)
         else:
             if not isinstance(obj, self.UNTRACKED):
                 logger.warn('Cannot track %r of type %s'%(obj, type(obj).__name__))
             return obj
 
+    ### GARBAGE COLLECTION {{{ ###
+
+    def _target_died(self, target):
+        # Called from a weakref callback, i.e. at an arbitrary point (perhaps
+        # in the middle of iterating over one of our tables). Defer the cleanup.
+        self._dead_targets.append(target)
+
+    def _reap(self):
+        """Remove all entries for targets whose objects no longer exist."""
+        while self._dead_targets:
+            dead, self._dead_targets = self._dead_targets, []
+            for target in dead:
+                vals = self._valuesets.get(target)
+                if vals is not None:
+                    for ident, _ in vals.items():
+                        if self._value_targets.get(ident) is target:
+                            del self._value_targets[ident]
+                for name, table in [('valuesets', self._valuesets),
+                                    ('uncommitted', self._uncommitted),
+                                    ('batched', self._batched)]:
+                    if target in table:
+                        del table[target]
+                        self._gc_stats[name] += 1
+                self._target_heights.pop(target, None)
+                idents = self._watchers.pop(target, None)
+                if idents is not None:
+                    self._gc_stats['watchers'] += 1
+                    for ident in idents:
+                        self._watchsets[ident] = tuple( t for t in self._watchsets[ident]
+                                                        if t is not target )
+
+    def gc_stats(self):
+        """Return the number of table entries removed (so far) because their
+        objects died, as a dict indexed by table name."""
+        self._reap()
+        return dict(self._gc_stats)
+
+    ### }}} ###
+
     ### VALUE SET MANIPULATION {{{ ###
 
 
     def add_value(self, target, val, prio, ident=None, comb=None):
         val = self._unwrap(val)
-        target = (self._unwrap(target[0]),) + target[1:]
+        target = self._target(target)
         prio = self._unwrap(prio)
         if ident is None: ident = self.new_id()
 
-        self._valuesets.setdefault(target, {})[ident] = (val, prio, comb)
+        vals = self._valuesets.get(target, None)
+        if vals is None:
+            vals = self._valuesets[target] = SingleValueSet()
+        new = vals.set(ident, val, prio, comb)
+        if new is not vals:
+            self._valuesets[target] = new
+        self._value_targets[ident] = target
+        self._raise_height(target, self._value_height(ident))
         self._value_set_changed(target)
 
         return ident
 
     def remove_value(self, target, ident):
-        target = (self._unwrap(target[0]),) + target[1:]
-        try:
-            del self._valuesets.setdefault(target, {})[ident]
-        except KeyError:
-            logger.debug('Not removing %r %r', target, self._valuesets.setdefault(target, {}))
+        target = self._target(target)
+        vals = self._valuesets.get(target, None)
+        if vals is None or ident not in vals:
+            logger.debug('Not removing %r %r', target, vals)
             return
+        vals.remove(ident)
+        if self._value_targets.get(ident) is target:
+            del self._value_targets[ident]
         self._value_set_changed(target)
 
     @contextmanager
     def _inhibit_notify(self, target):
+        """Ignore change notifications for ``target`` while in this block."""
+        self._inhibit_cnt[target] = self._inhibit_cnt.get(target, 0) + 1
         try:
-            self._inhibit_cnt.setdefault(target, 0)
-            self._inhibit_cnt[target] += 1
             yield
         finally:
             self._inhibit_cnt[target] -= 1
             if self._inhibit_cnt[target] <= 0:
-                del self._inhibited[target]
+                del self._inhibit_cnt[target]
 
     def _do_set(self, target, val):
-        obj, subtype, subname = target
-        if isinstance(obj, ObjectWrapper): obj = obj._rbk_obj
-        if subtype == 'attr':
-            # Support the explicit setter idiom common in Python.
-            if hasattr(obj, 'set_' + subname):
-                getattr(obj, 'set_' + subname)(val)
+        target = self._target(target)
+        obj, subtype, subname = target.obj, target.subtype, target.subname
+        if obj is None: return # Died in the meantime
+        # Whoever calls us notifies the watchers of the target on its own.
+        # The notification the object sends back (e.g. ``RuleAbider._changed``)
+        # would only start another round of event processing.
+        with self._inhibit_notify(target):
+            if subtype == 'attr':
+                # Support the explicit setter idiom common in Python.
+                if hasattr(obj, 'set_' + subname):
+                    getattr(obj, 'set_' + subname)(val)
+                else:
+                    setattr(obj, subname, val)
+            elif subtype == 'item':
+                obj[subname] = val
             else:
-                setattr(obj, subname, val)
-        elif subtype == 'item':
-            obj[subname] = val
-        else:
-            raise ValueError
+                raise ValueError
+
+    def _same_value(self, old, new):
+        """Decide whether an effective value change can be skipped."""
+        if old is new: return self.EQ_CUTOFF
+        if (not self.EQ_CUTOFF or old is NOTHING or type(old) is not type(new)
+                or isinstance(new, self.EQ_CUTOFF_EXEMPT)):
+            return False
+        try:
+            return bool(old == new)
+        except Exception:
+            return False
+
+    def _commit_value(self, target, vals, val):
+        if vals is not None:
+            if self._same_value(vals.committed_value, val):
+                logger.debug('...unchanged, not writing')
+                return
+            vals.committed_value = val
+        self._do_set(target, val)
+
+    @contextmanager
+    def bulk(self):
+        """Postpone the recomputation of effective values until the end of the block.
+
+        Used when (de)activating a whole subtree of directives: the effective
+        value of each changed target is then computed (and its watchers are
+        notified) only once, no matter how many of the directives assign to
+        it. A target read inside the block is brought up to date first."""
+        self._bulk_depth += 1
+        try:
+            yield
+        finally:
+            self._bulk_depth -= 1
+            if not self._bulk_depth:
+                self._flush_bulk()
+
+    def _flush_bulk(self):
+        while self._bulk:
+            target = next(iter(self._bulk))
+            self._flush_bulk_target(target)
+
+    def _flush_bulk_target(self, target):
+        del self._bulk[target]
+        self.stats['bulk_recomputed'] += 1
+        self._recompute(target)
 
     def _value_set_changed(self, target):
-        vals = self._valuesets.get(target, {})
-        if not vals and target in self._valuesets:
+        if self._bulk_depth:
+            if target in self._bulk:
+                self.stats['bulk_coalesced'] += 1
+            else:
+                self._bulk[target] = True
+            return
+        self._recompute(target)
+
+    def _recompute(self, target):
+        vals = self._valuesets.get(target, None)
+        if vals is not None and not vals:
             del self._valuesets[target]
+            self._target_heights.pop(target, None)
         logger.debug('VALSET %s %s', target, vals)
 
         if vals:
-            eff = get_effective_value(vals)
+            eff = vals.get_effective_value()
+            if self._same_value(vals.last_value, eff):
+                logger.debug('...effective value unchanged')
+                return
+            vals.last_value = eff
             if self.in_transaction:
                 self._uncommitted[target] = eff
             else:
-                self._do_set(target, eff)
+                self._commit_value(target, vals, eff)
             self.notify_change(target, external=False)
         else:
             # If the value set is empty, the resulting value is undefined
@@ -214,26 +692,33 @@ class Context:
     def tracked_eval(self, expr):
         """Evaluates an expression (wrapped in a lambda by ``rulebook.compiler.Compiler._wrap_lambda``),
         recording its dependencties. Returns the tuple (value, depends)."""
+        if type(expr) is Constant:
+            return expr.value, []
         with self.track_reads() as deps:
             val = expr()
-        return val, deps
+        return val, list(deps.keys())
 
     def _report_read(self, event):
         if self._readtrack_stack:
-            self._readtrack_stack[-1].append(event)
+            self._readtrack_stack[-1][event] = True
 
     def _do_read(self, target):
-        obj, subtype, subname = target
+        obj, subtype, subname = target.obj, target.subtype, target.subname
         if subtype == 'attr':
             return getattr(obj, subname)
         elif subtype == 'item':
             return obj[subname]
         elif subtype == 'iter':
             return iter(obj)
+        elif subtype == 'len':
+            return len(obj)
         else:
             raise ValueError("Unknown target type %r" % subtype)
 
     def read_value(self, target):
+        target = self._target(target)
+        if self._bulk and target in self._bulk:
+            self._flush_bulk_target(target)
         if target in self._uncommitted:
             val = self._uncommitted[target]
         else:
@@ -243,12 +728,101 @@ class Context:
             val = self._wrap(val)
         return val
 
+    def read_path(self, base, path):
+        """Read a static chain of attributes and items, e.g. ``N.a.b[0]`` given as
+        ``read_path(N, (('attr', 'a'), ('attr', 'b'), ('item', 0)))``.
+
+        Equivalent to reading the chain through ``ObjectWrapper``s (including
+        read tracking), but without creating a wrapper for each step. Emitted
+        by the compiler for static chains in rulebook expressions."""
+        tracking = bool(self._readtrack_stack)
+        # `tracked` -- would `obj` be wrapped in the generic code path?
+        if type(base) is ObjectWrapper:
+            obj, tracked = base._rbk_obj, True
+        else:
+            obj, tracked = base, False
+        for subtype, subname in path:
+            if tracked and subtype == 'attr' and isinstance(obj, TrackedCollection) \
+                    and subname in obj.READ_METHODS:
+                # See ``ObjectWrapper.__getattr__``
+                obj = partial(self._read_method, obj, subname, obj.READ_METHODS[subname])
+                tracked = False
+            elif tracked:
+                target = Target.get(obj, subtype, subname)
+                if self._bulk and target in self._bulk:
+                    self._flush_bulk_target(target)
+                if target in self._uncommitted:
+                    obj = self._uncommitted[target]
+                else:
+                    obj = self._do_read(target)
+                if tracking:
+                    self._report_read(target)
+                    if isinstance(obj, AbiderBase):
+                        continue
+                    obj = self._wrap(obj) # Only warns about untrackable values
+            elif subtype == 'attr':
+                obj = getattr(obj, subname)
+            else:
+                obj = obj[subname]
+            if type(obj) is ObjectWrapper:
+                obj, tracked = obj._rbk_obj, True
+            else:
+                tracked = False
+        return ObjectWrapper(self, obj) if tracked else obj
+
+    def _read_method(self, obj, name, kind, *a, **kw):
+        """Call a method reading a ``TrackedCollection``, recording the
+        dependency of the given kind (see ``ObjectWrapper``)."""
+        target = Target.get(obj, kind, a[0] if kind == 'item' else None)
+        if self._bulk and target in self._bulk:
+            self._flush_bulk_target(target)
+        self._report_read(target)
+        return getattr(obj, name)(*a, **kw)
+
+    def aggregate(self, kind, ns, coll, project, cond=None, site=None):
+        """Evaluate an aggregate expression over the collection `coll`, e.g.
+        ``sum(c.n for c in conns if c.up)`` given as ``aggregate('sum', N,
+        N.conns, lambda c: c.n, lambda c: c.up, 'agg1')``. Emitted by the
+        compiler for `sum`, `min`, `max`, `any`, `all` and `groupcount` of
+        generators.
+
+        Inside tracked evaluation, the result is kept up to date by a
+        ``aggregate.CollectionAggregate`` and only its result is recorded
+        as read. The aggregate is identified by `kind`, the call site `site`
+        (a name unique within the compiled rulebook), the code of `project`
+        (equal code objects may be shared, but not between rulebooks) and
+        the namespace `ns`, so that it is reused when the expression is
+        evaluated again."""
+        items = self._unwrap(coll)
+        if not self._readtrack_stack or not isinstance(items, aggregate.COLLECTIONS):
+            return aggregate.evaluate(kind, coll, project, cond)
+        key = (kind, site, id(project.__code__), id(ns))
+        agg = self._aggregates.get(key)
+        if agg is None:
+            agg = self._aggregates[key] = aggregate.CollectionAggregate(self, kind, key, ns)
+            # Swept on commit unless the expression starts watching it
+            self._idle_aggregates[agg] = True
+        agg.project, agg.cond = project, cond
+        agg.update(items)
+        self._report_read(agg.target)
+        return agg.value()
+
+    def _sweep_aggregates(self):
+        idle, self._idle_aggregates = self._idle_aggregates, {}
+        for agg in idle:
+            if not agg._rbk_subs and self._aggregates.get(agg.key) is agg:
+                agg.dispose()
+                del self._aggregates[agg.key]
+                self.stats['aggregates_swept'] += 1
+
     @contextmanager
     def track_reads(self):
-        lst = []
-        self._readtrack_stack.append(lst)
+        """Record all targets read in the block. Yields a dict whose keys
+        are the targets, each one recorded only once."""
+        reads = {}
+        self._readtrack_stack.append(reads)
         try:
-            yield lst
+            yield reads
         finally:
             self._readtrack_stack.pop()
 
@@ -258,16 +832,22 @@ class Context:
 
     def commit(self):
         if not self.in_transaction: raise RuntimeError("Commit with no transaction")
+        if self._batched and not self._processing:
+            # Explicit commit inside a ``batch`` block, make the batched
+            # changes part of this transaction.
+            self._flush_batch()
+        if self._bulk:
+            self._flush_bulk()
         logger.debug('COMMIT')
         for dir in self._uncommitted_directives:
             logger.debug('COMMIT_DIR %r', dir)
             dir.commit()
         commit_objs = {}
         for target, val in self._uncommitted.items():
-            if hasattr(target[0], '_rbk_commit'):
-                commit_objs[id(target[0])] = target[0]
+            if hasattr(target.obj, '_rbk_commit'):
+                commit_objs[id(target.obj)] = target.obj
             logger.debug('COMMIT_VAL %r %r', target, val)
-            self._do_set(target, val)
+            self._commit_value(target, self._valuesets.get(target, None), val)
         commit_objs = sorted(commit_objs.values(), key=lambda obj: getattr(obj, '_rbk_commit_order', 0))
         for obj in commit_objs:
             logger.debug('COMMIT_OBJ %r', obj)
@@ -275,13 +855,35 @@ class Context:
         for hook in self.commit_hooks:
             logger.debug('COMMIT_HOOK %r', hook)
             hook(commit_objs)
-        self._uncommitted = ObjectKeyDict()
-        self._uncommitted_directives = ObjectKeyDict()
+        self._uncommitted = {}
+        self._uncommitted_directives = {}
         self.in_transaction = False
+        self._reap()
+        if self._idle_aggregates:
+            self._sweep_aggregates()
+        if self._idle_lazy and self.LAZY_IDLE_TIMEOUT is not None:
+            self.evict_idle()
+        logger.debug('TRANS_STATS %r', self.trans_stats)
+        self.stats.update(self.trans_stats)
+        self.last_trans_stats = self.trans_stats
+        self.trans_stats = collections.Counter()
+
+    def evict_idle(self, timeout=None):
+        """Evict the ``Lazy`` subtrees deactivated at least `timeout` seconds
+        ago (``LAZY_IDLE_TIMEOUT`` by default). Called on every commit if
+        ``LAZY_IDLE_TIMEOUT`` is set."""
+        if timeout is None: timeout = self.LAZY_IDLE_TIMEOUT
+        if timeout is None: return
+        deadline = time.monotonic() - timeout
+        for lazy, since in list(self._idle_lazy.items()):
+            if since <= deadline:
+                del self._idle_lazy[lazy]
+                lazy.evict()
 
     def begin(self):
         if self.in_transaction: raise RuntimeError("Transaction already started")
         logger.debug('BEGIN')
+        self._reap()
         self.in_transaction = True
 
     def process_events(self):
@@ -291,18 +893,21 @@ class Context:
         try:
             in_trans = self.in_transaction
             if not in_trans: self.begin()
-            cnt = 0
+            runs = {} # ident -> the number of its runs
             while self._queue:
-                target = self._queue.popleft()
-                cnt += 1
-                # list() is necessary as watchers might change during iteration
-                for func in list(self._watchers.get(target, {}).values()):
-                    func(target)
+                _, _, ident = heapq.heappop(self._queue)
+                target = self._queued.pop(ident)
+                # The watchset might have been removed since the event was queued
+                func = self._watch_funcs.get(ident)
+                if func is None: continue
+                cnt = runs[ident] = runs.get(ident, 0) + 1
+                self.trans_stats['watcher_runs'] += 1
+                func(target)
 
                 if cnt > self.MAX_CHAIN:
                     raise RuntimeError("Maximum number of transaction events exceeded"
                             " (probable reason: oscillating configuration). Current: %r, next 10: %r"
-                            % (target, list(self._queue)[:10]))
+                            % (target, [ self._queued[x[2]] for x in sorted(self._queue)[:10] ]))
             if not in_trans: self.commit()
         except:
             # XXX temporary workaround for broken exception handling in Network Secretary
@@ -315,49 +920,228 @@ class Context:
             self._processing = False
             logger.debug('PROCESS_END')
 
+    @contextmanager
+    def batch(self):
+        """Postpone the processing of external changes until the end of the block.
+
+        Use this when changing many tracked objects at once::
+
+            with ctx.batch():
+                for obj, val in updates:
+                    obj.x = val
+
+        Without it, every single change would be processed (and committed)
+        in a separate transaction. Inside the block, change notifications
+        are only collected (repeated notifications for the same target
+        are merged) and they are all processed together when the outermost
+        ``batch`` block is left. If a transaction was started explicitly
+        using ``begin``, the changes become part of it (and are processed
+        at the latest when it is committed), otherwise they are committed
+        at the end of the block. There is no limit on the number of changed
+        targets (``MAX_CHAIN`` only limits how often a single watcher runs).
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._batched:
+                self._flush_batch()
+
+    def _flush_batch(self):
+        logger.debug('BATCH_FLUSH %d targets', len(self._batched))
+        batched = self._batched
+        self._batched = {}
+        for target in batched:
+            self._schedule(target)
+        if self._queue and not self._processing:
+            self.process_events()
+
+    def _schedule(self, target):
+        """Queue all watchers of ``target`` to be run by ``process_events``.
+
+        A watcher that is already waiting in the queue is not queued again.
+        Watchers are run in the order of their height in the dependency graph
+        (a watchset that reads only targets nobody assigns to has height 0,
+        one that reads their results has height 1, etc.), so that a watcher
+        normally runs only after all its inputs have settled and only once
+        per wave of changes."""
+        self.trans_stats['events_queued'] += 1
+        watchers = self._watchers.get(target, None)
+        if not watchers: return
+        for ident in watchers:
+            if ident in self._queued:
+                self.trans_stats['events_coalesced'] += 1
+            else:
+                self._queue_seq += 1
+                heapq.heappush(self._queue, (self._heights.get(ident, 0), self._queue_seq, ident))
+            self._queued[ident] = target
+
     def notify_change(self, target, external=True):
+        target = self._target(target)
         logger.debug('NOTIFY_%s %r in_trans=%d processing=%d',
                 'EXT' if external else 'INT', target, self.in_transaction,
                 self._processing)
         if target in self._inhibit_cnt:
             logger.debug('...inhibit')
+            self.stats['echo_suppressed'] += 1
+            return
+        if external and self._batch_depth:
+            if target in self._batched:
+                self.stats['batch_coalesced'] += 1
+            else:
+                self._batched[target] = True
             return
-        self._queue.append(target)
-        if not self._processing:
+        self._schedule(target)
+        if self._queue and not self._processing:
             self.process_events()
 
-    def add_watchset(self, targets, func, ident=None):
+    def add_watchset(self, targets, func, ident=None, owner=None):
+        """Call ``func(target)`` whenever any of ``targets`` changes.
+
+        If a watchset with the same ident already exists, it is replaced.
+        Only the difference against the previous set of targets is applied,
+        so re-registering an unchanged watchset (as directives do every time
+        they are re-evaluated) is cheap.
+
+        ``owner`` is the ident of the value (see ``add_value``) computed
+        by the watcher, if it differs from ``ident``, e.g. when separate
+        parts of the value are watched separately. The height of the value
+        is then the maximum of the heights of all the owner's watchsets."""
         logger.debug('ADD_WATCHSET %s %s %s', targets, func, ident)
         if ident is None: ident = self.new_id()
-        if ident in self._watchsets: self.remove_watchset(ident)
+        new = {}
         for target in targets:
-            obj, *sub = target
+            new[self._target(target)] = True
+        old = self._watchsets.get(ident)
+        if old is not None:
+            # Watchsets are stored as tuples, which are much smaller than
+            # dicts. Most of them are short enough to be searched linearly.
+            if len(old) > 8: old = dict.fromkeys(old)
+            for target in old:
+                if target not in new:
+                    self._unwatch(target, ident)
+        height = 0
+        for target in new:
+            height = max(height, self._target_heights.get(target, -1) + 1)
+            if old is not None and target in old: continue
+            obj = target.obj
             if isinstance(obj, ObjectWrapper): raise TypeError("Cannot track ``ObjectWrapper``s")
-            self._watchers.setdefault(target, collections.OrderedDict())[ident] = func
-            if isinstance(obj, RuleAbider):
-                obj._rbk_trackers.add(self.notify_change)
-            else:
-                logger.warn("Cannot track %r", target)
-        self._watchsets[ident] = targets
+            watchers = self._watchers.get(target)
+            if watchers is None:
+                watchers = self._watchers[target] = {}
+                if isinstance(obj, AbiderBase):
+                    obj._rbk_subscribe((target.subtype, target.subname), self.notify_change)
+                else:
+                    logger.warn("Cannot track %r", target)
+            watchers[ident] = True
+        self._watchsets[ident] = tuple(new)
+        self._watch_funcs[ident] = func
+        self._heights[ident] = height
+        if owner is not None:
+            self._watch_owners[ident] = owner
+            self._owned_watchsets.setdefault(owner, {})[ident] = True
+            self._update_owner_height(owner)
+        else:
+            owner = ident
+        target = self._value_targets.get(owner)
+        if target is not None:
+            self._raise_height(target, self._value_height(owner))
+        return ident
+
+    def _value_height(self, ident):
+        """Return the height of the value with the given ident (see ``add_watchset``)."""
+        height = self._owner_heights.get(ident)
+        if height is None: height = self._heights.get(ident, 0)
+        return height
+
+    def _raise_height(self, target, height):
+        """Make the height of ``target`` at least ``height`` and propagate
+        the change to everything computed from it.
+
+        Heights only ever grow: a rule may be registered before the rules
+        computing its inputs, so the heights of its watchsets (and of the
+        targets it assigns to) are raised when theirs are. Rulebooks with
+        cyclic dependencies have no proper heights, so the propagation stops
+        at the number of watchsets (the height of the longest acyclic chain
+        cannot be larger)."""
+        limit = len(self._watchsets)
+        stack = [(target, height)]
+        while stack:
+            target, height = stack.pop()
+            if height <= self._target_heights.get(target, -1) or height > limit:
+                continue
+            self._target_heights[target] = height
+            for ident in self._watchers.get(target, ()):
+                if self._heights[ident] > height: continue
+                self._heights[ident] = height + 1
+                owner = self._watch_owners.get(ident)
+                if owner is None:
+                    owner = ident
+                else:
+                    self._update_owner_height(owner)
+                value_target = self._value_targets.get(owner)
+                if value_target is not None:
+                    stack.append((value_target, self._value_height(owner)))
+
+    def _update_owner_height(self, owner):
+        owned = self._owned_watchsets.get(owner)
+        if owned:
+            self._owner_heights[owner] = max( self._heights[ident] for ident in owned )
+        else:
+            self._owned_watchsets.pop(owner, None)
+            self._owner_heights.pop(owner, None)
+
+    def _unwatch(self, target, ident):
+        watchers = self._watchers.get(target, None)
+        if watchers is None: return
+        watchers.pop(ident, None)
+        if not watchers:
+            del self._watchers[target]
+            obj = target.obj
+            if isinstance(obj, AbiderBase):
+                obj._rbk_unsubscribe((target.subtype, target.subname), self.notify_change)
 
     def remove_watchset(self, ident):
         if ident not in self._watchsets: return
         for target in self._watchsets[ident]:
-            try: del self._watchers[target][ident]
-            except KeyError: pass
+            self._unwatch(target, ident)
         del self._watchsets[ident]
+        del self._watch_funcs[ident]
+        del self._heights[ident]
+        owner = self._watch_owners.pop(ident, None)
+        if owner is not None:
+            del self._owned_watchsets[owner][ident]
+            self._update_owner_height(owner)
 
     ### }}} ###
 
 class Namespace(RuleAbider):
+    # Names bound statically by the loaded rulebooks, see ``Context.declare_static``
+    _rbk_static = frozenset()
+
     def __getattr__(self, name):
         return getattr(builtins, name)
+    def __setattr__(self, name, val):
+        if name in self._rbk_static:
+            logger.warning("Setting %r in the namespace does not affect rulebooks, which use"
+                           " the builtin of the same name (see doc/design/names.md)", name)
+        super().__setattr__(name, val)
     def __repr__(self):
         return 'N'
 
-class NamespaceOverlay(object):
+class NamespaceOverlay(AbiderBase):
+    """The namespace of a ``for`` body: the loop variables in `overlay`
+    (a dict), everything else from `base`.
+
+    Reads of the loop variables are tracked, so that the body can be
+    reused for another item using ``rebind``."""
+    __slots__ = ('_ctx', '_base', '_overlay', '_rbk_subs', '_rbk_trackers', '__weakref__')
+
     def __init__(self, ctx, base, overlay):
         super().__init__()
+        self._rbk_subs = None
+        self._rbk_trackers = ()
         self._ctx = ctx
         self._base = base
         self._overlay = overlay
@@ -365,6 +1149,8 @@ class NamespaceOverlay(object):
     def __getattr__(self, name):
         if name.startswith('_'): raise AttributeError(name)
         if name in self._overlay:
+            if self._ctx._readtrack_stack:
+                self._ctx._report_read(Target.get(self, 'attr', name))
             return self._ctx._wrap(self._overlay[name])
         else:
             return self._ctx._wrap(getattr(self._base, name))
@@ -378,6 +1164,15 @@ class NamespaceOverlay(object):
             setattr(self._base, name, value)
         #self._changed(name)
 
+    def rebind(self, other):
+        """Take over the loop variables of `other` (an overlay created for
+        another item by the same loop) and notify the directives that read
+        the ones that changed."""
+        old, self._overlay = self._overlay, other._overlay
+        for name, val in self._overlay.items():
+            if old.get(name, NOTHING) is not val:
+                self._changed(name)
+
 class LocalNamespace(object):
     def __init__(self, ctx, base):
         self._ctx = ctx
@@ -402,9 +1197,18 @@ class LocalNamespace(object):
 
 
 class Directive(WithFields):
-    def __init__(self, ctx, *args, **kw):
+    # A rulebook instantiates a directive for every rule and every iteration
+    # of every ``for`` loop, so the built-in directives store their fields
+    # and state in ``__slots__``. Subclasses without ``__slots__`` (e.g. custom
+    # directives) simply get a ``__dict__``.
+    __slots__ = ('ctx', 'key', 'active', 'c_active')
+
+    def __init__(self, ctx, *args, key=None, **kw):
         super().__init__(*args, **kw)
         self.ctx = ctx
+        # A fingerprint of the directive's source generated by the compiler,
+        # see ``reconcile``. Directives without a key are never matched.
+        self.key = key
         # (in)active state as seen by the current transaction (if any, committed state otherwise)
         self.active = False
         # (in)active state as last committed
@@ -432,20 +1236,75 @@ class Directive(WithFields):
             self._commit()
             self.c_active = self.active
 
+    def matches(self, new):
+        """Can this directive be kept in place of `new` (compiled from a newer
+        version of the rulebook) when reloading?"""
+        return type(self) is type(new) and self.key is not None and self.key == new.key
+
+    def reconcile(self, new):
+        """Update this directive to the newer version `new`, which it ``matches``.
+
+        The directive itself stays as it is (including its values and watchsets),
+        only its nested directives that changed are replaced by their new
+        versions. Must be called within a transaction."""
+        pass
+
+def _reconcile_child(old, new, active):
+    """Return the directive to be used in place of `old` when reloading: `old`
+    itself updated to `new` if they match, otherwise `new`, activated if `active`."""
+    if old is not None and new is not None and old.matches(new):
+        old.reconcile(new)
+        return old
+    if old is not None:
+        old.set_active(False)
+    if new is not None and active:
+        new.set_active(True)
+    return new
+
 # Try to keep fields names in sync with the AST!
 
 class Block(Directive):
+    __slots__ = ('body',)
     FIELDS_REQ = ['body']
     def _set_active(self, active):
-        if active:
-            for directive in self.body:
-                directive.set_active(True)
-        else:
-            for directive in reversed(self.body):
+        with self.ctx.bulk():
+            if active:
+                for directive in self.body:
+                    directive.set_active(True)
+            else:
+                for directive in reversed(self.body):
+                    directive.set_active(False)
+
+    def reconcile(self, new):
+        # Match the directives by key. If there are multiple directives with the
+        # same key (i.e. duplicate rules), they are matched in order.
+        old_by_key = {}
+        for directive in self.body:
+            if directive.key is not None:
+                old_by_key.setdefault((type(directive), directive.key), []).append(directive)
+        body = []
+        added = []
+        for directive in new.body:
+            candidates = old_by_key.get((type(directive), directive.key))
+            if candidates:
+                old = candidates.pop(0)
+                old.reconcile(directive)
+                body.append(old)
+            else:
+                body.append(directive)
+                added.append(directive)
+        kept = set(map(id, body))
+        for directive in reversed(self.body):
+            if id(directive) not in kept:
                 directive.set_active(False)
+        self.body = body
+        if self.active:
+            for directive in added:
+                directive.set_active(True)
 
 
 class If(Directive):
+    __slots__ = ('cond', 'body', 'orelse')
     FIELDS_REQ = ['cond', 'body']
     FIELDS_OPT = ['orelse']
     def _set_active(self, active):
@@ -467,51 +1326,202 @@ class If(Directive):
         if self.orelse:
             self.orelse.set_active(not val)
 
+    def reconcile(self, new):
+        # The condition is the same, so is its value.
+        val = self.active and self.body.active
+        self.body = _reconcile_child(self.body, new.body, val)
+        self.orelse = _reconcile_child(self.orelse, new.orelse, self.active and not val)
+
+class Lazy(Directive):
+    """A directive built by ``factory()`` on its first activation.
+
+    The compiler wraps the bodies of ``if`` and ``else`` in it, so that
+    branches that are never taken cost neither time nor memory. When
+    ``ctx.LAZY_IDLE_TIMEOUT`` is set, the directive is dropped again after
+    staying inactive for that long (see ``Context.evict_idle``)."""
+    __slots__ = ('factory', 'directive', '__weakref__')
+    FIELDS_REQ = ['factory']
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.directive = None
+
+    def _set_active(self, active):
+        if active:
+            if self.directive is None:
+                self.directive = self.factory()
+                self.ctx.stats['lazy_built'] += 1
+            self.directive.set_active(True)
+        elif self.directive is not None:
+            self.directive.set_active(False)
+
+    def _commit(self):
+        if self.active:
+            self.ctx._idle_lazy.pop(self, None)
+        elif self.ctx.LAZY_IDLE_TIMEOUT is not None:
+            self.ctx._idle_lazy[self] = time.monotonic()
+
+    def evict(self):
+        """Drop the directive if inactive, it will be rebuilt when needed."""
+        if self.active or self.directive is None: return
+        self.directive = None
+        self.ctx.stats['lazy_evicted'] += 1
+
+    def reconcile(self, new):
+        self.factory = new.factory
+        if self.directive is not None:
+            self.directive = _reconcile_child(self.directive, new.factory(), self.active)
+
 class For(Directive):
-    FIELDS_REQ = ['iter', 'body_factory']
+    """Keeps a copy of the body active for every item of `iter`.
+
+    ``bind(item)`` returns the namespace of the body for an item (a
+    ``NamespaceOverlay`` binding the loop variables) and ``body_factory(ns)``
+    creates the body in it. When `iter` changes, the items are matched to
+    the existing bodies by identity or, if `item_key` is given, by the value
+    of ``item_key(ns)`` (``for dev in devices key dev.name:``). A body whose
+    key now belongs to a different object is kept, only its loop variables
+    are rebound. If more items have the same key, the last one is used.
+
+    Changes of a ``TrackedCollection`` iterated directly (``for x in lst:``)
+    are applied incrementally, using the added and removed items reported
+    by the collection (this is not done for loops with `item_key`).
+    """
+    __slots__ = ('iter', 'bind', 'body_factory', 'item_key', 'cur_items', 'cur_coll', 'pending', 'counts')
+    FIELDS_REQ = ['iter', 'bind', 'body_factory']
+    FIELDS_OPT = ['item_key']
 
     def __init__(self, *a, **kw):
         super().__init__(*a, **kw)
+        # key -> (item, ns, body)
         self.cur_items = {}
+        # The collection whose changes are applied incrementally, the changes
+        # not applied yet and the number of occurences of each item in it
+        self.cur_coll = None
+        self.pending = []
+        self.counts = None
 
     def _set_active(self, active):
         if active:
             self._on_changed(activating=True)
         else:
             self.ctx.remove_watchset(id(self))
+            self.ctx.remove_watchset((id(self), 'items'))
+            self._listen(None)
             self._set_items([])
 
     def _on_changed(self, *a, activating=False):
         if not (self.active or activating): return
-        val, deps = self.ctx.tracked_eval(self.iter)
-        if isinstance(self.ctx._unwrap(val), RuleAbider):
-            deps.append((self.ctx._unwrap(val), 'iter', None))
+        # The keys are evaluated together with `iter`, so that the loop
+        # is re-evaluated when they change.
+        with self.ctx.track_reads() as reads:
+            val = self.iter()
+            items = self._key_items(val)
+        deps = list(reads.keys())
+        coll = self.ctx._unwrap(val)
+        if isinstance(coll, TrackedCollection) and self.item_key is None:
+            # Changes of the collection are watched separately, see ``_apply_deltas``
+            iter_target = Target.get(coll, 'iter', None)
+            deps = [ target for target in deps if target is not iter_target ]
+            self._listen(coll)
+            self.pending = []
+            self.counts = collections.Counter(map(id, coll))
+            self.ctx.add_watchset([iter_target], self._apply_deltas, (id(self), 'items'))
+        else:
+            self._listen(None)
+            self.ctx.remove_watchset((id(self), 'items'))
+            if isinstance(coll, AbiderBase):
+                deps.append((coll, 'iter', None))
 
-        self._set_items(val)
+        self._set_items(items)
         self.ctx.add_watchset(deps,    self._on_changed, id(self))
 
+    def _listen(self, coll):
+        if coll is self.cur_coll: return
+        if self.cur_coll is not None:
+            self.cur_coll._rbk_unlisten(self._on_delta)
+        self.cur_coll = coll
+        self.pending = []
+        self.counts = None
+        if coll is not None:
+            coll._rbk_listen(self._on_delta)
+
+    def _on_delta(self, added, removed):
+        # Called immediately by the collection, the changes are applied
+        # when the change of its ``('iter', None)`` is processed.
+        self.pending.append((added, removed))
+
+    def _apply_deltas(self, *a):
+        if not self.active: return
+        pending, self.pending = self.pending, []
+        counts, cur_items = self.counts, self.cur_items
+        with self.ctx.bulk():
+            for added, removed in pending:
+                for item in added:
+                    key = id(item)
+                    counts[key] += 1
+                    if counts[key] == 1:
+                        self._add_item(key, item)
+                for item in removed:
+                    key = id(item)
+                    counts[key] -= 1
+                    if not counts[key]:
+                        del counts[key]
+                        cur_items.pop(key)[2].set_active(False)
+        self.ctx.stats['for_deltas'] += len(pending)
+
+
+    def reconcile(self, new):
+        self.bind, self.body_factory, self.item_key = new.bind, new.body_factory, new.item_key
+        for key, (item, ns, body) in list(self.cur_items.items()):
+            self.cur_items[key] = item, ns, _reconcile_child(body, self.body_factory(ns), body.active)
+
+    def _key_items(self, items):
+        """Return ``{key: (item, ns)}`` for the (possibly wrapped) items. Without
+        `item_key`, `ns` is None, it is only created for items that are new."""
+        unwrap = self.ctx._unwrap
+        if self.item_key is None:
+            return { id(item): (item, None) for item in map(unwrap, items) }
+        ctx = self.ctx
+        r = {}
+        for item in map(unwrap, items):
+            ns = self.bind(item)
+            with ctx.track_reads() as reads:
+                key = unwrap(self.item_key(ns))
+            # Only record the reads of the item, the temporary overlay never changes
+            for target in reads:
+                if target.obj is not ns:
+                    ctx._report_read(target)
+            r[key] = item, ns
+        return r
 
     def _set_items(self, items):
-        items = [ self.ctx._unwrap(x) for x in items ]
-        by_id = { id(x): x for x in items }
-        new_ids = set(by_id.keys())
-        old_ids = set(self.cur_items.keys())
-
-        added = new_ids - old_ids
-        removed = old_ids - new_ids
-
-        for add_id in added:
-            item = by_id[add_id]
-            body = self.body_factory(item)
-            body.set_active(True)
-            self.cur_items[add_id] = item, body
-
-        for rm_id in removed:
-            item, body = self.cur_items[rm_id]
-            body.set_active(False)
-            del self.cur_items[rm_id]
+        if not isinstance(items, dict):
+            items = self._key_items(items)
+        cur_items = self.cur_items
+        with self.ctx.bulk():
+            for key, (item, ns) in items.items():
+                cur = cur_items.get(key)
+                if cur is None:
+                    self._add_item(key, item, ns)
+                elif cur[0] is not item:
+                    cur_ns = cur[1]
+                    cur_ns.rebind(ns if ns is not None else self.bind(item))
+                    cur_items[key] = item, cur_ns, cur[2]
+                    self.ctx.stats['for_rebound'] += 1
+
+            for key in [ key for key in cur_items if key not in items ]:
+                item, ns, body = cur_items.pop(key)
+                body.set_active(False)
+
+    def _add_item(self, key, item, ns=None):
+        if ns is None: ns = self.bind(item)
+        body = self.body_factory(ns)
+        body.set_active(True)
+        self.cur_items[key] = item, ns, body
 
 class EnterLeave(Directive):
+    __slots__ = ('event', 'body')
     FIELDS_REQ = ['event', 'body']
 
     def _set_active(self, active):
@@ -576,17 +1586,34 @@ class OnChange(Directive):
         self.cur_obj = weakref.ref(obj)
 
 class Assign(Directive):
+    __slots__ = ('obj', 'subtype', 'subval', 'rhs', 'prio', 'comb', 'cur_obj', 'cur_val', 'cur_prio')
     FIELDS_REQ = ['obj', 'subtype', 'subval', 'rhs', 'prio']
     FIELDS_OPT = ['comb']
-    cur_obj = None
-    comb = None
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.cur_obj = None
+        # The current values of the RHS and priority
+        self.cur_val = None
+        self.cur_prio = 0
+
+    # The object, the value and the priority are evaluated and watched separately,
+    # so that e.g. a change of a dependency of the RHS does not re-evaluate the
+    # (possibly expensive) LHS object and priority expressions. The watchset
+    # idents are ``(id(self), part)``, the value set ident is ``id(self)``.
 
     def _set_active(self, active):
         logger.debug('%s %s', 'ACTIVATE' if active else 'DEACTIVATE', self)
         if active:
-            self._on_changed(activating=True)
+            self.cur_val = self._eval('rhs', self.rhs, self._rhs_changed)
+            if self.prio:
+                self.cur_prio = self._eval('prio', self.prio, self._prio_changed)
+            self._set_obj(self._eval('obj', self.obj, self._obj_changed))
         else:
             self._unset()
+            for part in ('obj', 'rhs', 'prio'):
+                self.ctx.remove_watchset((id(self), part))
+            self.cur_val = None
 
     def _commit(self):
         # Do not have to do anything. Value sets are committed separately.
@@ -597,44 +1624,54 @@ class Assign(Directive):
         # we call explicit setters).
         pass
 
+    def _eval(self, part, expr, func):
+        """Evaluate one part of the assignment and (re)register its watchset."""
+        if type(expr) is Constant:
+            return self.ctx._unwrap(expr.value)
+        val, deps = self.ctx.tracked_eval(expr)
+        self.ctx.add_watchset(deps, func, (id(self), part), owner=id(self))
+        return self.ctx._unwrap(val)
+
+    def _get_obj(self):
+        return None if self.cur_obj is None else self.cur_obj()
+
+    def _set_obj(self, obj):
+        self.cur_obj = weakref.ref(obj)
+        self._update_value()
+
+    def _update_value(self):
+        obj = self._get_obj()
+        if obj is None: return
+        self.ctx.add_value((obj, self.subtype, self.subval), self.cur_val, self.cur_prio,
+                           id(self), comb=self.comb)
+
     def _unset(self):
         logger.debug('UNSET %s', self)
-        if self.cur_obj is None: return
-        cur_obj = self.cur_obj()
+        cur_obj = self._get_obj()
+        self.cur_obj = None
         if cur_obj is None: return
         target = (cur_obj, self.subtype, self.subval)
         logger.debug('UNSET2 %s', target)
         self.ctx.remove_value(target, id(self))
-        self.ctx.remove_watchset(id(self))
-        self.cur_obj = None
 
-    def _on_changed(self, *a, activating=False):
-        if not (self.active or activating): return
-        obj, obj_deps = self.ctx.tracked_eval(self.obj)
-        val, val_deps    = self.ctx.tracked_eval(self.rhs)
-        if isinstance(obj, ObjectWrapper):
-            obj = obj._rbk_obj
-        if isinstance(val, ObjectWrapper):
-            val = val._rbk_obj
-        if self.prio:
-            prio, prio_deps    = self.ctx.tracked_eval(self.prio)
-        else:
-            prio, prio_deps = 0, []
-
-        if self.cur_obj is None: cur_obj = None
-        else: cur_obj = self.cur_obj()
-
-        logger.debug('CHANGED %s %s %s', self, cur_obj, obj)
-
-        if obj is not cur_obj:
-            # LHS changed, we must remove the attribute from the old object
-            # in addition to setting it on the new one
-            self._unset()
-
-        target = (obj, self.subtype, self.subval)
-        self.ctx.add_value(target, val, prio, id(self), comb=self.comb)
-        self.ctx.add_watchset(obj_deps + val_deps + prio_deps, self._on_changed, id(self))
-        self.cur_obj = weakref.ref(obj)
+    def _obj_changed(self, *a):
+        if not self.active: return
+        obj = self._eval('obj', self.obj, self._obj_changed)
+        logger.debug('CHANGED_OBJ %s %s %s', self, self._get_obj(), obj)
+        if obj is self._get_obj(): return
+        # LHS changed, move the value from the old object to the new one
+        self._unset()
+        self._set_obj(obj)
+
+    def _rhs_changed(self, *a):
+        if not self.active: return
+        self.cur_val = self._eval('rhs', self.rhs, self._rhs_changed)
+        self._update_value()
+
+    def _prio_changed(self, *a):
+        if not self.active: return
+        self.cur_prio = self._eval('prio', self.prio, self._prio_changed)
+        self._update_value()
 
 class _LambdaWithSource:
     """A helper for more helpful repr() of rulebook lambdas when debugging.
@@ -660,4 +1697,17 @@ class _LambdaWithSource:
     def __repr__(self):
         return '<L:%s>' % self.src
 
+class Constant(object):
+    """A directive argument known at compile time not to depend on anything
+    (e.g. the literal in ``x = 42 prio 5``). It is called like the lambdas
+    generated for other expressions, but directives evaluate it without
+    read tracking and do not register a watchset for it."""
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+    def __call__(self):
+        return self.value
+    def __repr__(self):
+        return '<C:%r>' % (self.value,)
+
 ### DIRECTIVES WITHOUT A SPECIAL SYNTAX (used with CustomDirective) ###
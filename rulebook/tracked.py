@@ -0,0 +1,301 @@
+"""Collections whose changes can be tracked by a rulebook.
+
+``TrackedList``, ``TrackedDict`` and ``TrackedSet`` behave like their builtin
+counterparts, but notify the trackers subscribed to them (see ``AbiderBase``)
+about every change. Each kind of change is reported separately, so that
+a rule is only re-evaluated when what it read changes (see ``ObjectWrapper``):
+
+  * ``('iter', None)`` when anything iteration could observe changes
+    (the contents, the order of a list or the values of a dict),
+  * ``('len', None)`` when the length changes,
+  * ``('keys', None)`` when the set of keys of a dict or the members
+    of a set change,
+  * ``('contains', value)`` when `value` is added or removed (for lists,
+    when an occurence of it is),
+  * ``('item', key)`` when the item with the given index or key changes.
+
+In addition, delta listeners (``_rbk_listen``) are told which items started
+or stopped being yielded by iteration. This allows a ``for`` loop over a large
+collection to update only the bodies of the changed items (see ``runtime.For``).
+"""
+from itertools import chain
+from .abider import AbiderBase
+from .util import NOTHING
+
+ITER = ('iter', None)
+LEN = ('len', None)
+KEYS = ('keys', None)
+
+class TrackedCollection(AbiderBase):
+    __slots__ = ()
+    # Are changes of ``('keys', None)`` reported?
+    _KEYED = False
+    # Membership changes are reported as ``('contains', value)`` by ``_delta``
+    _ITEMS_IMPLY_CONTAINS = False
+    # Methods reading the collection and the kind of change they depend
+    # on (see ``ObjectWrapper.__getattr__``). 'item' depends on the item
+    # given by the first argument.
+    READ_METHODS = {'copy': 'iter'}
+
+    def __new__(cls, *a, **kw):
+        self = super().__new__(cls, *a, **kw)
+        self._rbk_subs = None
+        self._rbk_trackers = ()
+        self._rbk_listeners = None
+        return self
+
+    def _rbk_listen(self, listener):
+        """Call ``listener(added, removed)`` with the lists of items added
+        to and removed from the collection on every change."""
+        if self._rbk_listeners is None:
+            self._rbk_listeners = []
+        self._rbk_listeners.append(listener)
+
+    def _rbk_unlisten(self, listener):
+        if self._rbk_listeners and listener in self._rbk_listeners:
+            self._rbk_listeners.remove(listener)
+
+    def _delta(self, added=(), removed=()):
+        if self._rbk_listeners:
+            for listener in list(self._rbk_listeners):
+                listener(added, removed)
+        if not (self._rbk_subs or self._rbk_trackers): return
+        changed = self._changed
+        if len(added) != len(removed):
+            changed(LEN)
+        if self._KEYED and (added or removed):
+            changed(KEYS)
+        for val in chain(added, removed):
+            try:
+                changed(('contains', val))
+            except TypeError:
+                pass # Unhashable values cannot be watched
+        changed(ITER)
+
+    def _changed_items(self, keys):
+        for key in keys:
+            self._changed(('item', key))
+
+_SLOTS = ('_rbk_subs', '_rbk_trackers', '_rbk_listeners', '__weakref__')
+
+class TrackedList(TrackedCollection, list):
+    __slots__ = _SLOTS
+    READ_METHODS = {'copy': 'iter', 'count': 'iter', 'index': 'iter'}
+
+    def _changed_from(self, start):
+        """Notify the watchers of all indices >= `start` (and all negative ones),
+        whose items shift when the length of the list changes."""
+        subs = self._rbk_subs
+        if not subs: return
+        self._changed_items([ key for kind, key in list(subs) if kind == 'item'
+                                and type(key) is int and (key < 0 or key >= start) ])
+
+    def _index(self, idx):
+        return idx + len(self) if idx < 0 else idx
+
+    def __setitem__(self, idx, val):
+        if isinstance(idx, slice):
+            val = list(val)
+            old = list.__getitem__(self, idx)
+            start = min(idx.indices(len(self))[:2])
+            list.__setitem__(self, idx, val)
+            self._changed_from(start)
+            self._delta(val, old)
+        else:
+            old = list.__getitem__(self, idx)
+            list.__setitem__(self, idx, val)
+            self._changed_items([self._index(idx), self._index(idx) - len(self)])
+            self._delta([val], [old])
+
+    def __delitem__(self, idx):
+        old = list.__getitem__(self, idx)
+        if isinstance(idx, slice):
+            start = min(idx.indices(len(self))[:2])
+        else:
+            start, old = self._index(idx), [old]
+        list.__delitem__(self, idx)
+        self._changed_from(start)
+        self._delta((), old)
+
+    def append(self, val):
+        list.append(self, val)
+        self._changed_from(len(self) - 1)
+        self._delta([val])
+
+    def extend(self, vals):
+        start = len(self)
+        list.extend(self, vals)
+        self._changed_from(start)
+        self._delta(list.__getitem__(self, slice(start, None)))
+
+    def __iadd__(self, vals):
+        self.extend(vals)
+        return self
+
+    def __imul__(self, n):
+        old = list(self)
+        list.__imul__(self, n)
+        self._changed_from(0)
+        self._delta(list.__getitem__(self, slice(len(old), None)), old[len(self):])
+        return self
+
+    def insert(self, idx, val):
+        start = min(self._index(idx), len(self)) if idx >= -len(self) else 0
+        list.insert(self, idx, val)
+        self._changed_from(start)
+        self._delta([val])
+
+    def pop(self, idx=-1):
+        start = self._index(idx)
+        val = list.pop(self, idx)
+        self._changed_from(start)
+        self._delta((), [val])
+        return val
+
+    def remove(self, val):
+        start = self.index(val)
+        list.__delitem__(self, start)
+        self._changed_from(start)
+        self._delta((), [val])
+
+    def clear(self):
+        old = list(self)
+        list.clear(self)
+        self._changed_from(0)
+        self._delta((), old)
+
+    def sort(self, *a, **kw):
+        list.sort(self, *a, **kw)
+        self._changed_from(0)
+        self._delta()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed_from(0)
+        self._delta()
+
+class TrackedDict(TrackedCollection, dict):
+    """A tracked dict. Iteration yields the keys, so only adding and removing
+    keys is reported to the delta listeners."""
+    __slots__ = _SLOTS
+    _KEYED = True
+    READ_METHODS = {'copy': 'iter', 'keys': 'keys', 'values': 'iter', 'items': 'iter', 'get': 'item'}
+
+    def __setitem__(self, key, val):
+        new = key not in self
+        dict.__setitem__(self, key, val)
+        self._changed(('item', key))
+        if new: self._delta([key])
+        else: self._changed(ITER)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._changed(('item', key))
+        self._delta((), [key])
+
+    def pop(self, key, default=NOTHING):
+        if key not in self:
+            if default is NOTHING: raise KeyError(key)
+            return default
+        val = dict.pop(self, key)
+        self._changed(('item', key))
+        self._delta((), [key])
+        return val
+
+    def popitem(self):
+        key, val = dict.popitem(self)
+        self._changed(('item', key))
+        self._delta((), [key])
+        return key, val
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *a, **kw):
+        for key, val in dict(*a, **kw).items():
+            self[key] = val
+
+    def clear(self):
+        old = list(self)
+        dict.clear(self)
+        self._changed_items(old)
+        self._delta((), old)
+
+class TrackedSet(TrackedCollection, set):
+    # Sets are weakly referenceable already
+    __slots__ = _SLOTS[:-1]
+    _KEYED = True
+    READ_METHODS = dict.fromkeys(['copy', 'isdisjoint', 'issubset', 'issuperset', 'union',
+                                  'intersection', 'difference', 'symmetric_difference'], 'iter')
+
+    def _apply(self, added, removed):
+        if added or removed:
+            self._delta(added, removed)
+
+    def add(self, val):
+        if val in self: return
+        set.add(self, val)
+        self._apply([val], [])
+
+    def discard(self, val):
+        if val not in self: return
+        set.discard(self, val)
+        self._apply([], [val])
+
+    def remove(self, val):
+        set.remove(self, val)
+        self._apply([], [val])
+
+    def pop(self):
+        val = set.pop(self)
+        self._apply([], [val])
+        return val
+
+    def clear(self):
+        old = list(self)
+        set.clear(self)
+        self._apply([], old)
+
+    def update(self, *others):
+        for other in others:
+            added = [ val for val in set(other) if val not in self ]
+            set.update(self, added)
+            self._apply(added, [])
+
+    def difference_update(self, *others):
+        for other in others:
+            removed = [ val for val in set(other) if val in self ]
+            set.difference_update(self, removed)
+            self._apply([], removed)
+
+    def intersection_update(self, *others):
+        keep = set.intersection(self, *others)
+        removed = [ val for val in self if val not in keep ]
+        set.difference_update(self, removed)
+        self._apply([], removed)
+
+    def symmetric_difference_update(self, other):
+        other = set(other)
+        removed = [ val for val in other if val in self ]
+        added = [ val for val in other if val not in self ]
+        set.difference_update(self, removed)
+        set.update(self, added)
+        self._apply(added, removed)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __isub__(self, other):
+        self.difference_update(other)
+        return self
+
+    def __iand__(self, other):
+        self.intersection_update(other)
+        return self
+
+    def __ixor__(self, other):
+        self.symmetric_difference_update(other)
+        return self
@@ -1,6 +1,8 @@
 import sys, os
 import itertools
 import collections
+import weakref
+from functools import partial
 
 debug_enabled = os.environ.get('RULEBOOK_DEBUG')
 if debug_enabled:
@@ -22,6 +24,9 @@ if debug_enabled:
 else:
     debug = lambda *a,**kw: None
 
+# A placeholder for "no value" where None is a valid value
+NOTHING = object()
+
 class LateBindingProperty(property):
     """An unrelated but useful piece of code. Allows the following use case:
         class A(object):
@@ -56,6 +61,8 @@ class LateBindingProperty(property):
 
 
 class WithFields(object):
+    # Subclasses may store the fields in ``__slots__``
+    __slots__ = ()
     FIELDS_REQ = []
     FIELDS_OPT = []
     @property
@@ -68,7 +75,8 @@ class WithFields(object):
             if fld not in data:
                 raise ValueError("Field %s required for nodes of type %s"%(fld,
                     type(self).__name__))
-        self.__dict__.update(data)
+        for fld, val in data.items():
+            setattr(self, fld, val)
 
     def __repr__(self):
         return '%s(%s)'%( type(self).__name__, ', '.join([ repr(getattr(self, x)) for x in self.FIELDS ]) )
@@ -163,3 +171,85 @@ class ObjectKeyDict(collections.MutableMapping):
         return len(self._data)
 
     # TODO implement more ``dict`` methods as needed.
+
+class Target(object):
+    """Something a rulebook can read, assign to and watch for changes: an attribute
+    (``Target(obj, 'attr', 'name')``) or an item (``Target(obj, 'item', key)``)
+    of an object, or some other aspect of it (e.g. ``Target(obj, 'iter', None)``).
+
+    Targets are interned: as long as a target is referenced from somewhere,
+    ``Target.get`` returns the very same object for the same ``obj`` (compared
+    by identity), ``subtype`` and ``subname`` (compared by value). Therefore
+    targets are hashed and compared by identity and looking them up in
+    a dict is a single probe, unlike the ``(obj, subtype, subname)`` tuples
+    they replace (see ``ObjectKeyDict``). Unpacking them like these tuples
+    still works.
+
+    A target only holds a weak reference to its object (if the object supports
+    them), so that tables indexed by targets do not keep objects alive. Once the
+    object dies, ``obj`` becomes None and all objects registered using
+    ``add_death_listener`` get their ``_target_died(target)`` method called.
+    """
+    __slots__ = ('_ref', 'subtype', 'subname', '__weakref__')
+    # (id(obj), subtype, subname) -> weakref to the Target. The entry is removed
+    # when the object dies, so a reused ``id`` never finds a stale target.
+    _interned = {}
+    _death_listeners = weakref.WeakSet()
+
+    @classmethod
+    def get(cls, obj, subtype, subname):
+        key = (id(obj), subtype, subname)
+        ref = cls._interned.get(key)
+        if ref is not None:
+            target = ref()
+            if target is not None:
+                return target
+        target = object.__new__(cls)
+        target.subtype = subtype
+        target.subname = subname
+        tref = weakref.ref(target, partial(_forget_target, key))
+        try:
+            target._ref = weakref.ref(obj, partial(_target_obj_died, key, tref))
+        except TypeError:
+            # Not weakreffable (e.g. list, dict), keep a strong reference.
+            target._ref = partial(_identity, obj)
+        cls._interned[key] = tref
+        return target
+
+    @classmethod
+    def add_death_listener(cls, listener):
+        cls._death_listeners.add(listener)
+
+    def __new__(cls, obj, subtype, subname):
+        return cls.get(obj, subtype, subname)
+
+    @property
+    def obj(self):
+        return self._ref()
+
+    def __iter__(self):
+        return iter((self._ref(), self.subtype, self.subname))
+
+    def __getitem__(self, idx):
+        return (self._ref(), self.subtype, self.subname)[idx]
+
+    def __reduce__(self):
+        return (Target, (self._ref(), self.subtype, self.subname))
+
+    def __repr__(self):
+        return 'Target(%r, %r, %r)' % (self._ref(), self.subtype, self.subname)
+
+def _identity(obj):
+    return obj
+
+def _forget_target(key, ref):
+    # Do not drop a newer target interned under the same key in the meantime.
+    if Target._interned.get(key) is ref:
+        del Target._interned[key]
+
+def _target_obj_died(key, tref, objref):
+    _forget_target(key, tref)
+    target = tref()
+    if target is None: return
+    for listener in list(Target._death_listeners):
+        listener._target_died(target)
@@ -0,0 +1,156 @@
+from testlib import *
+from rulebook import aggregate
+from rulebook.tracked import TrackedList
+import operator
+
+
+def test_aggregate():
+    root,ctx = load_string('''
+        total = 0 prio -1
+        biggest = -1 prio -1
+        smallest = 100 prio -1
+        broken = 0 prio -1
+        any_on = False prio -1
+        for itm in items:
+            total += itm.size
+            biggest max= itm.size
+            smallest min= itm.size
+            broken count= not itm.ok
+            any_on |= itm.on
+    ''')
+    objs = []
+    for i in range(10):
+        obj = DummyObj('obj%d' % i)
+        obj.size, obj.ok, obj.on = i, i % 3 != 0, False
+        objs.append(obj)
+    ctx.ns.items = objs
+    root.set_active(True)
+    ns = ctx.ns
+    assert (ns.total, ns.biggest, ns.smallest, ns.broken, ns.any_on) == (45, 9, 0, 4, False)
+    vals = ctx._valuesets[Target(ns, 'attr', 'total')]
+    assert [ type(group) for group in vals._groups.values() ] == [aggregate.Sum]
+
+    objs[9].size = 20
+    objs[0].size = 5
+    objs[3].ok = True
+    objs[4].on = True
+    assert (ns.total, ns.biggest, ns.smallest, ns.broken, ns.any_on) == (61, 20, 1, 3, True)
+    ctx.ns.items = objs[:5]
+    assert (ns.total, ns.biggest, ns.smallest, ns.broken, ns.any_on) == (15, 5, 1, 1, True)
+    ctx.ns.items = []
+    assert (ns.total, ns.biggest, ns.smallest, ns.broken, ns.any_on) == (0, -1, 100, 0, False)
+    assert not ctx._valuesets[Target(ns, 'attr', 'total')]._groups
+
+def test_max_none():
+    root,ctx = load_string('''
+        for itm in items:
+            biggest max= itm.size
+        biggest = 0 prio -1
+    ''')
+    a, b = DummyObj('a'), DummyObj('b')
+    a.size, b.size = 3, 7
+    ctx.ns.items = [a, b]
+    root.set_active(True)
+    assert ctx.ns.biggest == 7
+    b.size = 1
+    assert ctx.ns.biggest == 3
+
+def test_fallback():
+    # Lists do not commute, they are folded one by one like other relative
+    # values (the later added first)
+    vals = ValueSet()
+    vals.set('base', [], 0)
+    vals.set('a', [1], 1, operator.add)
+    vals.set('c', [2], 1, operator.add)
+    assert vals.get_effective_value() == [2, 1]
+    vals.remove('a')
+    assert vals.get_effective_value() == [2]
+    vals.set('a', [1], 1, operator.add)
+    assert vals.get_effective_value() == [1, 2]
+    # A lower priority than the absolute value
+    vals.set('d', [0], -1, operator.add)
+    assert vals.get_effective_value() == [1, 2]
+
+def test_mixed_combs():
+    # Different combining functions at the same priority are folded in order
+    for values, expected in [([1, (1, operator.add), (2, operator.mul), (3, operator.add)], 9),
+                             ([1, (1, max), (-20, operator.add), (30, max)], 10)]:
+        vals = ValueSet()
+        entries = { 'base': (values[0], 0, None) }
+        for idx, (val, comb) in enumerate(values[1:]):
+            entries[idx] = (val, 1, comb)
+        for ident, entry in entries.items():
+            vals.set(ident, *entry)
+        assert vals.get_effective_value() == expected == get_effective_value(entries)
+        # With a single combining function left, the group applies as a whole
+        vals.remove(1)
+        del entries[1]
+        assert vals.get_effective_value() == get_effective_value(entries)
+
+def test_aggregate_expr():
+    root,ctx = load_string('''
+        stats.up = sum(1 for c in conns if c.up)
+        stats.top = max(c.n for c in conns)
+        stats.kinds = groupcount(c.kind for c in conns)
+        stats.nested = sum(sum(x for x in c.parts) for c in conns)
+    ''')
+    conns = TrackedList()
+    for i in range(10):
+        conn = DummyObj('conn%d' % i)
+        conn.up, conn.n, conn.kind, conn.parts = i % 2 == 0, i, 'k%d' % (i % 3), (i, 1)
+        conns.append(conn)
+    ctx.ns.conns = conns
+    ctx.ns.stats = stats = DummyObj('stats')
+    root.set_active(True)
+    assert (stats.up, stats.top, stats.kinds, stats.nested) == (5, 9, {'k0': 4, 'k1': 3, 'k2': 3}, 55)
+    # The rule only depends on the collection and the result
+    assign = root.body[0]
+    assert len(ctx._watchsets[(id(assign), 'rhs')]) == 2
+
+    conns[3].up = True
+    conns[9].n = -1
+    assert (stats.up, stats.top) == (6, 8)
+    assert ctx.stats['aggregate_updates'] == 2
+    conns[0].kind = 'k1'
+    assert stats.kinds == {'k0': 3, 'k1': 4, 'k2': 3}
+
+    del conns[:5]
+    conns.append(conns[0])
+    assert (stats.up, stats.top, stats.nested) == (2, 8, 46)
+    ctx.ns.conns = conns[:2]
+    assert (stats.up, stats.top) == (1, 6)
+
+    root.set_active(False)
+    assert not ctx._aggregates
+    assert ctx.stats['aggregates_swept'] == 4
+
+def test_aggregate_expr_sites():
+    # Aggregates in one expression differing only in kind or only in the iterable
+    root,ctx = load_string('''
+        spread = max(x.n for x in a) - min(x.n for x in a)
+        total = sum(x.n for x in a) + sum(x.n for x in b)
+    ''')
+    a, b = TrackedList(), TrackedList()
+    for lst, values in ((a, (1, 2, 3)), (b, (4, 5))):
+        for i, n in enumerate(values):
+            item = DummyObj('x%d' % i)
+            item.n = n
+            lst.append(item)
+    ctx.ns.a, ctx.ns.b = a, b
+    root.set_active(True)
+    assert (ctx.ns.spread, ctx.ns.total) == (2, 15)
+    a[0].n = 100
+    assert (ctx.ns.spread, ctx.ns.total) == (98, 114)
+
+def test_comprehension_scope():
+    root,ctx = load_string('''
+        names = [ c.name for c in conns ]
+        total = sum(c.n * k for c in conns for k in (1, 2))
+    ''')
+    a, b = DummyObj('a'), DummyObj('b')
+    a.name, a.n, b.name, b.n = 'a', 1, 'b', 2
+    ctx.ns.conns = [a, b]
+    root.set_active(True)
+    assert (ctx.ns.names, ctx.ns.total) == (['a', 'b'], 9)
+    with raises(AttributeError):
+        ctx.ns.c
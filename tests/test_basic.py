@@ -1,4 +1,5 @@
 from testlib import *
+import collections
 
 
 
@@ -92,3 +93,335 @@ def test_for():
     assert obj2.y == 20
 
 
+
+def test_eq_cutoff():
+    root,ctx = load_string('''
+        y = x // 10
+        z = f(y)
+    ''')
+    calls = []
+    def f(y):
+        calls.append(y)
+        return y
+    ctx.ns.f = f
+    ctx.ns.x = 1
+    root.set_active(True)
+    assert ctx.ns.z == 0
+    ncalls = len(calls)
+    ctx.ns.x = 5
+    assert len(calls) == ncalls
+    ctx.ns.x = 15
+    assert ctx.ns.z == 1
+    assert calls[ncalls:] == [1]
+
+def test_no_echo():
+    root,ctx = load_string('''
+        y = x
+        z = f(y)
+    ''')
+    calls = []
+    ctx.ns.f = lambda y: calls.append(y)
+    ctx.ns.x = 1
+    root.set_active(True)
+    ctx.ns.x = 2
+    # Writing `y` at commit must not re-run the watchers of `y`
+    assert calls == [1, 2]
+    assert ctx.stats['echo_suppressed'] >= 2
+    assert not ctx._queue
+
+def test_watchset_diff():
+    root,ctx = load_string('''
+        y = a if sel else b + b
+    ''')
+    ctx.ns.a, ctx.ns.b, ctx.ns.sel = 1, 2, True
+    root.set_active(True)
+    ns = ctx.ns
+    ident = (id(root.body[0]), 'rhs')
+    deps = ctx._watchsets[ident]
+    assert list(deps) == [Target(ns, 'attr', 'sel'), Target(ns, 'attr', 'a')]
+    ctx.ns.sel = False
+    assert ctx.ns.y == 4
+    # Repeated reads of `b` are only recorded once
+    assert list(ctx._watchsets[ident]) == [Target(ns, 'attr', 'sel'), Target(ns, 'attr', 'b')]
+    assert Target(ns, 'attr', 'a') not in ctx._watchers
+    ctx.ns.a = 42
+    assert ctx.ns.y == 4
+
+class Device(SlottedAbider):
+    FIELDS = ['rate', 'load', 'limit']
+    limit = 100
+
+def test_slotted_abider():
+    root,ctx = load_string('''
+        dev.limit = dev.rate * 2
+    ''')
+    ctx.ns.dev = dev = Device()
+    assert dev.limit == 100
+    with raises(AttributeError):
+        dev.load
+    dev.rate = 10
+    root.set_active(True)
+    assert dev.limit == 20
+    dev.rate = 5
+    assert dev.limit == 10
+    queued = ctx.stats['events_queued']
+    # Nobody watches `load`, so nothing is even queued
+    dev.load = 42
+    ctx.ns.unwatched = 42
+    assert ctx.stats['events_queued'] == queued
+    root.set_active(False)
+    assert not dev._rbk_subs
+
+def test_read_path():
+    root,ctx = load_string('''
+        a.x = a.b.c * 10 + a.d['k']
+    ''')
+    a, b, b2 = DummyObj('a'), DummyObj('b'), DummyObj('b2')
+    b.c, b2.c = 1, 3
+    a.b = b
+    a.d = {'k': 0}
+    ctx.ns.a = a
+    root.set_active(True)
+    assert a.x == 10
+    b.c = 2
+    assert a.x == 20
+    a.b = b2
+    assert a.x == 30
+    b.c = 7
+    assert a.x == 30
+
+    # The same reads are recorded as with the generic code path
+    N = ctx.nswrap
+    with ctx.track_reads() as generic:
+        val = N.a.b.c
+    with ctx.track_reads() as specialized:
+        assert ctx.read_path(N, (('attr', 'a'), ('attr', 'b'), ('attr', 'c'))) == val
+    assert list(generic) == list(specialized)
+    with ctx.track_reads():
+        wrapped = ctx.read_path(N, (('attr', 'a'), ('attr', 'b')))
+    assert isinstance(wrapped, ObjectWrapper) and wrapped._rbk_obj is b2
+
+def test_static_names():
+    root,ctx = load_string('''
+        import math
+        a.n = len(a.s) + math.floor(a.f)
+        b.n = abs(b.x)
+        abs = int
+    ''')
+    a, b = DummyObj('a'), DummyObj('b')
+    a.s, a.f, b.x = 'abc', 1.5, -3
+    ctx.ns.a, ctx.ns.b = a, b
+    root.set_active(True)
+    assert a.n == 4
+    watched = { target.subname for target in ctx._watchers }
+    assert 'len' not in watched and 'math' not in watched
+    # Names assigned by the rulebook stay namespace reads
+    assert 'abs' in watched
+    assert b.n == -3
+
+def test_static_names_shadowing():
+    root,ctx = load_string('''
+        enter:
+            N.round = lambda x: 42
+        a.n = round(a.f)
+        a.m = abs(a.f - 3)
+    ''')
+    a = DummyObj('a')
+    a.f = 1.5
+    ctx.ns.a = a
+    root.set_active(True)
+    # Assignments in imperative bodies shadow builtins, too
+    assert a.n == 42
+    assert a.m == 1.5
+    # Setting a static name from the outside warns
+    records = []
+    handler = logging.Handler(logging.WARNING)
+    handler.emit = records.append
+    logging.getLogger('rulebook.runtime').addHandler(handler)
+    try:
+        ctx.ns.round = lambda x: 7
+        assert a.n == 7
+        assert not any( 'builtin' in record.getMessage() for record in records )
+        ctx.ns.abs = lambda x: 0
+        assert any( "'abs'" in record.getMessage() for record in records )
+        # So does loading a rulebook after the name was set
+        del records[:]
+        ctx = Context()
+        ctx.ns.filter, ctx.ns.id, ctx.ns.unused = 'mine', 7, 1
+        root = loader.load_string('y = (filter, id)\n', ctx=ctx)[0]
+        root.set_active(True)
+        assert ctx.ns.y == (filter, id)
+        messages = [ record.getMessage() for record in records if 'builtin' in record.getMessage() ]
+        assert len(messages) == 2 and "'filter'" in messages[0] and "'id'" in messages[1]
+    finally:
+        logging.getLogger('rulebook.runtime').removeHandler(handler)
+
+def test_assign_parts():
+    root,ctx = load_string('''
+        sel(a).x = val(a.r) prio pri(a.p)
+    ''')
+    calls = collections.Counter()
+    def counted(name, func):
+        def wrapper(arg):
+            calls[name] += 1
+            return func(arg)
+        return wrapper
+    a, b = DummyObj('a'), DummyObj('b')
+    a.r, a.p, a.target = 1, 0, a
+    ctx.ns.a = a
+    ctx.ns.sel = counted('sel', lambda a: a.target)
+    ctx.ns.val = counted('val', lambda r: r * 10)
+    ctx.ns.pri = counted('pri', lambda p: p)
+    root.set_active(True)
+    assert a.x == 10
+    assert calls == {'sel': 1, 'val': 1, 'pri': 1}
+
+    a.r = 2
+    assert a.x == 20
+    assert calls == {'sel': 1, 'val': 2, 'pri': 1}
+    a.p = 5
+    assert calls == {'sel': 1, 'val': 2, 'pri': 2}
+    assert ctx._valuesets[Target(a, 'attr', 'x')].get_effective_value() == 20
+
+    # An LHS change moves the value
+    a.target = b
+    assert calls == {'sel': 2, 'val': 2, 'pri': 2}
+    assert b.x == 20
+    assert Target(a, 'attr', 'x') not in ctx._valuesets
+    a.r = 3
+    assert b.x == 30
+
+def test_constant_parts():
+    root,ctx = load_string('''
+        x = 42 prio 5
+        for itm in lst:
+            from math import floor
+            itm.y = floor(itm.x) prio -1
+    ''')
+    obj = DummyObj('obj')
+    obj.x = 1.5
+    ctx.ns.lst = [obj]
+    root.set_active(True)
+    assert ctx.ns.x == 42
+    assert obj.y == 1
+    # Only the RHS of the assignment in the loop depends on anything
+    assign = root.body[0]
+    assert not any(ident[0] == id(assign) for ident in ctx._watchsets if isinstance(ident, tuple))
+    assert ctx._valuesets[Target(ctx.ns, 'attr', 'x')].get_effective_value() == 42
+
+    from rulebook import parser, compiler
+    comp = compiler.Compiler()
+    comp.transform_node(parser.parse('import math\nx = 42 prio 5\na.x = math.pi\n'))
+    assert comp.stats == {'constant_obj': 1, 'constant_rhs': 1, 'constant_prio': 2,
+                          'hoisted_imports': 1}
+
+    # Imports in branches are only done when the branch is taken
+    root,ctx = load_string('''
+        if use_fast:
+            import no_such_module
+        if use_math:
+            import math
+            y = math.floor(1.5)
+    ''')
+    ctx.ns.use_fast = False
+    ctx.ns.use_math = False
+    root.set_active(True)
+    ctx.ns.use_math = True
+    assert ctx.ns.y == 1
+
+def test_for_key():
+    root,ctx = load_string('''
+        for dev in devs key dev.name:
+            dev.y = dev.x * 2
+            last.x = dev.x
+    ''')
+    def poll(**vals):
+        devs = []
+        for name, x in sorted(vals.items()):
+            dev = DummyObj(name)
+            dev.name, dev.x = name, x
+            devs.append(dev)
+        ctx.ns.devs = devs
+        return devs
+    ctx.ns.last = last = DummyObj('last')
+    a1, = poll(a=1)
+    root.set_active(True)
+    assert (a1.y, last.x) == (2, 1)
+    loop = root.body[0]
+    body = loop.cur_items['a'][2]
+
+    # A fresh object with the same key keeps the body
+    a2, b2 = poll(a=3, b=2)
+    assert (a2.y, b2.y) == (6, 4)
+    assert loop.cur_items['a'][2] is body
+    assert ctx.stats['for_rebound'] == 1
+    # The key reads the item, not the temporary overlay binding it
+    assert Target(b2, 'attr', 'name') in ctx._watchsets[id(loop)]
+    assert not ctx.gc_stats().get('watchers')
+    # The values moved to the new object
+    assert Target(a1, 'attr', 'y') not in ctx._valuesets
+    a2.x = 5
+    assert a2.y == 10
+    a1.x = 7
+    assert a2.y == 10
+
+    # A changed key is a new item
+    a2.name = 'c'
+    assert set(loop.cur_items) == {'b', 'c'}
+    assert loop.cur_items['c'][2] is not body
+    assert a2.y == 10
+
+def test_lazy():
+    root,ctx = load_string('''
+        if a:
+            x = f(1)
+        else:
+            x = f(2)
+    ''')
+    calls = []
+    def f(n):
+        calls.append(n)
+        return n
+    ctx.ns.f = f
+    ctx.ns.a = True
+    ctx.LAZY_IDLE_TIMEOUT = 0
+    root.set_active(True)
+    if_a = root.body[0]
+    assert ctx.ns.x == 1
+    # The `else` branch was never needed
+    assert if_a.orelse.directive is None
+    assert ctx.stats['lazy_built'] == 1
+
+    ctx.ns.a = False
+    assert ctx.ns.x == 2
+    # The idle `if` branch was evicted on commit and is rebuilt when needed
+    assert if_a.body.directive is None
+    ctx.ns.a = True
+    assert ctx.ns.x == 1
+    assert calls == [1, 2, 1]
+    assert (ctx.stats['lazy_built'], ctx.stats['lazy_evicted']) == (3, 2)
+
+def test_bulk():
+    root,ctx = load_string('''
+        x = 0 prio -1
+        if a:
+            x = 1 prio 1
+            x = 2 prio 2
+            x = 3 prio 3
+            y = x + 1
+        z = g(x)
+    ''')
+    calls = []
+    ctx.ns.g = lambda x: calls.append(x)
+    ctx.ns.a = False
+    root.set_active(True)
+    ctx.ns.a = True
+    # `x` was brought up to date before `y` read it
+    assert (ctx.ns.x, ctx.ns.y) == (3, 4)
+    stats = ctx.stats.copy()
+    ctx.ns.a = False
+    assert ctx.ns.x == 0
+    assert calls == [0, 3, 0]
+    # One recomputation and notification of `x` for all three removals
+    assert ctx.stats['bulk_coalesced'] - stats['bulk_coalesced'] == 2
+    assert ctx.stats['events_queued'] - stats['events_queued'] == 2 # x, z
@@ -0,0 +1,118 @@
+from testlib import *
+import os, sys, tempfile
+
+def test_cache():
+    # The cache honours PYTHONDONTWRITEBYTECODE, which may be set when testing.
+    dont_write, sys.dont_write_bytecode = sys.dont_write_bytecode, False
+    try:
+        _test_cache()
+    finally:
+        sys.dont_write_bytecode = dont_write
+
+def _test_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'test.rbk')
+        with open(fn, 'w') as file:
+            file.write('obj.x = 1\n')
+        cache_fn = loader.cache_from_source(fn)
+
+        def run():
+            obj = DummyObj('obj')
+            root, ctx = loader.load(fn)
+            ctx.ns.obj = obj
+            root.set_active(True)
+            return obj.x
+
+        os.chmod(fn, 0o644)
+        assert run() == 1
+        assert os.path.exists(cache_fn)
+        # The cache is as readable as the source
+        assert os.stat(cache_fn).st_mode & 0o777 == 0o644
+        # Poison the cached code to check that it is actually used.
+        code = loader.compiler.compile('obj.x = 2\n', fn)
+        with open(cache_fn, 'rb') as file:
+            header = file.read(len(loader._cache_header(os.stat(fn))))
+        loader._write_cache(cache_fn, header, code)
+        assert run() == 2
+
+        # A changed source invalidates the cache.
+        with open(fn, 'w') as file:
+            file.write('obj.x = 33\n')
+        assert run() == 33
+
+        # A corrupted cache is ignored and rewritten.
+        with open(cache_fn, 'r+b') as file:
+            data = file.read()
+            file.seek(0); file.truncate()
+            file.write(data[:len(data)//2])
+        assert run() == 33
+        assert len(open(cache_fn, 'rb').read()) == len(data)
+
+def test_reload():
+    src = '''
+obj.x = 1
+if obj.a:
+    obj.y = 2
+    obj.z = 3
+else:
+    obj.y = 0
+for item in obj.items:
+    item.v = 1
+enter:
+    N.log.append('enter')
+'''
+    obj = DummyObj('obj')
+    obj.a = True
+    obj.items = [DummyObj('item1'), DummyObj('item2')]
+    root, ctx = loader.load_string(src)
+    ctx.ns.obj = obj
+    ctx.ns.log = []
+    root.set_active(True)
+    assert (obj.x, obj.y, obj.z) == (1, 2, 3)
+    assert [ item.v for item in obj.items ] == [1, 1]
+    assign_x, if_a, for_items, enter = root.body
+
+    src = src.replace('obj.z = 3', 'obj.z = 4').replace('item.v = 1', 'item.v = 2')
+    src += 'obj.n = 7\n'
+    new_root = loader.reload_string(root, src)
+    assert new_root is root
+    assert (obj.x, obj.y, obj.z, obj.n) == (1, 2, 4, 7)
+    assert [ item.v for item in obj.items ] == [2, 2]
+    # Unchanged directives are kept as they are
+    assert root.body[:4] == [assign_x, if_a, for_items, enter]
+    assert ctx.ns.log == ['enter']
+
+    # Changes to the kept `If` are still tracked
+    obj.a = False
+    assert obj.y == 0
+    obj.a = True
+    assert obj.z == 4
+    obj.items.append(DummyObj('item3'))
+    obj.items = list(obj.items)
+    assert [ item.v for item in obj.items ] == [2, 2, 2]
+
+    # Changed directives are replaced
+    loader.reload_string(root, src.replace("'enter'", "'enter2'").replace('obj.n = 7\n', ''))
+    assert ctx.ns.log == ['enter', 'enter2']
+    assert len(root.body) == 4
+    assert not enter.active and root.body[3].active
+
+def test_reload_imports():
+    import types
+    for name in ('rbk_test_m1', 'rbk_test_m2'):
+        mod = sys.modules[name] = types.ModuleType(name)
+        mod.f = (lambda name: lambda a: (name, a))(name)
+    try:
+        root, ctx = loader.load_string('from rbk_test_m1 import f\nout = f(a)\ns = str(a)\n')
+        ctx.ns.a = 1
+        root.set_active(True)
+        assert ctx.ns.out == ('rbk_test_m1', 1)
+        str_a = root.body[2]
+        loader.reload_string(root, 'from rbk_test_m2 import f\nout = f(a)\ns = str(a)\n')
+        assert ctx.ns.out == ('rbk_test_m2', 1)
+        ctx.ns.a = 2
+        assert ctx.ns.out == ('rbk_test_m2', 2)
+        # Directives not using the changed name are kept
+        assert root.body[2] is str_a
+    finally:
+        del sys.modules['rbk_test_m1'], sys.modules['rbk_test_m2']
@@ -0,0 +1,118 @@
+from testlib import *
+from rulebook import parser, ast as rbkast
+import ast as pyast
+
+SAMPLE = '''\
+import operator
+from os import (path,
+    sep)
+set prio 3
+obj.x = 1
+obj.y = max(1,
+            2) prio 5
+obj.z += 2 prio 1
+if obj.a > 0:
+    obj.b = obj.a + 1
+    # comment
+    obj.c = [ x * 2 for x in range(obj.a) ]
+else:
+    obj.b = 0 prio 2
+if obj.a: obj.q = {1: 2}
+else: obj.q = 3
+for x in obj.items:
+    x.parent = obj
+    if x: x.z = 1
+enter:
+    print("hi")
+    if obj:
+        y = 1
+leave: print("bye"); z = 2
+obj.w = 1 + \\
+    2
+obj.s = 'end'
+'''
+
+def dump(node):
+    if isinstance(node, pyast.AST):
+        return pyast.dump(node)
+    elif isinstance(node, list):
+        return [ dump(x) for x in node ]
+    elif isinstance(node, rbkast.Node):
+        return (type(node).__name__, [ dump(getattr(node, fld)) for fld in node.FIELDS ])
+    else:
+        return node
+
+def test_single_pass():
+    assert dump(parser.parse(SAMPLE)) == dump(parser.parse(SAMPLE, single_pass=False))
+    # Compound simple bodies cannot be translated, the legacy parser is used.
+    src = 'if obj.a: obj.b = 1\nelse: if obj.c:\n    obj.b = 2\n'
+    assert dump(parser.parse(src)) == dump(parser.parse(src, single_pass=False))
+
+def test_single_pass_lines():
+    root = parser.parse(SAMPLE)
+    if_node = root.body.body[5]
+    assert if_node.cond.lineno == 9
+    assert if_node.body.body[1].rhs.lineno == 12
+    assert root.body.body[-1].lhs.lineno == 27
+
+    with raises(SyntaxError) as exc:
+        parser.parse('obj.x = 1\nif obj:\n    obj.y = (1,\n  2 +)\n')
+    assert exc.value.lineno == 4
+    assert exc.value.text == '  2 +)\n'
+    for src in ['obj.x = 1; obj.y = 2\n', 'obj.x = obj.y = 1\n', 'f(x) prio 2\n',
+                'set foo 3\n', 'if x:\n  x.y = 1\nelif y:\n  x.y = 2\n']:
+        with raises(SyntaxError):
+            parser.parse(src)
+
+def test_for_key():
+    src = ('for dev in devs key dev.name:\n    dev.x = 1\n'
+           'for key, (a, b) in d.items(), e key (key, a):\n    key.x = a\n'
+           'for x in sorted(d, key=f): x.y = 1\n')
+    root = parser.parse(src)
+    assert dump(root) == dump(parser.parse(src, single_pass=False))
+    keyed, pairs, plain = root.body.body
+    assert dump(keyed.item_key) == dump(pyast.parse('dev.name', mode='eval').body)
+    assert dump(pairs.iter) == dump(pyast.parse('d.items(), e', mode='eval').body)
+    assert isinstance(pairs.item_key, pyast.Tuple)
+    assert plain.item_key is None
+    # `key` is a name unless it splits the header into an iterable and a key
+    src = ('for x in a if key else b:\n    x.y = 1\n'
+           'for x in a if key else b key x.n:\n    x.y = 1\n')
+    root = parser.parse(src)
+    assert dump(root) == dump(parser.parse(src, single_pass=False))
+    plain, keyed = root.body.body
+    assert dump(plain.iter) == dump(pyast.parse('a if key else b', mode='eval').body)
+    assert plain.item_key is None
+    assert dump(keyed.iter) == dump(plain.iter)
+    assert dump(keyed.item_key) == dump(pyast.parse('x.n', mode='eval').body)
+    for single_pass in (True, False):
+        with raises(SyntaxError):
+            parser.parse('for x in a key:\n    x.y = 1\n', single_pass=single_pass)
+
+def test_named_assign_ops():
+    src = ('top max= a.x prio 3\nn count= a, b\nm = max(a, b)\nif c: low min= a.y\n')
+    root = parser.parse(src)
+    assert dump(root) == dump(parser.parse(src, single_pass=False))
+    top, n, m, if_c = root.body.body
+    assert dump(top.comb) == dump(pyast.parse('max', mode='eval').body)
+    assert dump(top.prio) == dump(pyast.parse('3', mode='eval').body)
+    assert dump(n.rhs) == dump(pyast.parse('a, b', mode='eval').body)
+    assert dump(n.comb) == dump(pyast.parse('R.aggregate.count', mode='eval').body)
+    assert m.comb is None and if_c.body.comb is not None
+    with raises(SyntaxError):
+        parser.parse('a.x @= b\n')
+    # The names are only operators after an lvalue
+    src = 'a.count = b\na.max = 3\ncount = 5\nif c: min = x\n'
+    root = parser.parse(src)
+    assert dump(root) == dump(parser.parse(src, single_pass=False))
+    for node in root.body.body[:3] + [root.body.body[3].body]:
+        assert isinstance(node, rbkast.Assign) and node.comb is None
+    assert root.body.body[0].lhs.attr == 'count'
+    assert root.body.body[2].lhs.id == 'count'
+    assert dump(parser.parse('a.count count= b\n').body.body[0].comb) == dump(n.comb)
+    src = 'x = lambda count=1, max=2: count + max prio 3\n'
+    root = parser.parse(src)
+    assert dump(root) == dump(parser.parse(src, single_pass=False))
+    assign, = root.body.body
+    assert assign.comb is None and isinstance(assign.rhs, pyast.Lambda)
+    assert dump(assign.prio) == dump(pyast.parse('3', mode='eval').body)
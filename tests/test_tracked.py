@@ -0,0 +1,156 @@
+from testlib import *
+from rulebook.tracked import TrackedList, TrackedDict, TrackedSet
+
+def events(coll):
+    log = []
+    coll._rbk_trackers = [ lambda target: log.append((target.subtype, target.subname)) ]
+    deltas = []
+    coll._rbk_listen(lambda added, removed: deltas.append((list(added), list(removed))))
+    return log, deltas
+
+def test_list_events():
+    lst = TrackedList([1, 2, 3])
+    log, deltas = events(lst)
+    lst.append(4)
+    lst[0] = 5
+    del lst[1]
+    lst.pop()
+    lst.extend([6, 6])
+    assert lst == [5, 3, 6, 6]
+    assert deltas == [([4], []), ([5], [1]), ([], [2]), ([], [4]), ([6, 6], [])]
+    assert ('item', 0) in log and log.count(('iter', None)) == 5
+    # Shifted indices are reported to their watchers
+    lst._rbk_trackers = ()
+    changed = []
+    tracker = lambda target: changed.append(target.subname)
+    for idx in [0, 2, -1]:
+        lst._rbk_subscribe(('item', idx), tracker)
+    lst.insert(1, 7)
+    assert sorted(changed) == [-1, 2]
+    # Including deletions of slices with a negative step
+    lst = TrackedList(range(8))
+    changed = []
+    for idx in [2, 3, 4]:
+        lst._rbk_subscribe(('item', idx), tracker)
+    del lst[5:2:-1]
+    assert lst == [0, 1, 2, 6, 7]
+    assert 3 in changed and 4 in changed
+
+def test_dict_set_events():
+    d = TrackedDict(a=1)
+    log, deltas = events(d)
+    d['a'] = 2
+    d['b'] = 3
+    d.pop('a')
+    assert deltas == [(['b'], []), ([], ['a'])]
+    # Changing a value does not change the keys
+    assert log[:2] == [('item', 'a'), ('iter', None)]
+    assert log[2:] == [('item', 'b'), ('len', None), ('keys', None), ('contains', 'b'), ('iter', None),
+                       ('item', 'a'), ('len', None), ('keys', None), ('contains', 'a'), ('iter', None)]
+
+    s = TrackedSet([1])
+    log, deltas = events(s)
+    s.add(1)
+    s |= {1, 2}
+    s.discard(1)
+    assert deltas == [([2], []), ([], [1])]
+
+def test_for_incremental():
+    root,ctx = load_string('''
+        for itm in lst:
+            itm.y = itm.x * 2
+    ''')
+    objs = [ DummyObj('obj%d' % i) for i in range(4) ]
+    for i, obj in enumerate(objs): obj.x = i
+    ctx.ns.lst = lst = TrackedList(objs[:2])
+    root.set_active(True)
+    assert [ obj.y for obj in objs[:2] ] == [0, 2]
+    loop = root.body[0]
+    evals = []
+    loop.iter = (lambda iter: lambda: evals.append(1) or iter())(loop.iter)
+
+    lst.append(objs[2])
+    assert objs[2].y == 4
+    lst.remove(objs[0])
+    assert Target(objs[0], 'attr', 'y') not in ctx._valuesets
+    # Duplicate items keep their body until the last one is removed
+    lst.append(objs[1])
+    lst.pop(0)
+    assert objs[1].y == 2
+    lst.pop()
+    assert Target(objs[1], 'attr', 'y') not in ctx._valuesets
+    assert set(loop.cur_items) == {id(objs[2])}
+    with ctx.batch():
+        lst.append(objs[3])
+        lst[0] = objs[1]
+    assert set(loop.cur_items) == {id(objs[1]), id(objs[3])}
+    assert not evals
+    assert ctx.stats['for_deltas'] == 7
+
+    # Replacing the collection re-evaluates the loop
+    ctx.ns.lst = TrackedList([objs[0]])
+    assert evals and set(loop.cur_items) == {id(objs[0])}
+    lst.append(objs[2])
+    assert set(loop.cur_items) == {id(objs[0])}
+    root.set_active(False)
+    assert not loop.cur_items and not lst._rbk_listeners
+
+def test_dependency_kinds():
+    root,ctx = load_string('''
+        out.big = count(len(q) > 2)
+        out.empty = count(not q)
+        out.has = count('a' in d)
+        out.keys = count(sorted(d.keys()))
+        out.val = count(d.get('b'))
+    ''')
+    calls = []
+    def count(val):
+        calls.append(val)
+        return val
+    ctx.ns.count = count
+    ctx.ns.out = out = DummyObj('out')
+    ctx.ns.q = q = TrackedList([1, 2])
+    ctx.ns.d = d = TrackedDict(b=1)
+    root.set_active(True)
+    assert (out.big, out.empty, out.has, out.keys, out.val) == (False, False, False, ['b'], 1)
+    del calls[:]
+
+    # Only rules that observed the change are re-evaluated
+    q[0] = 5
+    d['b'] = 2
+    assert calls == [2]
+    q.append(3)
+    # Both length rules, but not the rest
+    assert out.big and sorted(calls[1:]) == [False, True]
+    del calls[:]
+    d['c'] = 0
+    assert out.keys == ['b', 'c'] and calls == [['b', 'c']]
+    del calls[:]
+    d['a'] = 0
+    assert out.has
+    assert sorted(map(repr, calls)) == sorted(map(repr, [True, ['a', 'b', 'c']]))
+
+def test_contains_from_items():
+    # Objects reporting only item changes wake up membership tests
+    class Registry(RuleAbider):
+        def __init__(self):
+            super().__init__()
+            self._items = {}
+        def __contains__(self, key):
+            return key in self._items
+        def __getitem__(self, key):
+            return self._items[key]
+        def add(self, key, val):
+            self._items[key] = val
+            self._changed(('item', key))
+    root,ctx = load_string('''
+        out.has = 'a' in reg
+    ''')
+    ctx.ns.out = out = DummyObj('out')
+    ctx.ns.reg = reg = Registry()
+    root.set_active(True)
+    assert out.has is False
+    reg.add('b', 1)
+    assert out.has is False
+    reg.add('a', 1)
+    assert out.has is True
@@ -31,3 +31,108 @@ def test_trans_assign_indirect():
     assert obj.a == 0
     ctx.ns.x = 5
     assert obj.a == 10
+
+def test_batch():
+    root,ctx = load_string('''
+        y = f(x1, x2)
+    ''')
+    calls = []
+    def f(*a):
+        calls.append(a)
+        return sum(a)
+    ctx.ns.f = f
+    ctx.ns.x1 = ctx.ns.x2 = 0
+    root.set_active(True)
+    del calls[:]
+    with ctx.batch():
+        for i in range(10):
+            ctx.ns.x1 = i
+            with ctx.batch():
+                ctx.ns.x2 = i
+        assert calls == []
+    assert calls == [(9, 9)]
+    assert ctx.ns.y == 18
+    assert ctx.stats['batch_coalesced'] == 18
+
+def test_batch_explicit_transaction():
+    root,ctx = load_string('''
+        obj.a = 2*x
+    ''')
+    ctx.ns.obj = obj = EvenOnly()
+    ctx.ns.x = 0
+    root.set_active(True)
+    ctx.begin()
+    with ctx.batch():
+        ctx.ns.x = 1
+    assert obj.a == 0
+    ctx.commit()
+    assert obj.a == 2
+
+def test_glitch_free():
+    root,ctx = load_string('''
+        a = x + 1
+        b = x * 2
+        c = f(a, b)
+    ''')
+    calls = []
+    def f(a, b):
+        calls.append((a, b))
+        return a + b
+    ctx.ns.f = f
+    ctx.ns.x = 1
+    root.set_active(True)
+    del calls[:]
+    ctx.ns.x = 5
+    # `c` only runs once, after both `a` and `b` have been updated
+    assert calls == [(6, 10)]
+    assert ctx.last_trans_stats['watcher_runs'] == 3
+    assert ctx.last_trans_stats['events_coalesced'] == 1
+    assert ctx.last_trans_stats['events_queued'] == 4 # x, a, b, c
+
+def test_glitch_free_chain():
+    # `d` reads the root `a` directly as well as through the chain `b`, `c`,
+    # which is declared after it.
+    root,ctx = load_string('''
+        d = g(a, c)
+        c = b + 1
+        b = a + 1
+    ''')
+    calls = []
+    def g(a, c):
+        calls.append((a, c))
+        return a + c
+    ctx.ns.g = g
+    ctx.ns.a = 1
+    ctx.ns.b = ctx.ns.c = 0
+    root.set_active(True)
+    del calls[:]
+    ctx.ns.a = 10
+    assert calls == [(10, 12)]
+    assert ctx.ns.d == 22
+
+def test_wide_wave():
+    # Many watchers of a single target each run once, which is not oscillation
+    n = Context.MAX_CHAIN + 500
+    root,ctx = load_string('\n'.join( 'y%d = x + %d' % (i, i) for i in range(n) ))
+    ctx.ns.x = 0
+    root.set_active(True)
+    ctx.ns.x = 1
+    assert ctx.ns.y0 == 1 and getattr(ctx.ns, 'y%d' % (n - 1)) == n
+    assert ctx.last_trans_stats['watcher_runs'] == n
+
+def test_batch_many():
+    # A batch may change more targets than MAX_CHAIN
+    n = Context.MAX_CHAIN + 500
+    root,ctx = load_string('''
+        for o in objs:
+            o.y = o.x * 2
+    ''')
+    objs = [ DummyObj('o%d' % i) for i in range(n) ]
+    for o in objs: o.x = 0
+    ctx.ns.objs = objs
+    root.set_active(True)
+    with ctx.batch():
+        for i, o in enumerate(objs):
+            o.x = i
+    assert objs[-1].y == 2 * (n - 1)
+    assert ctx.last_trans_stats['watcher_runs'] == n
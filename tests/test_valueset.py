@@ -1,4 +1,5 @@
 from testlib import *
+import operator, random, gc
 
 
 def test_add_remove():
@@ -28,3 +29,101 @@ def test_add_remove():
     assert obj.x == 'normal'
     ctx.remove_value(target, normal_id)
     assert obj.x == 'low'
+
+def test_relative():
+    ctx = Context()
+    ctx.ns.obj = obj = DummyObj('obj')
+    target = (obj, 'attr', 'x')
+
+    ctx.add_value(target, 10, 0, 'base')
+    ctx.add_value(target, 5, 1, 'plus', comb=operator.add)
+    assert obj.x == 15
+    ctx.add_value(target, 2, 2, 'times', comb=operator.mul)
+    assert obj.x == 30
+    # Relative values below the anchor are ignored
+    ctx.add_value(target, 100, -1, 'low', comb=operator.add)
+    assert obj.x == 30
+    ctx.add_value(target, 20, 5, 'high')
+    assert obj.x == 20
+
+def test_valueset_matches_sort():
+    rnd = random.Random(42)
+    vals = {}
+    vs = ValueSet()
+    for i in range(2000):
+        ident = rnd.randrange(30)
+        if ident in vals and rnd.random() < 0.3:
+            del vals[ident]
+            vs.remove(ident)
+        else:
+            entry = (rnd.randrange(1000), rnd.randrange(-5, 5),
+                     operator.add if rnd.random() < 0.1 else None)
+            vals[ident] = entry
+            vs.set(ident, *entry)
+        if any( comb is None for val, prio, comb in vals.values() ):
+            assert vs.get_effective_value() == get_effective_value(vals)
+
+class CountingObj(DummyObj):
+    def __init__(self, name):
+        super().__init__(name)
+        self._writes = 0
+    def set_x(self, val):
+        self._writes += 1
+        self.x = val
+
+def test_eq_cutoff():
+    ctx = Context()
+    obj = CountingObj('obj')
+    target = (obj, 'attr', 'x')
+    ctx.add_value(target, 5, 0)
+    assert obj._writes == 1
+    ctx.add_value(target, 5, -10)
+    ctx.add_value(target, 5.0, 10, 'float')
+    assert obj._writes == 2 # 5 == 5.0 but they differ in type
+    ctx.remove_value(target, 'float')
+    assert obj._writes == 3
+
+    ctx.EQ_CUTOFF = False
+    ctx.add_value(target, 5, -20)
+    assert obj._writes == 4
+
+def test_gc():
+    root,ctx = load_string('''
+        for itm in lst:
+            itm.y = itm.x + offset
+            if itm.x:
+                itm.z = 1 prio -5
+    ''')
+    ctx.ns.offset = 1
+    objs = [ DummyObj('obj%d' % i) for i in range(10) ]
+    for obj in objs:
+        obj.x = 1
+        # An assignment the rulebook never removes
+        ctx.add_value((obj, 'attr', 'z'), 0, -10)
+    ctx.ns.lst = objs
+    root.set_active(True)
+    assert objs[3].y == 2 and objs[3].z == 1
+    nvalsets = len(ctx._valuesets)
+    ctx.ns.lst = []
+    del obj, objs
+    gc.collect()
+    stats = ctx.gc_stats()
+    assert stats['valuesets'] == 10
+    assert len(ctx._valuesets) == nvalsets - 20
+    assert not [ t for t in ctx._watchers if t.obj is None ]
+
+def test_single_value():
+    ctx = Context()
+    obj = DummyObj('obj')
+    target = Target(obj, 'attr', 'x')
+    ctx.add_value(target, 1, 0, 'a')
+    assert type(ctx._valuesets[target]) is SingleValueSet
+    ctx.add_value(target, 2, 5, 'b')
+    vals = ctx._valuesets[target]
+    # A second value promotes the set and keeps its state
+    assert type(vals) is ValueSet
+    assert vals.committed_value == 2 and obj.x == 2
+    ctx.remove_value(target, 'b')
+    ctx.remove_value(target, 'a')
+    assert obj.x == 1
+    assert target not in ctx._valuesets